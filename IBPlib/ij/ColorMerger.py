@@ -19,125 +19,335 @@ path.append(jython_scripts)
 #=========================================#
 
 from ij import IJ
-from ij.io import FileSaver
 from ij.plugin import RGBStackMerge
-from IBPlib.ij.Colortags import Colortags
-from IBPlib.ij.Utils.Files import (buildList, imageloader)
+from IBPlib.ij.Colortags import get_colortags
+from IBPlib.ij.Utils.Files import (scan, check_folder, imageloader, ensure_folder)
+from IBPlib.ij.Utils.Scheduler import AdmissionScheduler
+from IBPlib.ij.Utils.Manifest import (Manifest, callable_name, parameter_value)
+from IBPlib.ij.Utils.Sharding import (RunReport, shard_of, validate_shard)
+from IBPlib.ij.Utils import Output
 
-__version__ = "1.1"
+__version__ = "1.2"
 __threadname__ = "IBPlib.ij.ColorMerger" # Threads spawned by ColorMerger have this name + name of the final image.
 
 class ColorMerger:
 	'''
 	If you want to use ColorMerger in opened images explicitly pass False or None to the 3 parameters.
+
+	Merging runs as a staged pipeline: a pool of readers loads the channels of each image,
+	a pool of mergers builds the composites and a pool of writers saves them.
+	Stages are joined by bounded queues, so a slow stage blocks the previous one
+	and only a handful of images are held in memory at any time.
+	New images are only loaded when the scheduler admits them under its memory budget.
+	Pool sizes default to the scheduler max_workers (the core count unless set).
+	colortags can be a Colortags instance, a dict or a json file (see Colortags.get_colortags),
+	IJ prefs are used if not given.
+	shard=(index, count) restricts the run to one deterministic share of the images, so count
+	processes can work on the same folder. All channels of an image land in the same shard.
+	Merge the shard manifests and run reports with IBPlib.ij.Utils.Sharding.merge_shards.
+	writer is an optional IBPlib.ij.Utils.ThreadedFileSaver.WriterPool, which then replaces the
+	writer stage and can be shared with other pipelines. It is flushed at the end of run.
+	output is an optional IBPlib.ij.Utils.Output.OutputWriter (compression, tiles, BigTIFF) used by
+	the writer stage. With a WriterPool, its output is used instead.
 	'''
 
-	def __init__(self, savefolder, imgfolder, ext, debug=False):
+	def __init__(self, savefolder, imgfolder, ext, debug=False, readers=None, mergers=None, writers=None, queue_size=2,
+		scheduler=None, colortags=None, shard=(0, 1), writer=None, output=None):
+		validate_shard(shard)
 		self.debug=debug
-		self.Colortags = Colortags()
+		self.shard = tuple(shard)
+		self.Colortags = get_colortags(colortags)
 		self.savefolder = savefolder
 		self.imgfolder = imgfolder
 		self.ext = ext
-		self.MAXWORKERS = 3
+		self.scheduler = scheduler or AdmissionScheduler()
+		self.READERS = readers or self.scheduler.max_workers
+		self.MERGERS = mergers or self.scheduler.max_workers
+		self.WRITERS = writers or self.scheduler.max_workers
+		self.writer = writer
+		self.output_writer = output # Not self.output, the method queueing the composites.
 		self.tasks_q = Queue()
+		self.merge_q = Queue(maxsize=queue_size)
+		self.save_q = Queue(maxsize=queue_size)
 		self.workers = []
+		self.manifest = None
+		self.report = RunReport("ColorMerger", self.shard)
+		self.run_inputs = {}
+		self.run_params = {}
 		
 
-	def run(self, onGPU=False, postProcessingMethod=None, postProcessingMethodArgs=[]):
+	def run(self, onGPU=False, postProcessingMethod=None, postProcessingMethodArgs=[], incremental=True, recursive=False,
+		images=None, exclusionFlag="done"):
 		'''
 		Main pipeline to merge images in parallel
+		Images are queued while imgfolder is scanned, see scanchannels.
+		Files containing exclusionFlag in their name (e.g. already processed ones) are not scanned.
+		With recursive, subfolders are scanned too and their layout is mirrored in savefolder.
+		images is an iterable of paths under imgfolder to merge instead of scanning it,
+		e.g. the result of an IBPlib.ij.Utils.Index.ImageIndex query.
+		If incremental, images whose output is recorded in the savefolder manifest with the same
+		inputs and parameters are skipped.
 		'''
 		IJ.log("\n### ColorMerger v{0} has started".format(__version__))
 		if self.debug:
 			IJ.log("\n*** Debug mode")
-		img_list = buildList(self.imgfolder, extension=self.ext, debug=self.debug)
-		IJ.log("\n{0} images are being processed.".format(len(img_list)))
-		titleslist = [os.path.split(img)[1] for img in img_list]
-		sortedtitles = self.sortbytag(titleslist)
-		if self.debug:
-			print("\nColorMerger.run() -> titleslist = {0}\n\nsortedtitles = {1}".format(titleslist, sortedtitles))
+		self.report = RunReport("ColorMerger", self.shard)
+		if self.savefolder and not self.debug:
+			self.setup_manifest(postProcessingMethod, postProcessingMethodArgs)
 		IJ.log("\n#########\n")
-   
-		for root, channels in sortedtitles.items():
-			self.tasks_q.put((root, channels, onGPU,
-				postProcessingMethod,
-				postProcessingMethodArgs),
-			block=True)
-		IJ.log("Tasks ready")
-		self.setup_workers()
 
-		self.tasks_q.join()
+		exclude = None
+		if exclusionFlag:
+			exclude = "*{0}*".format(exclusionFlag)
+
+		if images is None:
+			check_folder(self.imgfolder) # Fails before any worker is started.
+		self.setup_workers()
+		queued, uptodate = 0, 0
+		try:
+			for root, channels in self.scanchannels(recursive, images, exclude):
+				if self.shard[1] > 1 and shard_of(root, self.shard[1]) != self.shard[0]:
+					continue
+				if self.manifest:
+					self.run_inputs[root] = [os.path.join(self.imgfolder, title) for title in channels if title]
+					if incremental and self.manifest.is_up_to_date(root, self.run_inputs[root], self.run_params):
+						self.report.skipped(root)
+						uptodate += 1
+						continue
+				if self.debug:
+					print("\nColorMerger.run() -> {0} = {1}".format(root, channels))
+				self.tasks_q.put((root, channels, onGPU,
+					postProcessingMethod,
+					postProcessingMethodArgs),
+				block=True)
+				queued += 1
+			if self.shard[1] > 1:
+				IJ.log("\nShard {0} of {1}.".format(self.shard[0], self.shard[1]))
+			IJ.log("\n{0} images are being processed, {1} images are up to date and were skipped.".format(queued, uptodate))
+			IJ.log("Tasks ready")
+		finally:
+			self.shutdown_workers() # Also stops the workers when queueing failed.
+		if self.writer:
+			self.writer.flush()
+			self.writer.log_stats()
+		if self.manifest:
+			self.manifest.save()
+			self.report.save(self.savefolder, {"scheduler": self.scheduler.report()})
+		self.scheduler.log_report()
 		IJ.log("\n### Done merging.")
 
 
+	def setup_manifest(self, postProcessingMethod, postProcessingMethodArgs):
+		'''
+		Loads the savefolder manifest and sets the parameters of the run.
+		The inputs of each root are recorded in self.run_inputs as they are queued.
+		'''
+		self.manifest = Manifest(self.savefolder, shard=self.shard)
+		self.run_params = {"colortags": self.Colortags.tags,
+			"postProcessingMethod": callable_name(postProcessingMethod),
+			"postProcessingMethodArgs": [parameter_value(arg) for arg in postProcessingMethodArgs]}
+		output = getattr(self.writer, "output", None) if self.writer else self.output_writer
+		if output:
+			self.run_params["output"] = output.settings() # A settings change rewrites the images.
+		self.run_inputs = {}
+
+
 	def dummy_task(self):
-		import time.sleep
-		while not self.tasks_q.empty():
-			root, sortedchannels, onGPU, postProcessingMethod, postProcessingMethodArgs = self.tasks_q.get()
+		from time import sleep
+		while True:
+			task = self.tasks_q.get()
+			if task is None:
+				self.tasks_q.task_done()
+				break
+			root, sortedchannels, onGPU, postProcessingMethod, postProcessingMethodArgs = task
 			IJ.log("Working on {0}".format(root))
-			time.sleep(5)
+			sleep(5)
 			IJ.log("Done working on {0}".format(root))
 			self.tasks_q.task_done()
 
 
 	def setup_workers(self):
-		task = self.mergerthread_task
+		'''
+		Starts the reader, merger and writer pools.
+		Stages are started downstream first so that no queue is ever left without a consumer.
+		'''
 		if self.debug:
-			task = self.dummy_task
-		 
-		for i in range(self.MAXWORKERS):
-			t = Thread(target=task, name="{0}.{1}".format(__threadname__, i))
-			self.workers.append(t)
-			t.start()
-
+			stages = ((self.dummy_task, self.READERS, "reader"),)
+		else:
+			stages = ((self.writerthread_task, self.WRITERS, "writer"),
+				(self.mergerthread_task, self.MERGERS, "merger"),
+				(self.readerthread_task, self.READERS, "reader"))
+			if self.writer:
+				stages = stages[1:]
+		self.workers = []
+		for task, size, stage in stages:
+			pool = []
+			for i in range(size):
+				t = Thread(target=task, name="{0}.{1}.{2}".format(__threadname__, stage, i))
+				pool.append(t)
+				t.start()
+			self.workers.append((stage, pool))
 
-	def sortbytag(self, titleslist):
-		'''
-		Sorts and indexes images based on the root of the image title and color tag index.
-		Image gets excluded from sorted list if it has only one channel.
-		'''
-		sortedimgs = {}
+
+	def shutdown_workers(self):
+		'''
+		Drains the pipeline stage by stage.
+		Each stage receives one sentinel per thread once the previous stage has finished.
+		'''
+		queues = {"reader": self.tasks_q, "merger": self.merge_q, "writer": self.save_q}
+		for stage, pool in reversed(self.workers):
+			for t in pool:
+				queues[stage].put(None, block=True)
+			for t in pool:
+				t.join()
+		self.workers = []
+
+
+	def sortbytag(self, titleslist):
+		'''
+		Sorts and indexes images based on the root of the image title and color tag index.
+		Image gets excluded from sorted list if it has only one channel.
+		Titles matching more than one colortag are logged. See scanchannels to sort while scanning.
+		'''
 		if self.debug:
 			print("Checking user defined colortags -> {0}".format(self.Colortags.tags))
-		for img in titleslist:
-			imgtitleroot = ""
-			for index, tagstuple in self.Colortags.tags.items():
-				for colortag in tagstuple:
-					if colortag not in img:
-						continue
-					imgtitleroot = "".join(img.split(colortag))
-					if imgtitleroot not in sortedimgs:
-						impsbucket = [None]*7
-						impsbucket[index] = img
-						sortedimgs.update({imgtitleroot:impsbucket})
-					else:
-						sortedimgs[imgtitleroot][index] = img
-		singlets = []
-		for root, channels in sortedimgs.items():
-			channelcount = len([True for title in channels if title])
-			if channelcount < 2:
-				IJ.log("\nSkipping <{0}> as it had only one channel.".format(root))
-				singlets.append(root)
-		[sortedimgs.pop(root) for root in singlets]
-		return sortedimgs
+		sortedimgs, ambiguous = self.Colortags.get_matcher().sort(titleslist)
+		for img, colortags in ambiguous.items():
+			IJ.log("\n<{0}> matches more than one colortag {1}.".format(img, colortags))
+		singlets = []
+		for root, channels in sortedimgs.items():
+			channelcount = len([True for title in channels if title])
+			if channelcount < 2:
+				IJ.log("\nSkipping <{0}> as it had only one channel.".format(root))
+				singlets.append(root)
+		[sortedimgs.pop(root) for root in singlets]
+		return sortedimgs
+
+
+	def scanchannels(self, recursive=False, images=None, exclude="*done*"):
+		'''
+		Generator of (root, sortedchannels) found while scanning self.imgfolder (skipping the files
+		matching the exclude pattern), or in images (paths under self.imgfolder) if given.
+		Titles and roots are relative to self.imgfolder.
+		A root is yielded as soon as it has a title for every colortag channel,
+		the other roots once their folder has been listed.
+		Roots with only one channel are skipped and titles matching more than one colortag are logged.
+		'''
+		matcher = self.Colortags.get_matcher()
+		nchannels = len(set([index for indexes in matcher.indexes.values() for index in indexes]))
+		pending = {}
+		dispatched = set()
+		folder = None
+		if images is None:
+			images = scan(self.imgfolder, extensions=self.ext, exclude=exclude, recursive=recursive)
+		else:
+			images = sorted(images)
+		for imgpath in images:
+			imgfolder, title = os.path.split(os.path.relpath(imgpath, self.imgfolder))
+			if imgfolder != folder:
+				for task in self.flushchannels(pending):
+					yield task
+				dispatched.clear()
+				folder = imgfolder
+			sortedimgs, ambiguous = matcher.sort([title])
+			for img, colortags in ambiguous.items():
+				IJ.log("\n<{0}> matches more than one colortag {1}.".format(img, colortags))
+			for root, channels in sortedimgs.items():
+				root = os.path.join(folder, root)
+				if root in dispatched:
+					IJ.log("\nSkipping <{0}> as <{1}> was already queued.".format(title, root))
+					continue
+				bucket = pending.setdefault(root, [None]*7)
+				for index, channel in enumerate(channels):
+					if channel:
+						bucket[index] = os.path.join(folder, channel)
+				if nchannels > 1 and len([True for channel in bucket if channel]) == nchannels:
+					dispatched.add(root)
+					yield root, pending.pop(root)
+		for task in self.flushchannels(pending):
+			yield task
+
+
+	def flushchannels(self, pending):
+		'''
+		Empties pending ({root: sortedchannels}) and returns its roots with at least two channels.
+		'''
+		ready = []
+		for root, channels in sorted(pending.items()):
+			if len([True for title in channels if title]) < 2:
+				IJ.log("\nSkipping <{0}> as it had only one channel.".format(root))
+				continue
+			ready.append((root, channels))
+		pending.clear()
+		return ready
 
 
-	def mergerthread_task(self):
+	def readerthread_task(self):
 		'''
-		Wrapper method to encapsulate mergechannels in a Thread inside a Queue object
+		Reader stage. Loads the channels of each task and hands them to the merger stage.
 		'''
-		while not self.tasks_q.empty():
-			root, sortedchannels, onGPU, postProcessingMethod, postProcessingMethodArgs = self.tasks_q.get()
-			try:
-				self.mergechannels(root,
-						sortedchannels,
-						onGPU=onGPU,
-						postProcessingMethod=postProcessingMethod,
-						postProcessingMethodArgs=postProcessingMethodArgs)
-			except (Exception, java.lang.Exception):
-				IJ.log(traceback.format_exc())
+		while True:
+			task = self.tasks_q.get()
+			if task is None:
+				self.tasks_q.task_done()
+				break
+			root, sortedchannels, onGPU, postProcessingMethod, postProcessingMethodArgs = task
+			cost = None
+			try:
+				cost = self.admit(sortedchannels)
+				imps = self.loadchannels(sortedchannels)
+				self.merge_q.put((root, imps, cost, postProcessingMethod, postProcessingMethodArgs), block=True)
+			except (Exception, java.lang.Exception) as e:
+				if cost is not None:
+					self.scheduler.release(cost)
+				self.report.failed(root, e)
+				IJ.log(traceback.format_exc())
 			finally:
 				self.tasks_q.task_done()
+
+
+	def mergerthread_task(self):
+		'''
+		Merger stage. Builds the composite of each loaded task and hands it to the writer stage.
+		'''
+		while True:
+			task = self.merge_q.get()
+			if task is None:
+				self.merge_q.task_done()
+				break
+			root, imps, cost, postProcessingMethod, postProcessingMethodArgs = task
+			try:
+				composite = self.merge(root, imps, postProcessingMethod, postProcessingMethodArgs)
+				if composite:
+					self.output(root, composite, imps, cost)
+				else:
+					self.scheduler.release(cost)
+			except (Exception, java.lang.Exception) as e:
+				self.scheduler.release(cost)
+				self.report.failed(root, e)
+				IJ.log(traceback.format_exc())
+			finally:
+				self.merge_q.task_done()
+
+
+	def writerthread_task(self):
+		'''
+		Writer stage. Saves the composites handed by the merger stage.
+		'''
+		while True:
+			task = self.save_q.get()
+			if task is None:
+				self.save_q.task_done()
+				break
+			root, composite, cost = task
+			try:
+				self.save(root, composite)
+			except (Exception, java.lang.Exception) as e:
+				self.report.failed(root, e)
+				IJ.log(traceback.format_exc())
+			finally:
+				self.scheduler.release(cost)
+				self.save_q.task_done()
 
 
 	def mergechannels(self, root, sortedchannels, onGPU=False, postProcessingMethod=None,
@@ -146,45 +356,138 @@ class ColorMerger:
 		Merge sorted channels(list of titles) under a given root title.
 		If ColorMerger was initialized with a savefolder it will try to save img in savefolder
 		else will merge channels, close original images and show the resulting composite.
+		Runs the three pipeline stages in series in the calling thread.
+		'''
+		imps = self.loadchannels(sortedchannels)
+		composite = self.merge(root, imps, postProcessingMethod, postProcessingMethodArgs)
+		if not composite:
+			return
+		if self.savefolder:
+			self.save(root, composite)
+		else:
+			self.output(root, composite, imps)
+
+
+	def admit(self, sortedchannels):
+		'''
+		Blocks until the scheduler has room for the channels (list of titles) and their composite.
+		Returns the admitted cost, which has to be released once the composite leaves the pipeline.
+		'''
+		imgpaths = [os.path.join(self.imgfolder, title) for title in sortedchannels if title]
+		cost = self.scheduler.footprint(imgpaths, overhead=2.0)
+		return self.scheduler.admit(cost)
+
+
+	def loadchannels(self, sortedchannels):
+		'''
+		Loads the channels (list of titles) from self.imgfolder.
+		Returns a list of ImagePlus keeping the colortag indexes, None for missing channels.
+		'''
+		imgpaths = [os.path.join(self.imgfolder, title) if title else None for title in sortedchannels]
+		imps = [imageloader(path) if path else None for path in imgpaths]
+		return imps
+
+
+	def merge(self, root, imps, postProcessingMethod=None, postProcessingMethodArgs=[]):
+		'''
+		Merges the loaded channels and applies the post processing method.
+		Returns the calibrated composite or None if channels could not be merged.
 		'''
 		IJ.log("\n## Merging <{0}>".format(root))
-		imgpaths = [os.path.join(self.imgfolder, title) if title else None for title in sortedchannels]
-		imps = [imageloader(path) if path else None for path in imgpaths]
 		for img in imps:
 			if img:
 				calibration = img.getCalibration()
 				break
 		merger = RGBStackMerge()
-		
+
 		try:
 			composite = merger.mergeChannels(imps, False)
 			composite.setTitle(root)
 		except (Exception, java.lang.Exception):
 			t_name = current_thread().name
 			IJ.log("# {0}\t{1} images skipped as channels have different dimensions".format(t_name, root))
-			return
-			
-		try:	
+			self.report.failed(root, "channels have different dimensions")
+			return None
+
+		try:
 			if postProcessingMethod:
 				postProcessingMethod(composite, *postProcessingMethodArgs)
 		except Exception as e:
 			t_name = current_thread().name
 			IJ.log("# {0}\t{1} post processing skipped due to error.\n{2}".format(t_name, root, e))
-			
+
 		composite.setCalibration(calibration)
-		if self.savefolder:
-			save_string = os.path.join(self.savefolder, root)
-			try:
-				FileSaver(composite).saveAsTiff(save_string)
-				IJ.log("{0}".format(save_string))
-			except (Exception, java.lang.Exception) as e:
-				IJ.log("ij.io.FileSaver raised an {0} exception while trying to save img '{1}' as '{2}'. Skipping image."
-						.format(e, root, save_string))
-		else:
-			composite.setTitle(root)
-			[imp.close() for imp in imps if imp]
-			composite.show()
-			
+		return composite
+
+
+	def output(self, root, composite, imps, cost=None):
+		'''
+		Queues the composite for saving if ColorMerger has a savefolder,
+		else closes the original images and shows the composite.
+		cost is the admitted cost of the task when running in the pipeline and is
+		released once the composite leaves it.
+		'''
+		if self.savefolder and self.writer:
+			self.submit(root, composite, cost)
+		elif self.savefolder:
+			self.save_q.put((root, composite, cost), block=True)
+		else:
+			composite.setTitle(root)
+			[imp.close() for imp in imps if imp]
+			composite.show()
+			if cost is not None:
+				self.scheduler.release(cost)
+
+
+	def submit(self, root, composite, cost=None):
+		'''
+		Hands the composite to self.writer to be saved as root in self.savefolder.
+		The task cost is released and the save recorded once the writer is done with it.
+		'''
+		save_string = os.path.join(self.savefolder, root)
+		ensure_folder(os.path.dirname(save_string))
+
+		def done(future):
+			try:
+				if future.ok:
+					self.saved(root, save_string)
+				else:
+					self.report.failed(root, future.error)
+			finally:
+				if cost is not None:
+					self.scheduler.release(cost)
+
+		return self.writer.submit(composite, save_string, callback=done)
+
+
+	def saved(self, root, save_string):
+		'''
+		Records a saved composite in the run report and the manifest.
+		'''
+		IJ.log("{0}".format(save_string))
+		self.report.processed(root)
+		if self.manifest and root in self.run_inputs:
+			self.manifest.record(root, self.run_inputs[root], self.run_params)
+
+
+	def save(self, root, composite):
+		'''
+		Saves the composite as root in self.savefolder.
+		Saved images are recorded in the manifest when running through run().
+		'''
+		save_string = os.path.join(self.savefolder, root)
+		try:
+			ensure_folder(os.path.dirname(save_string))
+			if not Output.save(composite, save_string, self.output_writer):
+				IJ.log("# '{0}' could not be saved.".format(save_string))
+				self.report.failed(root, "could not be saved")
+				return
+			self.saved(root, save_string)
+		except (Exception, java.lang.Exception) as e:
+			self.report.failed(root, e)
+			IJ.log("ij.io.FileSaver raised an {0} exception while trying to save img '{1}' as '{2}'. Skipping image."
+					.format(e, root, save_string))
+
 
 
 if __name__ in ("__builtin__", "__main__"):
@@ -1,3 +1,9 @@
+import os
+import re
+import json
+
+from threading import RLock
+
 from ij import IJ
 from ij import Prefs
 from ij.gui import GenericDialog, DialogListener
@@ -5,23 +11,60 @@ from IBPlib.ij.Constants import LIBPREFSKEY, COLORS
 
 SUBKEY="{0}.colortags".format(LIBPREFSKEY) # Base name for userPrefs key used by Colortags.py
 
+__CACHE__ = {} # Process wide Colortags instances built by get_colortags indexed by source.
+__CACHE_LOCK__ = RLock()
+
 class Colortags:
 	'''
 	This class handles persistence of the name of different color channels.
 	It instantiates a GUI window to capture and show the color names in use.
 	Other classes such as ColorMerger needs this to determine the color of the channel being processed.
+	Tags can also be supplied as a dict, in which case IJ prefs are not read.
+	When not interactive (by default on headless JVMs) a missing tag raises ValueError instead of
+	opening the dialog.
 	'''
-	def __init__(self):
+	def __init__(self, tags=None, interactive=None):
 
 		self.window = None
 		self.tags = {}
+		self.matcher = None
 		self.prefkeys = ["{0}.{1}".format(SUBKEY, name) for name in COLORS]
 		self.userprefs = Prefs()
-		self.load()
+		if interactive is None:
+			interactive = not is_headless()
+		if tags is None:
+			self.load()
+		else:
+			self.tags = parse_tags(tags)
+		if not self.tags and not interactive:
+			raise ValueError("No colortags set. Supply them as a dict or json file when running headless.")
 		while not self.tags:
 			self.edit("Please set at least one colortag.\n\n")
 
 
+	@classmethod
+	def from_dict(cls, tags):
+		'''
+		Returns Colortags built from a dict {channel: tags} without reading IJ prefs.
+		Channels are indexes (0-6) or color names from IBPlib.ij.Constants.COLORS,
+		tags are lists of strings or comma separated strings.
+		'''
+		return cls(tags=tags, interactive=False)
+
+
+	@classmethod
+	def from_json(cls, json_file):
+		'''
+		Returns Colortags built from a json file holding the tags dict, either at the top level
+		or under a "colortags" key (e.g. in a batch parameters file).
+		'''
+		with open(json_file, "r") as tags_json:
+			tags = json.load(tags_json)
+		if "colortags" in tags:
+			tags = tags["colortags"]
+		return cls.from_dict(tags)
+
+
 	def load(self):
 		'''
 		Tries to load IBPlib colortags from IJ prefs.
@@ -32,6 +75,17 @@ class Colortags:
 				continue
 			trimmedtagslist = [t.strip() for t in storedtags.split(",")]
 			self.tags.update({i:trimmedtagslist})
+		self.matcher = None
+
+
+	def get_matcher(self):
+		'''
+		Returns a TagMatcher compiled from the current tags.
+		The matcher is built once and rebuilt only after the tags are reloaded.
+		'''
+		if self.matcher is None:
+			self.matcher = TagMatcher(self.tags)
+		return self.matcher
 
 
 	def edit(self, msg=""):
@@ -50,6 +104,8 @@ class Colortags:
 		if self.window.wasOKed():
 			self.__savetags()
 			self.load()
+			with __CACHE_LOCK__:
+				__CACHE__.pop(None, None)
 
 
 	def __validate(self):
@@ -71,5 +127,147 @@ class Colortags:
 			self.userprefs.savePreferences()
 
 
+def is_headless():
+	'''
+	Returns True if the JVM has no display to show dialogs.
+	'''
+	from java.awt import GraphicsEnvironment
+	return GraphicsEnvironment.isHeadless()
+
+
+def parse_tags(tags):
+	'''
+	Normalises a {channel: tags} dict to the {index: [tags]} layout used by Colortags.
+	'''
+	names = [name.lower() for name in COLORS]
+	parsed = {}
+	for channel, channeltags in tags.items():
+		if isinstance(channel, basestring) and channel.lower() in names:
+			index = names.index(channel.lower())
+		else:
+			index = int(channel)
+		if not 0 <= index < len(COLORS):
+			raise ValueError("Colortag channel {0} is out of range.".format(channel))
+		if isinstance(channeltags, basestring):
+			channeltags = channeltags.split(",")
+		trimmedtagslist = [t.strip() for t in channeltags if t.strip()]
+		if trimmedtagslist:
+			parsed[index] = trimmedtagslist
+	return parsed
+
+
+def get_colortags(source=None, interactive=None):
+	'''
+	Returns a process wide cached Colortags.
+	source can be None (IJ prefs), a json file path, a dict or a Colortags instance.
+	Prefs are read once per process and json files once per mtime, so short lived
+	jobs reuse the tags with no Prefs I/O and no dialog.
+	'''
+	if isinstance(source, Colortags):
+		return source
+	if isinstance(source, dict):
+		return Colortags(tags=source, interactive=False)
+	if source is None:
+		key = None
+	else:
+		key = (os.path.abspath(source), os.path.getmtime(source))
+	with __CACHE_LOCK__:
+		colortags = __CACHE__.get(key)
+		if colortags is None:
+			if source is None:
+				colortags = Colortags(interactive=interactive)
+			else:
+				colortags = Colortags.from_json(source)
+			__CACHE__[key] = colortags
+	return colortags
+
+
+class TagMatcher:
+	'''
+	Groups image titles into colortag channel buckets in a single pass.
+	All tags are compiled into one regex shaped as a prefix trie, so each title is
+	scanned once and each position is tested against one character per trie level
+	no matter how many tags are set.
+	Overlapping tags are not sorted like the nested loop this replaced: only the longest tag
+	found at a position counts (e.g. with the tags "C1" and "C10", "img_C10.tif" is only sorted
+	under "C10", where the nested loop also sorted it under "C1" with the root "img_0.tif").
+	'''
+	def __init__(self, tags):
+		self.indexes = {}
+		for index, tagstuple in tags.items():
+			for colortag in tagstuple:
+				if colortag:
+					self.indexes.setdefault(colortag, []).append(index)
+		self.pattern = re.compile(trie_pattern(self.indexes.keys()))
+
+
+	def match(self, title):
+		'''
+		Returns the distinct colortags found in title.
+		'''
+		if not self.indexes:
+			return []
+		found = self.pattern.findall(title)
+		if len(found) > 1:
+			found = [colortag for i, colortag in enumerate(found) if colortag not in found[:i]]
+		return found
+
+
+	def sort(self, titleslist):
+		'''
+		Sorts titles by the root of the title (title without the colortag) and colortag index.
+		Returns a dict {root: [title or None]*7} and a dict {title: [colortags]} of the titles
+		matching more than one colortag. Ambiguous titles are sorted under every tag they match.
+		'''
+		sortedimgs = {}
+		ambiguous = {}
+		match = self.match
+		indexes = self.indexes
+		for img in titleslist:
+			found = match(img)
+			if not found:
+				continue
+			if len(found) > 1 or len(indexes[found[0]]) > 1:
+				ambiguous[img] = found
+			for colortag in found:
+				imgtitleroot = img.replace(colortag, "")
+				impsbucket = sortedimgs.get(imgtitleroot)
+				if impsbucket is None:
+					impsbucket = sortedimgs[imgtitleroot] = [None]*7
+				for index in indexes[colortag]:
+					impsbucket[index] = img
+		return sortedimgs, ambiguous
+
+
+def trie_pattern(words):
+	'''
+	Returns a regex pattern matching any of words, factored as a prefix trie.
+	e.g. ("C1", "C2", "C10") -> "C(?:1(?:0)?|2)"
+	'''
+	trie = {}
+	for word in words:
+		node = trie
+		for char in word:
+			node = node.setdefault(char, {})
+		node[""] = True
+
+	def depth(node):
+		return max([0] + [1 + depth(child) for char, child in node.items() if char])
+
+	def build(node):
+		chars = sorted([char for char in node if char], key=lambda char: -depth(node[char]))
+		alternatives = [re.escape(char) + build(node[char]) for char in chars]
+		if not alternatives:
+			return ""
+		if len(alternatives) == 1 and "" not in node:
+			return alternatives[0]
+		pattern = "(?:{0})".format("|".join(alternatives))
+		if "" in node:
+			pattern += "?"
+		return pattern
+
+	return build(trie)
+
+
 if __name__ in ("__builtin__", "__main__"):
-	t = Colortags()
\ No newline at end of file
+	t = Colortags()
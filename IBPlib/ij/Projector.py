@@ -17,63 +17,188 @@ import traceback
 
 import os.path
 
-from threading import Thread
+from threading import (Thread, Lock)
 
 from Queue import Queue
 
-import ij.io.FileSaver
 from ij import (IJ, CompositeImage, ImagePlus)
-from ij.plugin import ZProjector
-from IBPlib.ij.Utils.Files import (buildList, imageloader)
+from IBPlib.ij.Utils.Files import (scan, check_folder, imageloader, ensure_folder)
+from IBPlib.ij.Utils.Scheduler import (AdmissionScheduler, estimate_projection_footprint)
+from IBPlib.ij.Utils.Projections import (stream_projections, project_stack, validate_methods)
+from IBPlib.ij.Utils.Backends import (project, get_backend)
+from IBPlib.ij.Utils import Output
+from IBPlib.ij.Utils.Manifest import Manifest
+from IBPlib.ij.Utils.Sharding import (RunReport, shard_of, validate_shard)
 
-try:
-	from net.haesleinhuepf.clij2 import CLIJ2
-	clij2 = CLIJ2.getInstance()
-except ImportError:
-	IJ.error("Warning: CLIJ not installed, GPU processing unavailable.")
-
-__version__ = "1.1"
+__version__ = "1.2"
 __threadname__ = "IBPlib.ij.Zprojector" # Threads spawned by Zprojector have this name + name of the final image.
 
 class Projector:
 	'''
 	If you want to use Zprojector in opened images explicitly pass False or None to the 4 parameters.
     Note that by default it will generate maximum intensity projections when run as a hotkey macro.
+	Images are projected in parallel while the scheduler admits them under its memory budget.
+	shard=(index, count) restricts the run to one deterministic share of the images, so count
+	processes can work on the same folder. Merge the shard manifests and run reports with
+	IBPlib.ij.Utils.Sharding.merge_shards.
+	method can be a single ZProjector method name or a list of them. With a list, every projection
+	is computed from a single read and traversal of each image and saved with the method as suffix
+	(e.g. img_max.tif, img_sd.tif).
+	With streaming=True images are read one plane at a time and folded into the projections
+	(all methods but median), so memory is bounded by the projection size instead of the stack size.
+	When there are fewer images than workers, each image is split into row bands projected on
+	band_threads threads (see IBPlib.ij.Utils.Projections.band_projection). By default the spare
+	workers are shared between the images left once the folder has been scanned.
+	backend selects the projection backend of IBPlib.ij.Utils.Backends ("cpu", "zprojector", "clij2"
+	or any registered one). "auto" uses the fastest one found by the micro-benchmark when autobenchmark
+	is set, otherwise the multithreaded CPU backend when band_threads > 1 and ZProjector if not.
+	An unavailable or failing backend falls back to the next.
+	writer is an optional IBPlib.ij.Utils.ThreadedFileSaver.WriterPool the projections are handed to,
+	so workers do not wait for disk writes. It is flushed at the end of run.
+	output is an optional IBPlib.ij.Utils.Output.OutputWriter (compression, tiles, BigTIFF and 32-bit
+	policy) used for the saves made by the workers. With a WriterPool, its output is used instead.
 	'''
 
-	def __init__(self, savefolder, imgfolder, ext, method="max", debug=False):
+	def __init__(self, savefolder, imgfolder, ext, method="max", debug=False, scheduler=None, shard=(0, 1),
+		streaming=False, band_threads=None, backend="auto", autobenchmark=False, writer=None,
+		output=None):
+		validate_shard(shard)
 		self.debug=debug
+		self.streaming = streaming
+		self.BAND_THREADS = band_threads
+		self.band_threads = band_threads or 1
+		self.backend = backend
+		self.autobenchmark = autobenchmark
+		self.writer = writer
+		self.output = output
+		self.shard = tuple(shard)
 		self.savefolder = savefolder
 		self.imgfolder = imgfolder
 		self.ext = ext
 		self.method = method
-		self.MAXWORKERS = 3
+		if isinstance(method, basestring):
+			self.methods = [method]
+		else:
+			self.methods = list(method)
+		validate_methods(self.methods, streaming=streaming)
+		self.scheduler = scheduler or AdmissionScheduler()
 		self.tasks_q = Queue()
 		self.workers = []
+		self.manifest = None
+		self.report = RunReport("Projector", self.shard)
+		self.run_params = {}
+		self.scanning = False
 
 
-	def run(self, onGPU=False, exclusionFlag="488",):
+	def run(self, onGPU=False, exclusionFlag="488", incremental=True, backend=None, recursive=False, images=None):
 		'''
 		Main pipeline to generate the projections images in parallel
+		Images are queued while imgfolder is scanned, so projecting starts before the scan finishes.
+		With recursive, subfolders are scanned too and their layout is mirrored in savefolder.
+		images is an iterable of paths under imgfolder to project instead of scanning it,
+		e.g. the result of an IBPlib.ij.Utils.Index.ImageIndex query.
+		If incremental, images whose projection is recorded in the savefolder manifest with the same
+		input and parameters are skipped.
+		backend overrides self.backend for this run. onGPU=True is kept as a shortcut for backend="clij2".
 		'''
+		if onGPU:
+			backend = "clij2"
+		backend = backend or self.backend
 		IJ.log("\n### Z-projector v{0} has started".format(__version__))
-		img_list = buildList(self.imgfolder, extension=self.ext, debug=self.debug, exclusionFlag=exclusionFlag)
-		IJ.log("There are {0} images to be processed.\n".format(len(img_list)))
-		titleslist = [os.path.split(img)[1] for img in img_list]
+		self.report = RunReport("Projector", self.shard)
+		if self.savefolder and not self.debug:
+			self.setup_manifest(backend)
+		exclude = None
+		if exclusionFlag:
+			exclude = "*{0}*".format(exclusionFlag)
 
-		for img in titleslist:
-			self.tasks_q.put((img, onGPU))
+		if images is None:
+			check_folder(self.imgfolder) # Fails before any worker is started.
+			images = scan(self.imgfolder, extensions=self.ext, exclude=exclude, recursive=recursive)
+		self.scanning = True
 		self.setup_workers()
-		self.tasks_q.join()
+		queued, uptodate = 0, 0
+		try:
+			for imgpath in images:
+				title = os.path.relpath(imgpath, self.imgfolder)
+				if self.shard[1] > 1 and shard_of(title, self.shard[1]) != self.shard[0]:
+					continue
+				if incremental and self.is_up_to_date(title):
+					self.report.skipped(title)
+					uptodate += 1
+					continue
+				self.tasks_q.put((title, backend))
+				queued += 1
+			if self.shard[1] > 1:
+				IJ.log("Shard {0} of {1}.".format(self.shard[0], self.shard[1]))
+			IJ.log("There are {0} images to be processed, {1} images are up to date and were skipped.\n"
+				.format(queued, uptodate))
+		finally:
+			self.scanning = False
+			self.shutdown_workers() # Also stops the workers when queueing failed.
+		if self.writer:
+			self.writer.flush()
+			self.writer.log_stats()
+		if self.manifest:
+			self.manifest.save()
+			self.report.save(self.savefolder, {"scheduler": self.scheduler.report()})
+		self.scheduler.log_report()
 		IJ.log("### Done projecting.")
 
 
+	def setup_manifest(self, backend):
+		'''
+		Loads the savefolder manifest and sets the parameters of the run.
+		'''
+		self.manifest = Manifest(self.savefolder, shard=self.shard)
+		self.run_params = {"backend": backend}
+		output = getattr(self.writer, "output", None) if self.writer else self.output
+		if output:
+			self.run_params["output"] = output.settings() # A settings change rewrites the projections.
+
+
+	def is_up_to_date(self, title):
+		'''
+		Returns True if all projections of the image title are recorded in the manifest
+		with the same input and parameters.
+		'''
+		if not self.manifest:
+			return False
+		inputs = [os.path.join(self.imgfolder, title)]
+		return all([self.manifest.is_up_to_date(output, inputs, self.output_params(method))
+			for method, output in self.outputs(title)])
+
+
+	def outputs(self, title):
+		'''
+		Returns a list of (method, output title) for the projections of the image title.
+		A single method keeps the image title, several methods get the method as suffix.
+		'''
+		if isinstance(self.method, basestring):
+			return [(self.method, title)]
+		root = os.path.splitext(title)[0]
+		return [(method, "{0}_{1}.tif".format(root, method)) for method in self.methods]
+
+
+	def output_params(self, method):
+		'''
+		Returns the manifest parameters of the projection made with method.
+		'''
+		params = dict(self.run_params)
+		params.update({"method": method})
+		return params
+
+
 	def dummy_task(self):
-		import time.sleep
-		while not self.tasks_q.empty():
-			img, onGPU = self.tasks_q.get()
+		from time import sleep
+		while True:
+			task = self.tasks_q.get()
+			if task is None:
+				self.tasks_q.task_done()
+				break
+			img, backend = task
 			IJ.log("Working on {0}".format(img))
-			time.sleep(5)
+			sleep(5)
 			IJ.log("Done working on {0}".format(img))
 			self.tasks_q.task_done()
 
@@ -82,56 +207,184 @@ class Projector:
 		if self.debug:
 			task = self.dummy_task
 		 
-		for i in range(self.MAXWORKERS):
+		for i in range(self.scheduler.max_workers):
 			t = Thread(target=task, name="{0}.{1}".format(__threadname__, i))
 			self.workers.append(t)
 			t.start()
 
+
+	def shutdown_workers(self):
+		'''
+		Waits for the queued images and stops the workers with one sentinel each.
+		'''
+		self.tasks_q.join()
+		for t in self.workers:
+			self.tasks_q.put(None)
+		for t in self.workers:
+			t.join()
+		self.workers = []
+
+
+	def task_threads(self):
+		'''
+		Returns the number of band threads for the next image.
+		While imgfolder is being scanned each image gets one thread, as more images may follow.
+		Afterwards the workers are shared between the images left.
+		'''
+		if self.BAND_THREADS:
+			return self.BAND_THREADS
+		if self.scanning:
+			return 1
+		return max(1, self.scheduler.max_workers // max(1, self.tasks_q.unfinished_tasks))
+
 			
 	def projectorthread_task(self):
 		'''
 		Wrapper method to encapsulate doprojection in a Thread inside a Queue object
 		'''
-		while not self.tasks_q.empty():
-			img, onGPU = self.tasks_q.get()
+		while True:
+			task = self.tasks_q.get()
+			if task is None:
+				self.tasks_q.task_done()
+				break
+			img, backend = task
+			threads = self.task_threads()
+			cost = None
 			try:
-				self.doprojection(img, onGPU=onGPU)
-			except (Exception, java.lang.Exception):
+				cost = self.scheduler.admit(self.estimate_cost(img, backend, threads))
+				self.doprojection(img, backend=backend, threads=threads)
+			except (Exception, java.lang.Exception) as e:
+				self.report.failed(img, e)
 				IJ.log(traceback.format_exc())
 			finally:
+				if cost is not None:
+					self.scheduler.release(cost)
 				self.tasks_q.task_done()
 
 
-	def doprojection(self, titleOrImp, onGPU=False):
+	def estimate_cost(self, title, backend=None, threads=None):
 		'''
-		Run ij.plugin.Zprojector on image referenced by title or imp using self.method as
-		projection method and saves the projection on self.savefolder.
+		Returns the estimated memory to project the image referenced by title.
 		'''
+		threads = threads or self.band_threads
+		imgpath = os.path.join(self.imgfolder, title)
+		onGPU = backend == "clij2"
+		if self.streaming and not onGPU:
+			return estimate_projection_footprint(imgpath)
+		if len(self.methods) > 1 and not onGPU:
+			return self.scheduler.footprint([imgpath], overhead=1.0 + 0.5 * len(self.methods))
+		if threads > 1 and not onGPU:
+			return self.scheduler.footprint([imgpath], overhead=1.5)
+		return self.scheduler.footprint([imgpath])
+
+
+	def doprojection(self, titleOrImp, onGPU=False, backend=None, threads=None):
+		'''
+		Projects the image referenced by title or imp with self.method on the selected backend
+		and saves the projection on self.savefolder.
+		With several methods all projections come from one read of the image.
+		'''
+		if onGPU:
+			backend = "clij2"
+		backend = backend or self.backend
+		onGPU = backend == "clij2"
 		if isinstance(titleOrImp, ImagePlus):
 			imp = titleOrImp
 			title = titleOrImp.getTitle()
+		elif self.streaming and not onGPU:
+			imp = None
+			title = titleOrImp
 		else:
 			imp = self.load_image(titleOrImp)
 			title = titleOrImp
 			
 		IJ.log("# Projecting {0}...".format(title))
-		if onGPU:
-			projection = self.CLIJ2_max_projection(imp)
+		if imp is None:
+			projections = stream_projections(os.path.join(self.imgfolder, title), self.methods)
 		else:
-			projection = ZProjector.run(imp, self.method)
-		if self.savefolder:
-			save_string = os.path.join(self.savefolder, title)
+			projections = self.zprojections(imp, backend, threads)
+		if not self.savefolder:
+			if imp:
+				imp.close()
+			[projection.show() for projection in projections.values()]
+			return
+		if self.writer:
+			self.submit(title, projections, record=not isinstance(titleOrImp, ImagePlus))
+			return
+		saved = True
+		for method, output in self.outputs(title):
+			save_string = os.path.join(self.savefolder, output)
 			try:
-				ij.io.FileSaver(projection).saveAsTiff(save_string)
+				ensure_folder(os.path.dirname(save_string))
+				if not Output.save(projections[method], save_string, self.output):
+					IJ.log("# '{0}' could not be saved.".format(save_string))
+					saved = False
+					continue
 				IJ.log("{0}".format(save_string))
+				if self.manifest and not isinstance(titleOrImp, ImagePlus):
+					self.manifest.record(output, [os.path.join(self.imgfolder, title)], self.output_params(method))
 			except:
+				saved = False
 				IJ.log("ij.io.FileSaver raised an exception while trying to save img '{0}' as '{1}'.Skipping image."
 						.format(title, save_string))
+		if saved:
+			self.report.processed(title)
 		else:
-			imp.close()
-			projection.show()
+			self.report.failed(title, "could not be saved")
+
+
+	def submit(self, title, projections, record=True):
+		'''
+		Hands the projections of the image title to self.writer.
+		The image is reported as processed once all its projections are saved,
+		and each saved projection is recorded in the manifest if record.
+		'''
+		outputs = self.outputs(title)
+		state = {"left": len(outputs), "error": None}
+		lock = Lock()
+		for method, output in outputs:
+			save_string = os.path.join(self.savefolder, output)
+			ensure_folder(os.path.dirname(save_string))
+
+			def done(future, method=method, output=output, save_string=save_string):
+				if future.ok:
+					IJ.log("{0}".format(save_string))
+					if record and self.manifest:
+						self.manifest.record(output, [os.path.join(self.imgfolder, title)], self.output_params(method))
+				with lock:
+					if not future.ok:
+						state["error"] = future.error
+					state["left"] -= 1
+					last = state["left"] == 0
+				if not last:
+					return
+				if state["error"] is None:
+					self.report.processed(title)
+				else:
+					self.report.failed(title, state["error"])
+
+			self.writer.submit(projections[method], save_string, callback=done)
 
 	
+	def zprojections(self, imp, backend=None, threads=None):
+		'''
+		Returns a dict {method: projection} of imp.
+		A single method runs on the selected backend with threads (default self.band_threads) threads.
+		With "auto" and without autobenchmark, a single thread uses ZProjector directly.
+		Several methods are computed from a single traversal of the planes, unless a backend is named,
+		in which case each method runs on it.
+		'''
+		backend = backend or self.backend
+		threads = threads or self.band_threads
+		auto = backend == "auto"
+		if len(self.methods) > 1 and auto:
+			return project_stack(imp, self.methods)
+		if auto and not self.autobenchmark:
+			backend = "cpu" if threads > 1 else "zprojector"
+		return dict([(method, project(imp, method, backend=backend, threads=threads,
+			autobenchmark=self.autobenchmark)) for method in self.methods])
+
+
 	def load_image(self, title):
 		'''
 		Loads an image according to its title.
@@ -148,16 +401,9 @@ class Projector:
 		Performs a z-projection on the GPU using CLIJ.
 		Returns an imagePLus with the maximum projection of the image.
 		'''
-		
-		imageInput = clij2.push(imp)
-		imageOutput = clij2.create([imageInput.getWidth(), imageInput.getHeight()], imageInput.getNativeType())
-		clij2.op().maximumZProjection(imageInput, imageOutput)
-		projection = clij2.pull(imageOutput)
-		imageInput.close()
-		imageOutput.close()
-		return projection
+		return get_backend("clij2").project(imp, "max")
+
 
-	
 if __name__ in ("__builtin__", "__main__"):
 	
 	test_img_folder = r"I:\LET805IBP-Q1894\Yokogawa\Staging area\111021\ColorMerged"
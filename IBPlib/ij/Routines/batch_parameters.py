@@ -1,6 +1,8 @@
 import os
 import json
-from datetime import date
+from datetime import (date, datetime)
+
+from IBPlib.ij.Utils.Manifest import write_json
 
 # Refactor to use serial batchfile names instead.
 __BATCH_FILENAME = "IBPlib_batch.json"
@@ -50,9 +52,9 @@ class Batch_Parameters:
 		'''
 		filename = "{0}.json".format(self.name)
 		filepath = os.path.join(output_folder, filename)
-		with open(filepath, "w") as jsonfile:
-			params = {k:v[1] for k,v in self.__parameters__.items()}
-			json.dump(params, jsonfile, indent=1)
+		params = {k:v[1] for k,v in self.__parameters__.items()}
+		# Atomically replaced once fully written, so a crash never leaves a missing or truncated parameters file.
+		write_json(params, filepath, indent=1)
 		return True
 
 
@@ -87,6 +89,104 @@ class Batch_Parameters:
 		return stored_params	
 
 
+class BatchJournal:
+	'''
+	Append-only journal of the images completed by a batch run, saved next to the batch json
+	as <batch name>.journal.jsonl with one small json record per line.
+	Recording an image appends a line instead of rewriting the whole parameters file, and with
+	durable the line is fsynced, so a crash loses at most the image in progress.
+	replay rebuilds the analysed and remaining images from the journal on startup and compact
+	folds the journal into the batch json (every compact_every records, or when called).
+	e.g.
+		journal = BatchJournal(bp, output_folder)
+		remaining = journal.replay()
+		for img in remaining:
+			...
+			journal.record(img)
+		journal.compact()
+	'''
+	def __init__(self, batch_parameters, output_folder, durable=True, compact_every=25):
+		self.batch_parameters = batch_parameters
+		self.output_folder = output_folder
+		self.path = os.path.join(output_folder, "{0}.journal.jsonl".format(batch_parameters.name))
+		self.durable = durable
+		self.compact_every = compact_every
+		self.analysed = list(batch_parameters.get("analysed_images") or [])
+		self.done = set(self.analysed)
+		self.uncompacted = 0
+		self.journal = None
+
+
+	def replay(self):
+		'''
+		Adds the images recorded in the journal to the analysed images and returns the raw images
+		left to analyse, in order. A line truncated by a crash is ignored.
+		'''
+		if os.path.exists(self.path):
+			with open(self.path, "r") as journal:
+				for line in journal:
+					try:
+						entry = json.loads(line)
+					except ValueError:
+						continue
+					if entry.get("image") not in self.done:
+						self.done.add(entry["image"])
+						self.analysed.append(entry["image"])
+						self.uncompacted += 1
+		return self.remaining()
+
+
+	def remaining(self):
+		return [img for img in self.batch_parameters.get("raw_images") or [] if img not in self.done]
+
+
+	def record(self, img, **fields):
+		'''
+		Appends the completion of img (and any extra json fields) to the journal.
+		'''
+		entry = {"image": img, "time": datetime.now().isoformat()}
+		entry.update(fields)
+		if self.journal is None:
+			self.journal = open(self.path, "a")
+			if self.journal.tell() > 0 and not ends_with_newline(self.path):
+				self.journal.write("\n") # Closes a line truncated by a crash.
+		self.journal.write("{0}\n".format(json.dumps(entry)))
+		self.journal.flush()
+		if self.durable:
+			os.fsync(self.journal.fileno())
+		if img not in self.done:
+			self.done.add(img)
+			self.analysed.append(img)
+		self.uncompacted += 1
+		if self.compact_every and self.uncompacted >= self.compact_every:
+			self.compact()
+
+
+	def compact(self):
+		'''
+		Saves the analysed and remaining images to the batch json and empties the journal.
+		The journal is only emptied after the json is written, and replaying it again is harmless.
+		'''
+		self.batch_parameters.set("analysed_images", list(self.analysed))
+		self.batch_parameters.set("raw_images", self.remaining())
+		self.batch_parameters.to_json_file(self.output_folder)
+		self.close()
+		open(self.path, "w").close()
+		self.uncompacted = 0
+
+
+	def close(self):
+		if self.journal is not None:
+			self.journal.close()
+			self.journal = None
+
+
+def ends_with_newline(path):
+	with open(path, "rb") as f:
+		f.seek(-1, os.SEEK_END)
+		return f.read(1) == b"\n"
+
+
 def get_schema():
 	'''
 	WIP
@@ -9,21 +9,30 @@ path.append(jython_scripts)
 #=========================================#
 
 import os
+import time
 import threading
+import traceback
 import csv
 import datetime
+import java.lang.Exception
+
+from Queue import Queue
 
 from sc.fiji.snt import SNTService, Tree
 from sc.fiji.snt.analysis import RoiConverter
 
 from ij import IJ
-from ij.io import RoiEncoder
-from ij.gui import (WaitForUserDialog, Overlay, ProfilePlot)
+from ij.gui import (WaitForUserDialog, Overlay)
 from ij.plugin.frame import RoiManager
 
 from IBPlib.ij.Routines import batch_parameters
+from IBPlib.ij.Routines.batch_parameters import BatchJournal
 from IBPlib.ij.Utils.Files import imageloader
 from IBPlib.ij.Utils.Misc import validate_th_method
+from IBPlib.ij.Utils.Profiles import (profile, profiles, ProfileWriter, ProfileBuffer, BINARY_EXTENSION)
+from IBPlib.ij.Utils.Rois import RoiStore
+from IBPlib.ij.Utils.Masks import (MaskCache, TubenessCache, extract_channel, threshold)
+from IBPlib.ij.Utils.Prefetch import Prefetcher
 
 __VERSION__ = "1.11"
 __NOW__ = datetime.date.today()
@@ -45,13 +54,17 @@ def get_batch_schema():
 	return __PARAMS_SCHEMA
 
 	
-def assisted_SNTtrace(context, imp):
+def assisted_SNTtrace(context, imp, session=None, path=None):
 	'''
 	Calls SNT in a given img for user assisted tracing.
 	Uses WaitForUserDialog to confirm the end of tracing operations.
+	With session (an SNTSession) the running SNT instance is reused, path being the file of imp.
 	Returns list of SNT Paths.
 	'''
-	snt = prepare_SNT(context, imp)
+	if session is None:
+		snt = prepare_SNT(context, imp)
+	else:
+		snt = session.load(imp, path)
 	pafm = snt.getPathAndFillManager()
 	dialog = WaitForUserDialog("Go to next step...", "Press ok when tracing is done.")
 	dialog.show()
@@ -91,6 +104,82 @@ def prepare_SNT(context, imp):
 	return plugin
 
 
+class SNTSession:
+	'''
+	Long lived SNT instance for a batch: the first image initialises SNT with prepare_SNT and
+	the next ones are swapped in with plugin.initialize, without restarting the service and UI.
+	With hessian, the tubeness of tracing_ch (see IBPlib.ij.Utils.Masks.TubenessCache) is loaded
+	as the SNT secondary image and paths are traced on it, so Hessian guided tracing does not
+	compute it on the first click.
+	SNT is prepared again if its UI was closed between images.
+	precompute builds it ahead of time (e.g. from a Prefetcher) and costs_folder keeps it on disk
+	for later sessions.
+	'''
+	def __init__(self, context, tracing_ch=1, hessian=False, sigma=None, costs_folder=None, max_items=3):
+		self.context = context
+		self.tracing_ch = tracing_ch
+		self.sigma = sigma
+		self.plugin = None
+		self.costs = None
+		if hessian:
+			self.costs = TubenessCache(costs_folder, max_items=max_items)
+
+
+	def load(self, imp, path=None):
+		'''
+		Shows imp in SNT with an empty set of paths and returns the SNT plugin.
+		'''
+		ui = None
+		if self.plugin is not None:
+			ui = self.plugin.getUI()
+		if ui is None:
+			self.plugin = prepare_SNT(self.context, imp) # First image, or SNT was closed by the user.
+		else:
+			if not ui.isReady():
+				self.plugin.cancelPath()
+				self.plugin.cancelSearch(True)
+				ui.changeState(ui.READY)
+			self.plugin.initialize(imp)
+			self.plugin.getPathAndFillManager().clear()
+		if self.costs is not None:
+			self.load_cost_image(imp, path)
+		return self.plugin
+
+
+	def precompute(self, imp, path=None):
+		'''
+		Builds (or loads from disk) the tubeness image of imp. Safe to call from any thread.
+		'''
+		if self.costs is not None:
+			self.costs.get(imp, self.tracing_ch, self.sigma, path=path)
+
+
+	def load_cost_image(self, imp, path=None):
+		'''
+		Loads the tubeness of imp as the SNT secondary image and traces on it.
+		'''
+		cost = self.costs.get(imp, self.tracing_ch, self.sigma, path=path)
+		if hasattr(self.plugin, "loadSecondaryImage") and hasattr(self.plugin, "enableSecondaryImgTracing"):
+			self.plugin.loadSecondaryImage(cost)
+			self.plugin.enableSecondaryImgTracing(True)
+			if hasattr(self.plugin, "enableHessian"):
+				self.plugin.enableHessian(True)
+		elif hasattr(self.plugin, "enableHessian"):
+			IJ.log("# This SNT cannot trace on a secondary image, its Hessian is computed interactively.")
+			self.plugin.enableHessian(True)
+		else:
+			IJ.log("# This SNT supports neither secondary images nor Hessian tracing.")
+
+
+	def close(self):
+		'''
+		Forgets the SNT instance, which stays open as after prepare_SNT.
+		'''
+		if self.costs is not None:
+			self.costs.log_stats()
+		self.plugin = None
+
+
 def convert_SNTpaths_to_roi(SNTpaths):
 	'''
 	Converts a list of SNT_paths to an Array of imageJ1 rois.
@@ -107,17 +196,12 @@ def convert_SNTpaths_to_roi(SNTpaths):
 	return roi_list
 
 
-def get_profile(imp, roi, rm):
+def get_profile(imp, roi, rm=None):
 	'''
-	Iteratively get the profile of each roi in a list from give img.
-	returns ProfilePlots.
+	Returns the ProfilePlot profile of roi on imp.
+	rm is no longer used, see IBPlib.ij.Utils.Profiles.profile.
 	'''
-	i = rm.getCount()
-	rm.add(roi, i)
-	roi.setName("{0}_{1}".format(imp.getTitle(), i))
-	rm.select(imp, i)
-	pp = ProfilePlot(imp)
-	return pp.getProfile()
+	return profile(imp, roi)
 
 
 def setup_output_folders(output_folder):
@@ -149,14 +233,36 @@ def export_profile(profile_list, title, output, append=False):
 			writer.writerow([i, value])
 
 
-def get_analysis_ch(imp, analysis_ch):
+def profile_writer(csvs_output, consolidated, append=True):
+	'''
+	Returns a ProfileWriter for a consolidated export of a batch in csvs_output, or None to
+	export one csv per roi. consolidated is None, "csv" (long format) or "binary" (see
+	IBPlib.ij.Utils.Profiles.read_profiles to load either back).
+	'''
+	extensions = {"csv": ".csv", "binary": BINARY_EXTENSION}
+	if consolidated is None:
+		return None
+	if consolidated not in extensions:
+		raise ValueError("Unknown consolidated format {0}. Use None or one of {1}.".format(consolidated, sorted(extensions)))
+	return ProfileWriter(os.path.join(csvs_output, "profiles{0}".format(extensions[consolidated])), append=append)
+
+
+def setup_masks(output_folder, persist=True, max_items=4):
 	'''
-	Returns an ImagePlus of the channel index specified in analysis_ch
+	Returns a MaskCache saving the thresholded masks in a folder named masks inside the
+	output folder, or only keeping them in memory if persist is False.
 	'''
-	from ij.plugin import ChannelSplitter
+	if not persist:
+		return MaskCache(max_items=max_items)
+	return MaskCache(os.path.join(output_folder, "masks"), max_items=max_items)
 
-	analysis_imp = ChannelSplitter.split(imp)[analysis_ch-1]
-	return analysis_imp
+
+def get_analysis_ch(imp, analysis_ch):
+	'''
+	Returns an ImagePlus of the channel index specified in analysis_ch.
+	Only that channel is copied, see IBPlib.ij.Utils.Masks.extract_channel.
+	'''
+	return extract_channel(imp, analysis_ch)
 
 
 def apply_threshold(imp, th_method):
@@ -164,17 +270,17 @@ def apply_threshold(imp, th_method):
 	Sets the ImageProcessor of the supplied imp to a BinayProcessor
 	according to th_method.
 	'''
-	from ij.process import AutoThresholder as at
-
-	ip = imp.getProcessor()
-	ip.setAutoThreshold(at.Method.valueOf(th_method), True)
-	bp = imp.createThresholdMask()
-	imp.setProcessor(bp)
+	threshold(imp, th_method)
 
 
-def run(context, imp, output_folder, analysis_ch, th_method, stroke_width, tracing_ch, dispose_snt=True):
+def run(context, imp, output_folder, analysis_ch, th_method, stroke_width, tracing_ch, dispose_snt=True, writer=None,
+	store=None, masks=None, path=None, session=None):
 	'''
 	**dispose_snt kwarg is not implemented.
+	SNT is reused from session (an SNTSession) if given.
+	Profiles go to writer (a ProfileWriter) if given, otherwise to one csv per roi.
+	Rois are appended to the bundle of the image in store (a RoiStore of the rois folder by default).
+	The thresholded mask comes from masks (a MaskCache) if given, path being the file of imp.
 
 	Runs the main analysis pipeline.
 	Consists in:
@@ -199,29 +305,29 @@ def run(context, imp, output_folder, analysis_ch, th_method, stroke_width, traci
 	imp.changes = False
 	#imp.setC(tracing_ch)
 	try:
-		SNTpaths = assisted_SNTtrace(context, imp)
+		SNTpaths = assisted_SNTtrace(context, imp, session=session, path=path)
 	except RuntimeError:
 		SNTService().getPlugin().closeAndResetAllPanes()
+		if session is not None:
+			session.plugin = None
 		imp.close()
 		return False
 		
 	if not SNTpaths:
 		IJ.error("No paths found, reloading image.\nDid you forget to finish the trace?")
-		return run(context, imp, output_folder, analysis_ch, th_method, stroke_width, tracing_ch, dispose_snt=dispose_snt)
+		return run(context, imp, output_folder, analysis_ch, th_method, stroke_width, tracing_ch, dispose_snt=dispose_snt, writer=writer,
+			store=store, masks=masks, path=path, session=session)
 		
 	imp.hide()
-	analysis_imp = get_analysis_ch(imp, analysis_ch)
-	apply_threshold(analysis_imp, th_method)
-	rm = get_clean_RoiManager()
 	rois = convert_SNTpaths_to_roi(SNTpaths)
-	profile_from_threshold(imp, analysis_ch, rois, stroke_width, th_method, csvs_output)
-	for roi in rois:
-		try:
-			RoiEncoder.save(roi, os.path.join(rois_output, "{0}.roi".format(roi.getName())))
-		except:
-			IJ.error("Could not save {0}".format(roi.getName()))
-	analysis_imp.changes = False
-	analysis_imp.close()
+	profile_from_threshold(imp, analysis_ch, rois, stroke_width, th_method, csvs_output, writer=writer,
+		masks=masks, path=path)
+	if store is None:
+		store = RoiStore(rois_output)
+	try:
+		store.append(imp.getTitle(), rois)
+	except:
+		IJ.error("Could not save the rois of {0}".format(imp.getTitle()))
 	imp.close()
 	return True
 
@@ -237,99 +343,222 @@ def get_clean_RoiManager(show=False):
 	return rm
 
 
-def batch_run(context, batch_parameters):
+def batch_run(context, batch_parameters, consolidated=None, persist_masks=True, lookahead=1, prefetch_budget=None,
+	durable=True, compact_every=25, hessian=False, sigma=None):
 	'''
 	Runs the analysis pipeline for each img inside the raw_images key
 	then updates the parameter dictionary and saves it.
+	consolidated appends the profiles of every image to a single file, see profile_writer. The file is
+	continued when the batch already has analysed images and started anew otherwise.
+	Thresholded masks are saved for re-profiling runs unless persist_masks is False, see setup_masks.
+	While an image is traced the next lookahead images are opened and masked in the background,
+	holding at most prefetch_budget bytes (see IBPlib.ij.Utils.Prefetch.Prefetcher). 0 disables it.
+	Each completed image is appended to the batch journal (fsynced if durable) and the journal is
+	folded into the batch json every compact_every images, see batch_parameters.BatchJournal.
+	Images recorded by an interrupted run are skipped.
+	SNT is kept open between images (see SNTSession). With hessian the tubeness of the tracing
+	channel, at sigma, is precomputed with the prefetched images and saved in the tubeness folder.
 	'''
 	IJ.log("Running pipeline...")
-	images = batch_parameters.get("raw_images")
-	total_images = len(images)
-	if not batch_parameters.get("analysed_images"):
-		analysed_images = []
-	else:
-		analysed_images = batch_parameters.get("analysed_images")
-	i=1
-	while len(images) >0:
-		progress = "{0}/{1}".format(i, total_images)
+	output_folder = batch_parameters.get("output_folder")
+	rois_output, csvs_output = setup_output_folders(output_folder)
+	journal = BatchJournal(batch_parameters, output_folder, durable=durable,
+		compact_every=compact_every)
+	images = journal.replay()
+	writer = profile_writer(csvs_output, consolidated, append=bool(journal.analysed))
+	masks = setup_masks(output_folder, persist_masks, max_items=lookahead + 2)
+	analysis_ch, th_method = batch_parameters.get("analysis_ch"), batch_parameters.get("th_method")
+	session = SNTSession(context, batch_parameters.get("tracing_ch"), hessian=hessian, sigma=sigma,
+		costs_folder=os.path.join(output_folder, "tubeness") if persist_masks else None, max_items=lookahead + 2)
+
+	def prepare(path, imp):
+		masks.get(imp, analysis_ch, th_method, path=path)
+		session.precompute(imp, path)
+
+	prefetcher = Prefetcher(images, depth=lookahead, budget=prefetch_budget, prepare=prepare)
+	try:
+		batch_run_images(context, batch_parameters, images, journal, writer, RoiStore(rois_output), masks, prefetcher,
+			session)
+	finally:
+		prefetcher.close()
+		prefetcher.log_stats()
+		session.close()
+		if writer is not None:
+			writer.close()
+		journal.compact()
+		journal.close()
+
+
+def batch_run_images(context, batch_parameters, images, journal, writer=None, store=None, masks=None, prefetcher=None,
+	session=None):
+	'''
+	Runs the pipeline on images, recording each completed image in journal.
+	'''
+	done = len(journal.analysed)
+	total_images = done + len(images)
+	for i, img in enumerate(images):
+		progress = "{0}/{1}".format(done + i + 1, total_images)
 		IJ.log("Progress: {0}".format(progress))
-		imp = imageloader(images[0])
+		if prefetcher is None:
+			imp = imageloader(img)
+		else:
+			imp = prefetcher.get(img)
 		if not run(context, imp, batch_parameters.get("output_folder"),
 			batch_parameters.get("analysis_ch"), batch_parameters.get("th_method"),
-			batch_parameters.get("stroke_width"), batch_parameters.get("tracing_ch")):
+			batch_parameters.get("stroke_width"), batch_parameters.get("tracing_ch"), writer=writer, store=store,
+			masks=masks, path=img, session=session):
 			IJ.log("Batch run canceled.")
-			batch_parameters.to_json_file(batch_parameters.get("output_folder"))
 			return
-		i += 1
-		analysed_images.append(images[0])
-		batch_parameters.set("analysed_images", analysed_images)
-		images.pop(0)
-		batch_parameters.set("raw_images", images)
-	batch_parameters.to_json_file(batch_parameters.get("output_folder"))
+		if writer is not None:
+			writer.flush()
+		journal.record(img)
 	IJ.log("Done ...")
 	IJ.log("Results stored in '{0}'".format(batch_parameters.get("output_folder")))
 
 
-def profile_from_threshold(imp, analysis_ch, rois, stroke_width, th_method, csvs_output):
+def profile_from_threshold(imp, analysis_ch, rois, stroke_width, th_method, csvs_output, writer=None,
+	masks=None, path=None, threads=None):
 	'''
 	Thresholds the desired channel using the threshold method specified and saves the
-	roi profile in the csv_output.
+	roi profile in the csv_output, or adds it to writer (a ProfileWriter) if given.
 	Rois will be set to the width in pixels specified by stroke_width.
+	Rois are named after the image and their index and profiled in parallel without the RoiManager,
+	on threads threads (the core count by default).
+	With masks (a MaskCache) the thresholded channel is reused from it (path is the file of imp).
 	'''
 	n_ch = imp.getNChannels()
 	if n_ch < analysis_ch:
 		raise ValueError("Analysis ch cannot be bigger than total number of channels.")
-	analysis_imp = get_analysis_ch(imp, analysis_ch)
-	apply_threshold(analysis_imp, th_method)
-	rm = get_clean_RoiManager()
-	for roi in rois:
+	if masks is None:
+		analysis_imp = get_analysis_ch(imp, analysis_ch)
+		apply_threshold(analysis_imp, th_method)
+	else:
+		analysis_imp = masks.get(imp, analysis_ch, th_method, path=path)
+	for i, roi in enumerate(rois):
 		roi.setStrokeWidth(stroke_width)
+		roi.setName("{0}_{1}".format(analysis_imp.getTitle(), i))
 		IJ.log("\n#Roi properties:\n##Name:{0}\n##Width:{1}\n##Length:{2}".format(roi.getName(), roi.getStrokeWidth(), roi.getLength()))
-		profile = get_profile(analysis_imp, roi, rm)
-		export_profile(profile, roi.getName(), csvs_output)
-	analysis_imp.changes = False
-	analysis_imp.close()
+	for roi, roi_profile in zip(rois, profiles(analysis_imp, rois, threads=threads)):
+		if roi_profile is None:
+			continue
+		if writer is None:
+			export_profile(roi_profile, roi.getName(), csvs_output)
+		else:
+			writer.add(imp.getTitle(), roi.getName(), stroke_width, th_method, roi_profile)
+	if masks is None:
+		analysis_imp.changes = False
+		analysis_imp.close()
 	return True
 
 
-def batch_profile_from_threshold(batch_parameters):
+def batch_profile_from_threshold(batch_parameters, consolidated=None, persist_masks=True, threads=1):
 	'''
 	Thresholds the desired channel using the threshold method specified and saves the
 	roi profile in the csv_output.
 	Rois will be set to the width in pixels specified by stroke_width.
 	Provide a batch parameters dict to operate on images.
-
-	WIP:
-	PUT A BETTER ALGO IN PLACE TO DETERMINE THE CORRECT ROI TO USE.
+	consolidated writes all the profiles to a single new file instead, see profile_writer.
+	Rois are looked up by exact image title in the RoiStore of the rois folder.
+	Masks saved by previous runs with the same analysis_ch and th_method are reused, see setup_masks.
+	With threads > 1 images are profiled in parallel, see profile_images.
+	Returns the list of images that failed.
 	'''
-	from ij.io import Opener
-	from IBPlib.ij.Utils.Files import buildList
-
-	opener = Opener()
 	rois_folder, csvs_folder = setup_output_folders(batch_parameters.get("output_folder"))
 	IJ.log("Plotting profiles...")
-
-	for i, img in enumerate(batch_parameters.get("analysed_images")):
-		progress = "{0}/{1}".format(i+1, len(batch_parameters.get("analysed_images")))
-		IJ.log("\n# Progress: {0}\n".format(progress))
-
-		imp = imageloader(img)
-		#title = os.path.basename(os.path.splitext(img)[0])
-		title = os.path.basename(img)
-		IJ.log("\nMeasuring -> {0}".format(title))
-		rois_path_list = buildList(rois_folder, extension=".roi")
-		rois = [opener.openRoi(roi) for roi in rois_path_list if roi.find(title) > 0]
-		if not rois:
-			IJ.log("## No rois found for {0}".format(title))
-
-		if not profile_from_threshold(imp, batch_parameters.get("analysis_ch"),
-			rois, batch_parameters.get("stroke_width"),
-			batch_parameters.get("th_method"), csvs_folder):
-			IJ.log("Batch run canceled.")
-			return
-
+	writer = profile_writer(csvs_folder, consolidated, append=False)
+	masks = setup_masks(batch_parameters.get("output_folder"), persist_masks, max_items=max(4, 2 * threads))
+	try:
+		failed = profile_images(batch_parameters, rois_folder, csvs_folder, writer, masks, threads)
+	finally:
+		if writer is not None:
+			writer.close()
+
+	masks.log_stats()
+	if failed:
+		IJ.log("# Could not profile {0} images:\n{1}".format(len(failed), "\n".join(failed)))
 	IJ.log("Done ...")
 	IJ.log("{0}".format(csvs_folder))
+	return failed
+
+
+def profile_images(batch_parameters, rois_folder, csvs_folder, writer=None, masks=None, threads=1):
+	'''
+	Profiles each of the analysed images of batch_parameters with its saved rois on a pool of
+	threads workers. Images are headless and independent: a failing image is logged and the
+	others carry on. Profiles are written under the same names whatever threads is, and the
+	consolidated writer receives them in image order.
+	The analysed images include the ones recorded in the batch journal by a run that has not
+	compacted it yet, see batch_parameters.BatchJournal.
+	Returns the list of images that failed.
+	'''
+	journal = BatchJournal(batch_parameters, batch_parameters.get("output_folder"))
+	journal.replay()
+	images = journal.analysed
+	store = RoiStore(rois_folder)
+	tasks_q = Queue()
+	lock = threading.Lock()
+	state = {"done": 0, "next": 0, "buffers": {}, "failed": []}
+	roi_threads = 1 if threads > 1 else None
+
+	def commit(i, buffer):
+		'''
+		Adds the finished images to writer in image order.
+		'''
+		with lock:
+			state["done"] += 1
+			IJ.log("\n# Progress: {0}/{1}\n".format(state["done"], len(images)))
+			if writer is None:
+				return
+			state["buffers"][i] = buffer
+			while state["next"] in state["buffers"]:
+				state["buffers"].pop(state["next"]).add_to(writer)
+				state["next"] += 1
+
+	def worker():
+		while True:
+			task = tasks_q.get()
+			if task is None:
+				tasks_q.task_done()
+				break
+			i, img = task
+			buffer = ProfileBuffer()
+			imp = None
+			try:
+				imp = imageloader(img)
+				title = imp.getTitle()
+				IJ.log("\nMeasuring -> {0}".format(title))
+				rois = store.get(title)
+				if not rois:
+					IJ.log("## No rois found for {0}".format(title))
+				profile_from_threshold(imp, batch_parameters.get("analysis_ch"),
+					rois, batch_parameters.get("stroke_width"),
+					batch_parameters.get("th_method"), csvs_folder, writer=None if writer is None else buffer,
+					masks=masks, path=img, threads=roi_threads)
+			except (Exception, java.lang.Exception):
+				IJ.log("## Profiling {0} failed.\n{1}".format(img, traceback.format_exc()))
+				buffer = ProfileBuffer() # Drops the profiles of the failed image.
+				with lock:
+					state["failed"].append(img)
+			finally:
+				if imp is not None:
+					imp.close()
+				commit(i, buffer)
+				tasks_q.task_done()
+
+	start = time.time()
+	workers = [threading.Thread(target=worker, name="IBPlib.tracing_and_linescanning.{0}".format(i)) for i in range(max(1, threads))]
+	[t.start() for t in workers]
+	try:
+		for task in enumerate(images):
+			tasks_q.put(task)
+	finally:
+		for t in workers:
+			tasks_q.put(None) # Also stops the workers when queueing failed.
+		[t.join() for t in workers]
+	elapsed = time.time() - start
+	IJ.log("# Profiled {0} images ({1} failed) in {2:.1f}s, {3:.1f} images/min.".format(len(images),
+		len(state["failed"]), elapsed, 60.0 * len(images) / elapsed if elapsed else 0.0))
+	return state["failed"]
 
 
 if __name__ in ("__builtin__", "__main__"):
@@ -0,0 +1,239 @@
+import time
+import traceback
+import java.lang.Exception
+
+from threading import (Lock, RLock)
+
+from ij import IJ
+
+from IBPlib.ij.Utils.Projections import (METHODS, TITLE_PREFIXES, band_projection)
+
+__version__ = "1.0"
+
+
+class ZProjectorBackend:
+	'''
+	Single threaded ij.plugin.ZProjector. Supports every method and is always available.
+	'''
+	name = "zprojector"
+	methods = METHODS
+
+	def available(self):
+		return True
+
+	def project(self, imp, method, threads=None):
+		from ij.plugin import ZProjector
+		return ZProjector.run(imp, method)
+
+
+class CPUBackend:
+	'''
+	Multithreaded CPU projection splitting the image in row bands.
+	See IBPlib.ij.Utils.Projections.band_projection. Results are identical to ZProjector.
+	'''
+	name = "cpu"
+	methods = METHODS
+
+	def available(self):
+		return True
+
+	def project(self, imp, method, threads=None):
+		return band_projection(imp, method, threads=threads)
+
+
+class CLIJ2Backend:
+	'''
+	GPU projection with CLIJ2, available only when CLIJ2 is installed and a GPU can be initialised.
+	Each channel and timepoint is projected separately. avg, sum and sd results are 32-bit.
+	'''
+	name = "clij2"
+	methods = ("max", "min", "sum", "avg", "sd", "median")
+	operations = {"max": "maximumZProjection", "min": "minimumZProjection", "sum": "sumZProjection",
+		"avg": "meanZProjection", "sd": "standardDeviationZProjection", "median": "medianZProjection"}
+
+	def __init__(self):
+		self.clij2 = None
+		self.checked = False
+		self.lock = Lock()
+
+
+	def available(self):
+		with self.lock:
+			if not self.checked:
+				self.checked = True
+				try:
+					from net.haesleinhuepf.clij2 import CLIJ2
+					self.clij2 = CLIJ2.getInstance()
+				except (Exception, java.lang.Exception, java.lang.Error):
+					self.clij2 = None
+		return self.clij2 is not None
+
+
+	def project(self, imp, method, threads=None):
+		from ij import (ImagePlus, ImageStack, CompositeImage)
+		from ij.plugin import Duplicator
+		from net.haesleinhuepf.clij.coremem.enums import NativeTypeEnum
+
+		if not self.available():
+			raise RuntimeError("CLIJ2 is not available.")
+		clij2 = self.clij2
+		operation = self.operations[method]
+		n_channels, n_slices, n_frames = imp.getNChannels(), imp.getNSlices(), imp.getNFrames()
+		stack = ImageStack(imp.getWidth(), imp.getHeight())
+		for t in range(1, n_frames + 1):
+			for c in range(1, n_channels + 1):
+				substack = Duplicator().run(imp, c, c, 1, n_slices, t, t)
+				imageInput = clij2.push(substack)
+				if method in ("max", "min", "median"):
+					native_type = imageInput.getNativeType()
+				else:
+					native_type = NativeTypeEnum.Float
+				imageOutput = clij2.create([imageInput.getWidth(), imageInput.getHeight()], native_type)
+				getattr(clij2, operation)(imageInput, imageOutput)
+				stack.addSlice(clij2.pull(imageOutput).getProcessor())
+				imageInput.close()
+				imageOutput.close()
+		projection = ImagePlus("{0}_{1}".format(TITLE_PREFIXES[method], imp.getTitle()), stack)
+		projection.setDimensions(n_channels, 1, n_frames)
+		projection.setCalibration(imp.getCalibration())
+		if n_channels > 1:
+			projection = CompositeImage(projection, CompositeImage.COMPOSITE)
+		return projection
+
+
+__BACKENDS__ = [CPUBackend(), ZProjectorBackend(), CLIJ2Backend()] # In default preference order.
+__FASTEST__ = {} # {(method, size class, threads): backend name} filled by benchmark_backends.
+__BACKENDS_LOCK__ = RLock() # Guards __BACKENDS__ and __FASTEST__.
+
+
+def register_backend(backend, first=False):
+	'''
+	Registers a projection backend. A backend has a name, a methods tuple,
+	an available() method and a project(imp, method, threads=None) method.
+	Replaces a registered backend with the same name.
+	'''
+	with __BACKENDS_LOCK__:
+		unregister_backend(backend.name)
+		if first:
+			__BACKENDS__.insert(0, backend)
+		else:
+			__BACKENDS__.append(backend)
+
+
+def unregister_backend(name):
+	with __BACKENDS_LOCK__:
+		for backend in [b for b in __BACKENDS__ if b.name == name]:
+			__BACKENDS__.remove(backend)
+
+
+def registered_backends():
+	'''
+	Returns a copy of the registered backends, in preference order.
+	'''
+	with __BACKENDS_LOCK__:
+		return list(__BACKENDS__)
+
+
+def get_backend(name):
+	backends = registered_backends()
+	for backend in backends:
+		if backend.name == name:
+			return backend
+	raise ValueError("Unknown projection backend {0}. Use one of {1}.".format(name, [b.name for b in backends]))
+
+
+def available_backends(method):
+	'''
+	Returns the available backends supporting method, in preference order.
+	'''
+	return [b for b in registered_backends() if method in b.methods and b.available()]
+
+
+def size_class(imp):
+	'''
+	Buckets images by the power of two of their number of voxels and their bit depth,
+	so a benchmark result is reused for images of similar size.
+	'''
+	voxels = imp.getWidth() * imp.getHeight() * imp.getStackSize()
+	return (voxels.bit_length(), imp.getBitDepth())
+
+
+def select_backends(method, imp=None, backend="auto", autobenchmark=False, threads=None):
+	'''
+	Returns the backends to try for method, in order.
+	A named backend comes first if available, followed by the others as fallbacks.
+	An unknown backend name raises ValueError.
+	With "auto" the fastest backend measured by benchmark_backends for the size class of imp
+	and the number of threads comes first, running the micro-benchmark first if autobenchmark is set.
+	'''
+	if backend and backend != "auto":
+		get_backend(backend)
+	candidates = available_backends(method)
+	if not candidates:
+		raise ValueError("No available projection backend supports {0}.".format(method))
+	preferred = None
+	if backend and backend != "auto":
+		preferred = backend
+	elif imp is not None:
+		key = (method, size_class(imp), threads)
+		with __BACKENDS_LOCK__:
+			preferred = __FASTEST__.get(key)
+		if preferred is None and autobenchmark:
+			benchmark_backends(method, imp, threads=threads)
+			with __BACKENDS_LOCK__:
+				preferred = __FASTEST__.get(key)
+	if preferred:
+		candidates.sort(key=lambda b: b.name != preferred)
+	return candidates
+
+
+def project(imp, method, backend="auto", threads=None, autobenchmark=False):
+	'''
+	Projects imp with method on the selected backend, falling back to the next
+	available backend if it fails.
+	'''
+	errors = []
+	for candidate in select_backends(method, imp, backend, autobenchmark, threads):
+		try:
+			return candidate.project(imp, method, threads=threads)
+		except (Exception, java.lang.Exception):
+			IJ.log("# {0} projection backend failed, falling back.\n{1}".format(candidate.name, traceback.format_exc()))
+			errors.append(candidate.name)
+	raise RuntimeError("All projection backends failed for {0}: {1}".format(method, errors))
+
+
+def benchmark_backends(method, imp, threads=None, max_slices=16, repeats=2):
+	'''
+	Micro-benchmark of every available backend for method on a synthetic stack with the
+	width, height and bit depth of imp and at most max_slices slices, using threads threads.
+	Stores the fastest backend for the size class of imp, used by select_backends.
+	Returns a dict {backend name: best time in seconds}.
+	'''
+	types = {8: "8-bit", 16: "16-bit", 24: "RGB", 32: "32-bit"}
+	slices = max(1, min(max_slices, imp.getStackSize()))
+	sample = IJ.createImage("benchmark", "{0} ramp".format(types[imp.getBitDepth()]),
+		imp.getWidth(), imp.getHeight(), slices)
+	timings = {}
+	for candidate in available_backends(method):
+		times = []
+		try:
+			for r in range(repeats):
+				start = time.time()
+				candidate.project(sample, method, threads=threads)
+				times.append(time.time() - start)
+		except (Exception, java.lang.Exception):
+			continue
+		timings[candidate.name] = min(times)
+	if timings:
+		fastest = min(timings.keys(), key=lambda name: timings[name])
+		with __BACKENDS_LOCK__:
+			__FASTEST__[(method, size_class(imp), threads)] = fastest
+		IJ.log("# benchmark_backends: {0} {1}x{2}x{3} {4}-bit -> {5}. {6}".format(method, imp.getWidth(),
+			imp.getHeight(), slices, imp.getBitDepth(), fastest,
+			", ".join(["{0} {1:.3f}s".format(name, t) for name, t in sorted(timings.items())])))
+	return timings
+
+
+if __name__ in ("__builtin__", "__main__"):
+	IJ.log("Available backends: {0}".format([b.name for b in registered_backends() if b.available()]))
+	benchmark_backends("max", IJ.getImage())
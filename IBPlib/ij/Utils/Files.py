@@ -13,14 +13,131 @@ path.append(jython_scripts)
 #=========================================#
 
 
+import re
+import time
+import shutil
+import hashlib
+import fnmatch
+
+from threading import (Thread, Lock)
+from Queue import Queue
+from collections import OrderedDict
+
 from IBPlib.ij.Constants import (__STORAGE_DIR__, __MAGNIFICATION_DIR__)
 
 BIOFORMATS = (".sld", ".ics", ".hdf5", ".czi", ".icd", ".ids")
 
-def buildList(path, extension=".tif", exclusionFlag="done", debug=False):
+__LISTINGS__ = {} # {directory: (listing time, [(name, isdir)])} used by listdir when a cache_ttl is given.
+__LISTINGS_LOCK__ = Lock()
+__IMAGE_CACHE__ = None # Process wide ImageCache used by imageloader, see set_image_cache.
+
+
+def listdir(path, cache_ttl=None):
+	'''
+	Returns a list of (name, isdir) for the entries of the directory path, sorted by name.
+	With cache_ttl (seconds) a listing younger than cache_ttl is reused, so repeated scans
+	of the same tree (e.g. one per image of a batch) do not hit the file server every time.
+	'''
+	if cache_ttl:
+		with __LISTINGS_LOCK__:
+			cached = __LISTINGS__.get(path)
+		if cached and time.time() - cached[0] < cache_ttl:
+			return cached[1]
+	listing = [(name, os.path.isdir(os.path.join(path, name))) for name in sorted(os.listdir(path))]
+	if cache_ttl:
+		with __LISTINGS_LOCK__:
+			__LISTINGS__[path] = (time.time(), listing)
+	return listing
+
+
+def clear_listing_cache():
+	with __LISTINGS_LOCK__:
+		__LISTINGS__.clear()
+
+
+def check_folder(path):
+	'''
+	Raises IOError if path does not exist or is not a directory.
+	'''
+	if not os.path.exists(path):
+		raise IOError("scan couldn't find {0}".format(path))
+	elif not os.path.isdir(path):
+		raise IOError("scan only accepts directory paths")
+
+
+def scan(path, extensions=None, include=None, exclude=None, recursive=False, max_depth=None,
+	follow_links=False, cache_ttl=None, exclude_dirs=None):
+	'''
+	Generator yielding the paths of the files under path.
+	Files are yielded as soon as their directory is listed, so callers can start working
+	on the first files before the scan of a large tree finishes.
+	extensions is an extension or a collection of them (case insensitive, e.g. (".ics", ".tif")).
+	include and exclude are glob patterns or lists of them matched against the file name.
+	exclude_dirs are glob patterns pruning the directories whose name matches them.
+	With recursive, subdirectories are scanned depth first down to max_depth levels below path.
+	Linked directories are only followed with follow_links.
+	cache_ttl (seconds) reuses recent directory listings, see listdir.
+	path is checked on the first next(), call check_folder to fail before that.
+	'''
+	check_folder(path)
+	if isinstance(extensions, basestring):
+		extensions = (extensions,)
+	if extensions is not None:
+		extensions = tuple([ext.lower() for ext in extensions])
+	if isinstance(include, basestring):
+		include = (include,)
+	if isinstance(exclude, basestring):
+		exclude = (exclude,)
+	if isinstance(exclude_dirs, basestring):
+		exclude_dirs = (exclude_dirs,)
+
+	def matches(name, patterns):
+		return patterns and any([fnmatch.fnmatch(name, pattern) for pattern in patterns])
+
+	stack = [(path, 0)]
+	while stack:
+		folder, depth = stack.pop()
+		try:
+			listing = listdir(folder, cache_ttl)
+		except OSError:
+			continue
+		subfolders = []
+		for name, isdir in listing:
+			fullpath = os.path.join(folder, name)
+			if isdir:
+				if matches(name, exclude_dirs):
+					continue
+				if recursive and (max_depth is None or depth < max_depth) and (follow_links or not os.path.islink(fullpath)):
+					subfolders.append((fullpath, depth + 1))
+				continue
+			if matches(name, exclude):
+				continue
+			if extensions is not None and not name.lower().endswith(extensions):
+				continue
+			if include and not matches(name, include):
+				continue
+			yield fullpath
+		stack.extend(reversed(subfolders))
+
+
+def ensure_folder(path):
+	'''
+	Creates the folder path if it does not exist yet. Safe to call from several threads.
+	'''
+	if not path or os.path.isdir(path):
+		return
+	try:
+		os.makedirs(path)
+	except OSError:
+		if not os.path.isdir(path):
+			raise
+
+
+def buildList(path, extension=".tif", exclusionFlag="done", debug=False, recursive=False):
 	'''
 	Returns a list with all the binary paths to files in the given path of the choosen extension that do not contain
 	the exclusion flag in the title
+	See scan to start working on the files while they are listed.
 	'''
 	if debug:
 		print("buildList() -> args={0}".format([path, extension, exclusionFlag]))
@@ -29,26 +146,40 @@ def buildList(path, extension=".tif", exclusionFlag="done", debug=False):
 		raise IOError("buildList couldn't find {0}".format(path))
 	elif not os.path.isdir(path):
 		raise IOError("buildList only accepts directory paths")
-	elif os.path.ismount(path):
-		raise IOError("Cannot operate on mounted drives.")
 	elif os.path.islink(path):
 		raise IOError("Please resolve sim links before passing it.")
 
-	files = []
-		
-	for f in os.listdir(path):
-		if debug:
-			print(f)
-		if not f.lower().endswith(extension) or f.find(exclusionFlag)>0:
-			continue
-		files.append(os.path.join(path, f))
+	exclude = None
+	if exclusionFlag:
+		exclude = "*{0}*".format(exclusionFlag)
+	files = list(scan(path, extensions=extension, exclude=exclude, recursive=recursive))
+	if debug:
+		print("\n".join(files))
 	return files
 
-def imageloader(path, debug=False):
+def imageloader(path, debug=False, cache=None, virtual=False):
 	'''
 	Wrapper to deal with opening bioformat images properly in macros
 	Returns an ImagePlus if successful and exception if not.
 	Read ij.ImagePlus and loci.plugins.BF.openImagePlus for details.
+	If cache (an ImageCache) is given, or a process wide one was set with set_image_cache,
+	images are served from it and the returned ImagePlus is a copy the caller owns.
+	With virtual, bioformat images are opened as virtual stacks and planes are read on demand
+	(see IBPlib.ij.Utils.Readers.open_virtual). Virtual stacks are never cached.
+	Use IBPlib.ij.Utils.Readers.probe when only dimensions or calibration are needed.
+	'''
+	if virtual and os.path.splitext(path)[1] in BIOFORMATS:
+		from IBPlib.ij.Utils.Readers import open_virtual
+		return open_virtual(path)
+	cache = cache or __IMAGE_CACHE__
+	if cache is not None:
+		return cache.get(path, openimage)
+	return openimage(path)
+
+
+def openimage(path):
+	'''
+	Opens path with Bio-Formats for BIOFORMATS extensions and ij.ImagePlus otherwise.
 	'''
 	from ij import ImagePlus
 	from loci.plugins import BF
@@ -61,6 +192,147 @@ def imageloader(path, debug=False):
 
 	else:
 		return ImagePlus(path)
+
+
+class ImageCache:
+	'''
+	Thread safe LRU cache of opened images keyed by path and mtime, bounded by a byte budget
+	(a quarter of the JVM max heap by default).
+	A file modified since it was cached is opened again.
+	get hands out a duplicate of the cached image, so callers can modify or close() it without
+	touching the cached entry. On a miss the loaded image is returned and a duplicate is cached.
+	Virtual stacks and images bigger than the budget are not cached, nor duplicated.
+	'''
+	def __init__(self, budget=None, heap_fraction=0.25):
+		from java.lang import Runtime
+
+		if budget is None:
+			budget = int(Runtime.getRuntime().maxMemory() * heap_fraction)
+		self.budget = budget
+		self.lock = Lock()
+		self.entries = OrderedDict() # {path: (mtime, imp, bytes)} from least to most recently used.
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.invalidations = 0
+
+
+	def get(self, path, loader=openimage):
+		'''
+		Returns a copy of the image in path, opening it with loader on a miss.
+		'''
+		path = os.path.abspath(path)
+		mtime = os.path.getmtime(path)
+		imp = None
+		with self.lock:
+			entry = self.entries.pop(path, None)
+			if entry and entry[0] == mtime:
+				self.entries[path] = entry
+				self.hits += 1
+				imp = entry[1]
+			else:
+				if entry:
+					self.size -= entry[2]
+					self.invalidations += 1
+				self.misses += 1
+		if imp is None:
+			imp = loader(path)
+			if self.cacheable(imp):
+				self.put(path, mtime, handoff(imp))
+			return imp
+		return handoff(imp)
+
+
+	def cacheable(self, imp):
+		'''
+		Returns True if imp is not a virtual stack and fits in the budget.
+		'''
+		return not imp.getStack().isVirtual() and imagesize(imp) <= self.budget
+
+
+	def put(self, path, mtime, imp):
+		'''
+		Caches imp for path, evicting the least recently used images to stay under the budget.
+		Returns False if imp was not cached.
+		'''
+		if not self.cacheable(imp):
+			return False
+		nbytes = imagesize(imp)
+		with self.lock:
+			previous = self.entries.pop(path, None)
+			if previous:
+				self.size -= previous[2]
+			while self.entries and self.size + nbytes > self.budget:
+				evicted_path, evicted = self.entries.popitem(last=False)
+				self.size -= evicted[2]
+				self.evictions += 1
+			self.entries[path] = (mtime, imp, nbytes)
+			self.size += nbytes
+		return True
+
+
+	def invalidate(self, path=None):
+		'''
+		Drops path from the cache, or every image if path is None.
+		'''
+		with self.lock:
+			if path is None:
+				self.entries.clear()
+				self.size = 0
+				return
+			entry = self.entries.pop(os.path.abspath(path), None)
+			if entry:
+				self.size -= entry[2]
+
+
+	def stats(self):
+		'''
+		Returns a dict with the cache counters.
+		'''
+		with self.lock:
+			return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+				"invalidations": self.invalidations, "images": len(self.entries),
+				"size": self.size, "budget": self.budget}
+
+
+	def log_stats(self):
+		from ij import IJ
+
+		s = self.stats()
+		IJ.log("# ImageCache: {0} hits, {1} misses, {2} evictions, {3} invalidations. {4} images, {5} MB of {6} MB."
+			.format(s["hits"], s["misses"], s["evictions"], s["invalidations"], s["images"],
+				s["size"] >> 20, s["budget"] >> 20))
+
+
+def handoff(imp):
+	'''
+	Returns a copy of imp with the same title, calibration and properties.
+	'''
+	copy = imp.duplicate()
+	copy.setTitle(imp.getTitle())
+	copy.setCalibration(imp.getCalibration())
+	return copy
+
+
+def imagesize(imp):
+	'''
+	Returns the bytes held by the pixels of imp.
+	'''
+	return imp.getWidth() * imp.getHeight() * imp.getStackSize() * imp.getBytesPerPixel()
+
+
+def set_image_cache(cache):
+	'''
+	Sets the process wide ImageCache used by imageloader. Pass None to disable it.
+	e.g. set_image_cache(ImageCache(budget=4 << 30))
+	'''
+	global __IMAGE_CACHE__
+	__IMAGE_CACHE__ = cache
+
+
+def get_image_cache():
+	return __IMAGE_CACHE__
 
 def validate_token_group_schema(groups_dict):
 	'''
@@ -108,6 +380,15 @@ def sort_to_storage(name, groups_dict):
 	other situations.
 	'''
 	tokens = tokenize(name, groups_dict)
+	return storage_path(name, tokens)
+
+
+STORAGE_TOKENS = ("group", "marker", "stage", "flags") # Token categories needed to build a storage path.
+
+def storage_path(name, tokens):
+	'''
+	Returns the storage path of name from its tokens (see tokenize and TokenIndex.classify).
+	'''
 	path = os.path.join(
 		__STORAGE_DIR__,
 		tokens.get("group"),
@@ -117,6 +398,183 @@ def sort_to_storage(name, groups_dict):
 		tokens.get("flags"), name)
 
 	return path
+
+
+class TokenIndex:
+	'''
+	Token groups (see tokenize) validated and compiled once, so thousands of names can be classified
+	with one regex scan per category instead of a substring scan per token.
+	Nested groups are flattened: any token found under a group is classified as the group name.
+	When several tokens of a category are found in a name the longest one wins, then the leftmost.
+	Empty tokens are ignored and categories without tokens are skipped, as tokenize never finds them
+	(an empty pattern would match every name).
+	'''
+	def __init__(self, groups_dict):
+		validate_token_group_schema(groups_dict)
+		self.categories = []
+		for category, tokens in groups_dict.items():
+			values = {}
+			self.flatten(tokens, values)
+			if not values:
+				continue
+			words = sorted(values.keys(), key=lambda token: -len(token))
+			pattern = re.compile("|".join([re.escape(token) for token in words]))
+			self.categories.append((category, pattern, values))
+
+
+	def flatten(self, tokens, values, group=None):
+		'''
+		Fills values with {token: value}, value being the token itself or the name of its group.
+		'''
+		if isinstance(tokens, dict):
+			for group_name, group_tokens in tokens.items():
+				self.flatten(group_tokens, values, group or group_name)
+			return
+		for token in tokens:
+			if token:
+				values.setdefault(token, group or token)
+
+
+	def classify(self, name):
+		'''
+		Returns a dict containing the found tokens indexed by category, like tokenize.
+		'''
+		found = {}
+		for category, pattern, values in self.categories:
+			matches = pattern.findall(name)
+			if matches:
+				found[category] = values[max(matches, key=len)]
+		return found
+
+
+	def classify_all(self, names, required=STORAGE_TOKENS):
+		'''
+		Classifies names in one pass.
+		Returns a dict {name: tokens} and a list of the names missing any of the required categories.
+		'''
+		classified = {}
+		unclassified = []
+		for name in names:
+			tokens = self.classify(name)
+			if [category for category in required if category not in tokens]:
+				unclassified.append(name)
+			else:
+				classified[name] = tokens
+		return classified, unclassified
+
+
+def file_checksum(path, chunk=1 << 20):
+	'''
+	Returns the md5 hex digest of the file in path.
+	'''
+	digest = hashlib.md5()
+	with open(path, "rb") as f:
+		while True:
+			data = f.read(chunk)
+			if not data:
+				break
+			digest.update(data)
+	return digest.hexdigest()
+
+
+def verified_copy(src, dst):
+	'''
+	Copies src to dst through a temporary file and checks the copy against the source checksum
+	before putting it in place. Raises IOError if they differ.
+	'''
+	partial = "{0}.part".format(dst)
+	shutil.copyfile(src, partial)
+	if file_checksum(src) != file_checksum(partial):
+		os.remove(partial)
+		raise IOError("Checksum mismatch copying {0} to {1}".format(src, dst))
+	shutil.copystat(src, partial)
+	os.rename(partial, dst)
+
+
+def transfer(src, dst, move=True):
+	'''
+	Moves or copies src to dst, creating the destination folders.
+	Moves within a filesystem are renames, other moves are a verified copy followed by removing src.
+	Returns "renamed", "moved" or "copied".
+	'''
+	if os.path.exists(dst):
+		raise IOError("{0} already exists".format(dst))
+	folder = os.path.dirname(dst)
+	ensure_folder(folder)
+	if move and os.stat(src).st_dev == os.stat(folder).st_dev:
+		try:
+			os.rename(src, dst)
+			return "renamed"
+		except OSError:
+			pass
+	verified_copy(src, dst)
+	if move:
+		os.remove(src)
+		return "moved"
+	return "copied"
+
+
+def bulk_sort_to_storage(paths, groups_dict, move=True, dry_run=False, threads=4):
+	'''
+	Sorts the files in paths to their storage path (see sort_to_storage) with a pool of threads.
+	groups_dict is compiled once into a TokenIndex and every name is classified before anything moves.
+	With move False files are copied. With dry_run nothing is moved and the report lists the
+	planned destinations.
+	Returns a report dict with the "unclassified" paths, the "planned" {src: dst}, the "done"
+	{src: operation} and the "failed" {src: reason}.
+	'''
+	from ij import IJ
+
+	index = groups_dict if isinstance(groups_dict, TokenIndex) else TokenIndex(groups_dict)
+	names = dict([(path, os.path.basename(path)) for path in paths])
+	classified, unclassified = index.classify_all(names.values())
+	unclassified = set(unclassified)
+	report = {"unclassified": [path for path in paths if names[path] in unclassified],
+		"planned": {}, "done": {}, "failed": {}}
+	destinations = {}
+	for path in paths:
+		if names[path] in classified:
+			dst = storage_path(names[path], classified[names[path]])
+			if dst in destinations:
+				report["failed"][path] = "same destination as {0}".format(destinations[dst])
+				continue
+			destinations[dst] = path
+			report["planned"][path] = dst
+	for path in report["unclassified"]:
+		IJ.log("# Could not classify {0}".format(path))
+	if dry_run:
+		return report
+
+	lock = Lock()
+	tasks_q = Queue()
+
+	def worker():
+		while True:
+			task = tasks_q.get()
+			if task is None:
+				tasks_q.task_done()
+				break
+			src, dst = task
+			try:
+				operation = transfer(src, dst, move)
+				with lock:
+					report["done"][src] = operation
+			except (IOError, OSError) as e:
+				with lock:
+					report["failed"][src] = "{0}".format(e)
+				IJ.log("# Could not sort {0}: {1}".format(src, e))
+			finally:
+				tasks_q.task_done()
+
+	workers = [Thread(target=worker, name="IBPlib.Files.sorter.{0}".format(i)) for i in range(max(1, threads))]
+	[t.start() for t in workers]
+	for task in sorted(report["planned"].items()):
+		tasks_q.put(task)
+	for t in workers:
+		tasks_q.put(None)
+	for t in workers:
+		t.join()
+	return report
 
 if __name__ == "__main__":
 	name = "111219_let-805_vab-10aGFP_2DOA_worm3_ - 2__cmle.tif"
@@ -0,0 +1,241 @@
+import os
+import json
+import java.lang.Exception
+
+from threading import Lock
+
+from IBPlib.ij.Utils.Files import (scan, TokenIndex)
+from IBPlib.ij.Utils.Readers import probe
+
+__version__ = "1.0"
+__INDEX_FILENAME__ = "IBPlib_index.sqlite"
+
+COLUMNS = ("path", "folder", "name", "size", "mtime", "width", "height", "slices", "channels", "frames",
+	"bitdepth", "pixel_width", "pixel_height", "pixel_depth", "unit", "colortag", "channel", "root", "tokens", "error")
+
+SCHEMA = (
+	"""CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, folder TEXT, name TEXT, size INTEGER,
+	mtime REAL, width INTEGER, height INTEGER, slices INTEGER, channels INTEGER, frames INTEGER,
+	bitdepth INTEGER, pixel_width REAL, pixel_height REAL, pixel_depth REAL, unit TEXT, colortag TEXT,
+	channel INTEGER, root TEXT, tokens TEXT, error TEXT)""",
+	"CREATE INDEX IF NOT EXISTS images_folder ON images (folder)",
+	"CREATE TABLE IF NOT EXISTS tokens (path TEXT, category TEXT, value TEXT)",
+	"CREATE INDEX IF NOT EXISTS tokens_value ON tokens (category, value)",
+	"CREATE INDEX IF NOT EXISTS tokens_path ON tokens (path)")
+
+
+def connect(db_path):
+	'''
+	Returns a DB-API connection to the SQLite database in db_path.
+	Uses the sqlite3 module when available and zxJDBC with the org.sqlite.JDBC driver
+	(sqlite-jdbc has to be in the Fiji jars) under Jython.
+	'''
+	try:
+		import sqlite3
+		return sqlite3.connect(db_path, check_same_thread=False)
+	except ImportError:
+		from com.ziclix.python.sql import zxJDBC
+		return zxJDBC.connect("jdbc:sqlite:{0}".format(db_path), None, None, "org.sqlite.JDBC")
+
+
+class ImageIndex:
+	'''
+	Persistent SQLite index of the images of one or more folders: path, size, mtime, dimensions,
+	channel count, bit depth, calibration, inferred colortag and tokens (see Files.tokenize).
+	refresh only reads the header of new or modified files (by size and mtime), so planning a run
+	on an indexed folder does not open thousands of images again.
+	colortags is anything accepted by IBPlib.ij.Colortags.get_colortags and groups_dict a token
+	groups dict or TokenIndex. Both are optional.
+	e.g.
+		index = ImageIndex(os.path.join(folder, __INDEX_FILENAME__), groups_dict=tokens)
+		index.refresh(folder, extensions=".ics")
+		paths = index.query(tokens={"stage": "2DOA", "marker": "vab-10a", "flags": "decon"}, channels=3)
+	'''
+	def __init__(self, db_path, colortags=None, groups_dict=None):
+		self.db_path = db_path
+		self.lock = Lock()
+		self.connection = connect(db_path)
+		self.matcher = None
+		if colortags is not None:
+			from IBPlib.ij.Colortags import get_colortags
+			self.matcher = get_colortags(colortags).get_matcher()
+		self.token_index = None
+		if groups_dict is not None:
+			self.token_index = groups_dict if isinstance(groups_dict, TokenIndex) else TokenIndex(groups_dict)
+		with self.lock:
+			cursor = self.connection.cursor()
+			for statement in SCHEMA:
+				cursor.execute(statement)
+			cursor.close()
+			self.connection.commit()
+
+
+	def refresh(self, folder, extensions=None, recursive=False, include=None, exclude=None, commit_every=500):
+		'''
+		Brings the index up to date with folder: new and modified files are probed and stored,
+		unchanged files are left alone and files that disappeared are removed.
+		Returns a dict with the number of added, updated, unchanged, removed and failed files.
+		'''
+		folder = os.path.abspath(folder)
+		known = dict([(row[0], (row[1], row[2])) for row in self.execute(
+			"SELECT path, size, mtime FROM images WHERE path LIKE ?", (os.path.join(folder, "%"),))
+			if row[0].startswith(folder + os.sep) and (recursive or os.path.dirname(row[0]) == folder)])
+		counts = {"added": 0, "updated": 0, "unchanged": 0, "removed": 0, "failed": 0}
+		pending = 0
+		for path in scan(folder, extensions=extensions, include=include, exclude=exclude, recursive=recursive):
+			if path.startswith(os.path.abspath(self.db_path)):
+				continue
+			st = os.stat(path)
+			signature = known.pop(path, None)
+			if signature is not None and signature[0] == st.st_size and signature[1] == st.st_mtime:
+				counts["unchanged"] += 1
+				continue
+			record = self.describe(path, st)
+			if record["error"]:
+				counts["failed"] += 1
+			counts["updated" if signature is not None else "added"] += 1
+			self.store(record)
+			pending += 1
+			if pending >= commit_every:
+				self.commit()
+				pending = 0
+		for path in known:
+			self.remove(path)
+			counts["removed"] += 1
+		self.commit()
+		return counts
+
+
+	def describe(self, path, st=None):
+		'''
+		Returns the index record of the file in path, reading only its header.
+		'''
+		st = st or os.stat(path)
+		name = os.path.basename(path)
+		record = dict([(column, None) for column in COLUMNS])
+		record.update({"path": path, "folder": os.path.dirname(path), "name": name,
+			"size": st.st_size, "mtime": st.st_mtime})
+		try:
+			p = probe(path)
+			cal = p["calibration"]
+			record.update({"width": p["width"], "height": p["height"], "slices": p["slices"],
+				"channels": p["channels"], "frames": p["frames"], "bitdepth": p["bitdepth"],
+				"pixel_width": cal.pixelWidth, "pixel_height": cal.pixelHeight,
+				"pixel_depth": cal.pixelDepth, "unit": cal.getUnit()})
+		except (Exception, java.lang.Exception) as e:
+			record["error"] = "{0}".format(e)
+		if self.matcher is not None:
+			found = self.matcher.match(name)
+			if found:
+				record.update({"colortag": found[0], "channel": self.matcher.indexes[found[0]][0],
+					"root": name.replace(found[0], "")})
+		tokens = {}
+		if self.token_index is not None:
+			tokens = self.token_index.classify(name)
+		record["tokens"] = json.dumps(tokens, sort_keys=True)
+		return record
+
+
+	def store(self, record):
+		'''
+		Inserts or replaces a record built by describe.
+		'''
+		statement = "INSERT OR REPLACE INTO images ({0}) VALUES ({1})".format(
+			", ".join(COLUMNS), ", ".join(["?"] * len(COLUMNS)))
+		tokens = json.loads(record["tokens"])
+		with self.lock:
+			cursor = self.connection.cursor()
+			cursor.execute(statement, tuple([record[column] for column in COLUMNS]))
+			cursor.execute("DELETE FROM tokens WHERE path = ?", (record["path"],))
+			for category, value in sorted(tokens.items()):
+				cursor.execute("INSERT INTO tokens (path, category, value) VALUES (?, ?, ?)",
+					(record["path"], category, value))
+			cursor.close()
+
+
+	def remove(self, path):
+		with self.lock:
+			cursor = self.connection.cursor()
+			cursor.execute("DELETE FROM images WHERE path = ?", (path,))
+			cursor.execute("DELETE FROM tokens WHERE path = ?", (path,))
+			cursor.close()
+
+
+	def query(self, folder=None, tokens=None, recursive=True, **fields):
+		'''
+		Returns the sorted paths of the indexed images matching all the conditions.
+		folder restricts the results to a folder (and its subfolders if recursive).
+		tokens is a dict {category: value} and fields are column values (e.g. channels=3, colortag="C1").
+		'''
+		conditions = ["error IS NULL"]
+		params = []
+		for column, value in sorted(fields.items()):
+			if column not in COLUMNS:
+				raise ValueError("Unknown index column {0}. Use one of {1}.".format(column, COLUMNS))
+			conditions.append("{0} = ?".format(column))
+			params.append(value)
+		if folder is not None:
+			folder = os.path.abspath(folder)
+			if recursive:
+				conditions.append("path LIKE ?")
+				params.append(os.path.join(folder, "%"))
+			else:
+				conditions.append("folder = ?")
+				params.append(folder)
+		for category, value in sorted((tokens or {}).items()):
+			conditions.append("path IN (SELECT path FROM tokens WHERE category = ? AND value = ?)")
+			params.extend([category, value])
+		rows = self.execute("SELECT path FROM images WHERE {0} ORDER BY path".format(" AND ".join(conditions)),
+			tuple(params))
+		paths = [row[0] for row in rows]
+		if folder is not None and recursive:
+			paths = [path for path in paths if path.startswith(folder + os.sep)]
+		return paths
+
+
+	def get(self, path):
+		'''
+		Returns the record of path as a dict with its tokens decoded, or None if it is not indexed.
+		'''
+		rows = self.execute("SELECT {0} FROM images WHERE path = ?".format(", ".join(COLUMNS)),
+			(os.path.abspath(path),))
+		if not rows:
+			return None
+		record = dict(zip(COLUMNS, rows[0]))
+		record["tokens"] = json.loads(record["tokens"] or "{}")
+		return record
+
+
+	def execute(self, statement, params=()):
+		'''
+		Runs statement and returns all the rows.
+		'''
+		with self.lock:
+			cursor = self.connection.cursor()
+			try:
+				cursor.execute(statement, params)
+				return cursor.fetchall()
+			finally:
+				cursor.close()
+
+
+	def commit(self):
+		with self.lock:
+			self.connection.commit()
+
+
+	def close(self):
+		self.commit()
+		with self.lock:
+			self.connection.close()
+
+
+if __name__ in ("__builtin__", "__main__"):
+	from ij import IJ
+	from ij.io import DirectoryChooser
+
+	folder = DirectoryChooser("Folder to index").getDirectory()
+	if folder:
+		index = ImageIndex(os.path.join(folder, __INDEX_FILENAME__))
+		IJ.log("{0}".format(index.refresh(folder, extensions=(".ics", ".tif"))))
+		index.close()
@@ -0,0 +1,177 @@
+import os
+import json
+
+from threading import Lock
+
+__version__ = "1.0"
+__MANIFEST_FILENAME__ = "IBPlib_manifest.json"
+
+
+def replace_file(src, dst):
+	'''
+	Moves src over dst in one step, so dst is either the old or the new file, never missing
+	or partly written. Uses java.nio atomic moves under Jython and os.rename elsewhere
+	(atomic on POSIX).
+	'''
+	try:
+		from java.nio.file import (Files, Paths, StandardCopyOption)
+	except ImportError:
+		getattr(os, "replace", os.rename)(src, dst)
+		return
+	Files.move(Paths.get(src), Paths.get(dst), StandardCopyOption.REPLACE_EXISTING, StandardCopyOption.ATOMIC_MOVE)
+
+
+def write_json(data, path, **kwargs):
+	'''
+	Dumps data to path through a temporary file replaced into place, see replace_file.
+	kwargs are passed to json.dump.
+	'''
+	temp_path = "{0}.tmp".format(path)
+	with open(temp_path, "w") as json_file:
+		json.dump(data, json_file, **kwargs)
+		json_file.flush()
+		os.fsync(json_file.fileno())
+	replace_file(temp_path, path)
+
+
+def file_signature(path):
+	'''
+	Returns a dict with the path, size and mtime of a file.
+	'''
+	st = os.stat(path)
+	return {"path": path, "size": st.st_size, "mtime": st.st_mtime}
+
+
+def callable_name(method):
+	'''
+	Returns a stable name for a post processing callable to be stored as a parameter.
+	'''
+	if method is None:
+		return None
+	module = getattr(method, "__module__", None)
+	name = getattr(method, "__name__", repr(method))
+	if module:
+		return "{0}.{1}".format(module, name)
+	return name
+
+
+
+def parameter_value(value):
+	'''
+	Returns a value to be stored as a parameter that compares equal between runs.
+	Primitives are stored as their repr, lists, tuples and dicts item by item, callables by
+	callable_name and other objects by str, as the repr of most Java and Jython objects holds
+	their identity. Objects whose str also holds it still differ between runs.
+	'''
+	if value is None or isinstance(value, (bool, int, long, float, basestring)):
+		return repr(value)
+	if isinstance(value, (list, tuple)):
+		return [parameter_value(item) for item in value]
+	if isinstance(value, dict):
+		return dict([(str(k), parameter_value(v)) for k, v in value.items()])
+	if callable(value):
+		return callable_name(value)
+	return str(value)
+
+
+class Manifest:
+	'''
+	Per output folder record of the inputs (path, size, mtime) and processing parameters
+	that produced each output.
+	A rerun only needs to process outputs that are missing or whose inputs or parameters changed.
+	When shard is given as (index, count) with count > 1 the manifest is saved to a per shard file,
+	so processes sharing the folder do not overwrite each other, while entries already merged into
+	the main manifest are still honoured. See IBPlib.ij.Utils.Sharding.merge_shards.
+	'''
+	def __init__(self, folder, filename=__MANIFEST_FILENAME__, autosave=50, shard=None):
+		self.folder = folder
+		self.main_path = os.path.join(folder, filename)
+		self.path = self.main_path
+		if shard and shard[1] > 1:
+			self.path = shard_filename(self.main_path, shard)
+		self.autosave = autosave
+		self.lock = Lock()
+		self.entries = {}
+		self.unsaved = 0
+		self.load()
+
+
+	def load(self):
+		'''
+		Loads the manifest from the output folder if one exists.
+		'''
+		paths = [self.main_path]
+		if self.path != self.main_path:
+			paths.append(self.path)
+		for path in paths:
+			if not os.path.exists(path):
+				continue
+			with open(path, "r") as manifest_file:
+				self.entries.update(json.load(manifest_file))
+
+
+	def save(self):
+		'''
+		Writes the manifest to the output folder.
+		'''
+		with self.lock:
+			self.__save()
+
+
+	def is_up_to_date(self, output, inputs, params):
+		'''
+		Returns True if output exists and was produced from the same inputs (by path, size and mtime)
+		with the same parameters.
+		'''
+		with self.lock:
+			entry = self.entries.get(output)
+		if not entry or not self.output_exists(output):
+			return False
+		try:
+			signatures = [file_signature(path) for path in inputs]
+		except OSError:
+			return False
+		return entry["inputs"] == signatures and entry["params"] == normalise(params)
+
+
+	def output_exists(self, output):
+		'''
+		Checks output in the folder, also as .tif as ij.io.FileSaver may have updated the extension.
+		'''
+		path = os.path.join(self.folder, output)
+		return os.path.exists(path) or os.path.exists("{0}.tif".format(os.path.splitext(path)[0]))
+
+
+	def record(self, output, inputs, params):
+		'''
+		Records the inputs and parameters of a successfully saved output.
+		The manifest is saved every autosave records and should be saved at the end of a run.
+		'''
+		entry = {"inputs": [file_signature(path) for path in inputs], "params": normalise(params)}
+		with self.lock:
+			self.entries[output] = entry
+			self.unsaved += 1
+			if self.autosave and self.unsaved >= self.autosave:
+				self.__save()
+
+
+	def __save(self):
+		write_json(self.entries, self.path, indent=1, sort_keys=True)
+		self.unsaved = 0
+
+
+def shard_filename(path, shard):
+	'''
+	Returns path with the shard suffix before the extension.
+	e.g. IBPlib_manifest.json -> IBPlib_manifest.shard-0-of-4.json
+	'''
+	root, ext = os.path.splitext(path)
+	return "{0}.shard-{1}-of-{2}{3}".format(root, shard[0], shard[1], ext)
+
+
+def normalise(params):
+	'''
+	Round trips params through json so they compare equal to the stored ones
+	(e.g. int dict keys become strings and tuples become lists).
+	'''
+	return json.loads(json.dumps(params, sort_keys=True))
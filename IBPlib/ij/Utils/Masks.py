@@ -0,0 +1,210 @@
+import os
+import hashlib
+import java.lang.Exception
+
+from collections import OrderedDict
+from threading import (Lock, Event)
+
+from ij import IJ
+
+from IBPlib.ij.Utils.Manifest import Manifest
+
+__version__ = "1.0"
+__MASKS_MANIFEST_FILENAME__ = "IBPlib_masks.json"
+
+
+def extract_channel(imp, channel):
+	'''
+	Returns a copy of channel (1 based) of imp with all its slices and frames, titled like
+	ij.plugin.ChannelSplitter does ("C<channel>-<title>"), without copying the other channels.
+	'''
+	from ij.plugin import Duplicator
+
+	if channel < 1 or channel > imp.getNChannels():
+		raise ValueError("Analysis ch cannot be bigger than total number of channels.")
+	channel_imp = Duplicator().run(imp, channel, channel, 1, imp.getNSlices(), 1, imp.getNFrames())
+	channel_imp.setTitle("C{0}-{1}".format(channel, imp.getTitle()))
+	return channel_imp
+
+
+def threshold(imp, th_method):
+	'''
+	Replaces the processor of imp by the mask of the th_method auto threshold of its current
+	plane (dark background).
+	'''
+	from ij.process import AutoThresholder as at
+
+	ip = imp.getProcessor()
+	ip.setAutoThreshold(at.Method.valueOf(th_method), True)
+	bp = imp.createThresholdMask()
+	imp.setProcessor(bp)
+	return imp
+
+
+def source_path(imp):
+	'''
+	Returns the path imp was opened from, or None.
+	'''
+	fi = imp.getOriginalFileInfo()
+	if fi is None or not fi.fileName:
+		return None
+	return os.path.join(fi.directory or "", fi.fileName)
+
+
+class MaskCache:
+	'''
+	Thresholded analysis channel masks keyed by (image path, mtime, analysis_ch, th_method).
+	A mask is built once, extracting only the analysis channel, and shared by the tracing,
+	profiling and re-profiling stages. The last max_items masks are kept in memory and, when
+	folder is given, masks are also saved there as tifs with a manifest of their sources so
+	later runs skip thresholding (a changed image or parameter builds a new mask).
+	Masks are shared: callers must not modify or close them.
+	e.g.
+		masks = MaskCache(os.path.join(output_folder, "masks"))
+		mask = masks.get(imp, analysis_ch, th_method, path=img)
+	'''
+	def __init__(self, folder=None, max_items=4):
+		self.folder = folder
+		self.max_items = max_items
+		self.lock = Lock()
+		self.masks = OrderedDict()
+		self.building = {} # {key: Event} of the masks being built, so each is only built once.
+		self.hits = 0
+		self.loads = 0
+		self.builds = 0
+		self.manifest = None
+		if folder is not None:
+			if not os.path.exists(folder):
+				os.mkdir(folder)
+			self.manifest = Manifest(folder, filename=__MASKS_MANIFEST_FILENAME__, autosave=1)
+
+
+	def get(self, imp, analysis_ch, th_method, path=None):
+		'''
+		Returns the mask of analysis_ch of imp thresholded with th_method.
+		path is the file imp was opened from, found from imp when not given.
+		Images without a file are masked but not cached.
+		'''
+		path = path or source_path(imp)
+		if path is None or not os.path.exists(path):
+			return self.build(imp, analysis_ch, th_method)
+		key = (os.path.abspath(path), os.path.getmtime(path), analysis_ch, th_method)
+		while True:
+			with self.lock:
+				mask = self.masks.pop(key, None)
+				if mask is not None:
+					self.masks[key] = mask
+					self.hits += 1
+					return mask
+				built = self.building.get(key)
+				if built is None:
+					built = self.building[key] = Event()
+					break
+			built.wait() # Being built by another thread, found in memory (or built here if it failed) on the next pass.
+		try:
+			mask = self.load(key, imp)
+			if mask is None:
+				mask = self.build(imp, analysis_ch, th_method)
+				self.persist(key, mask)
+				with self.lock:
+					self.builds += 1
+			self.put(key, mask)
+		finally:
+			with self.lock:
+				self.building.pop(key).set()
+		return mask
+
+
+	def build(self, imp, channel, method):
+		'''
+		Returns the mask of channel of imp thresholded with method.
+		'''
+		return threshold(extract_channel(imp, channel), method)
+
+
+	def params(self, key):
+		'''
+		Returns the manifest parameters of key.
+		'''
+		return {"analysis_ch": key[2], "th_method": key[3]}
+
+
+	def put(self, key, mask):
+		with self.lock:
+			self.masks[key] = mask
+			while len(self.masks) > self.max_items:
+				self.masks.popitem(last=False)
+
+
+	def filename(self, key):
+		path, mtime, analysis_ch, th_method = key
+		digest = hashlib.md5(path.encode("utf-8")).hexdigest()[:8]
+		return "{0}_{1}_C{2}_{3}.tif".format(os.path.splitext(os.path.basename(path))[0], digest, analysis_ch, th_method)
+
+
+	def load(self, key, imp):
+		'''
+		Returns the persisted mask of key, or None if there is none up to date.
+		'''
+		if self.manifest is None:
+			return None
+		filename = self.filename(key)
+		if not self.manifest.is_up_to_date(filename, [key[0]], self.params(key)):
+			return None
+		mask = IJ.openImage(os.path.join(self.folder, filename))
+		if mask is None:
+			return None
+		mask.setTitle("C{0}-{1}".format(key[2], imp.getTitle()))
+		with self.lock:
+			self.loads += 1
+		return mask
+
+
+	def persist(self, key, mask):
+		from ij.io import FileSaver
+
+		if self.manifest is None:
+			return
+		filename = self.filename(key)
+		title = mask.getTitle()
+		try:
+			if FileSaver(mask).saveAsTiff(os.path.join(self.folder, filename)):
+				self.manifest.record(filename, [key[0]], self.params(key))
+		except (Exception, java.lang.Exception) as e:
+			IJ.log("# Could not save the mask {0}: {1}".format(filename, e))
+		finally:
+			mask.setTitle(title) # FileSaver renames the image after the file.
+
+
+	def stats(self):
+		with self.lock:
+			return {"hits": self.hits, "loads": self.loads, "builds": self.builds, "items": len(self.masks)}
+
+
+	def log_stats(self):
+		s = self.stats()
+		IJ.log("# Masks: {0} built, {1} loaded from disk, {2} memory hits.".format(s["builds"], s["loads"], s["hits"]))
+
+
+class TubenessCache(MaskCache):
+	'''
+	Hessian tubeness images of the tracing channel keyed by (image path, mtime, tracing_ch, sigma),
+	used by SNT as the secondary (cost) image for Hessian guided tracing.
+	Works like MaskCache: get(imp, tracing_ch, sigma, path) builds each image once, with the
+	Fiji features.TubenessProcessor, and saves it in folder when given.
+	sigma is in calibrated units, None meaning the pixel width of the image.
+	'''
+	def build(self, imp, channel, sigma):
+		from features import TubenessProcessor
+
+		channel_imp = extract_channel(imp, channel)
+		if sigma is None:
+			sigma = channel_imp.getCalibration().pixelWidth
+		tubeness = TubenessProcessor(sigma, True).generateImage(channel_imp)
+		tubeness.setTitle(channel_imp.getTitle())
+		tubeness.setCalibration(channel_imp.getCalibration())
+		return tubeness
+
+
+	def params(self, key):
+		return {"tracing_ch": key[2], "sigma": key[3]}
@@ -0,0 +1,250 @@
+import os
+import time
+import tempfile
+import jarray
+import java.lang.Exception
+
+from ij import (IJ, ImagePlus, ImageStack, CompositeImage)
+
+__version__ = "1.0"
+
+COMPRESSIONS = {"none": "Uncompressed", "lzw": "LZW", "zlib": "zlib", "zstd": "zstd"} # Names accepted by OutputWriter.
+FLOAT_POLICIES = ("keep", "clip", "scale")
+BIGTIFF_THRESHOLD = (1 << 32) - (1 << 26) # Leave room for the IFDs and the OME-XML header.
+
+
+def available_compressions():
+	'''
+	Returns the OutputWriter compression names supported by the installed Bio-Formats TiffWriter.
+	'''
+	from loci.formats.out import OMETiffWriter
+
+	types = [t.lower() for t in OMETiffWriter().getCompressionTypes()]
+	return [name for name, bf_name in sorted(COMPRESSIONS.items()) if bf_name.lower() in types]
+
+
+def to_16bit(imp, policy="clip"):
+	'''
+	Returns a 16-bit copy of a 32-bit imp following policy:
+	"clip" rounds the values and clips them to [0, 65535], which keeps the values of avg and sd
+	projections of 16-bit data as they are.
+	"scale" maps the stack min and max to [0, 65535] and stores value = offset + slope * pixel
+	as the calibration function.
+	"keep" returns imp unchanged, as do images that are not 32-bit.
+	'''
+	from ij.measure import Calibration
+	from ij.process import StackStatistics
+
+	if policy not in FLOAT_POLICIES:
+		raise ValueError("Unknown float policy {0}. Use one of {1}.".format(policy, FLOAT_POLICIES))
+	if policy == "keep" or imp.getBitDepth() != 32:
+		return imp
+	offset, slope = 0.0, 1.0
+	if policy == "scale":
+		stats = StackStatistics(imp)
+		offset = stats.min
+		if stats.max > stats.min:
+			slope = (stats.max - stats.min) / 65535.0
+	source = imp.getStack()
+	stack = ImageStack(imp.getWidth(), imp.getHeight())
+	for i in range(1, source.getSize() + 1):
+		fp = source.getProcessor(i)
+		if policy == "scale":
+			fp = fp.duplicate()
+			fp.subtract(offset)
+			fp.multiply(1.0 / slope)
+		stack.addSlice(source.getSliceLabel(i), fp.convertToShortProcessor(False))
+	converted = ImagePlus(imp.getTitle(), stack)
+	converted.setDimensions(imp.getNChannels(), imp.getNSlices(), imp.getNFrames())
+	cal = imp.getCalibration().copy()
+	if policy == "scale":
+		cal.setFunction(Calibration.STRAIGHT_LINE, [offset, slope], "Gray Value")
+	converted.setCalibration(cal)
+	if imp.isComposite():
+		converted = CompositeImage(converted, imp.getMode())
+		converted.setLuts(imp.getLuts())
+	return converted
+
+
+class OutputWriter:
+	'''
+	Writes images as OME-TIFF with Bio-Formats, with compression, tiles and BigTIFF.
+	compression is one of COMPRESSIONS ("zstd" only where the installed Bio-Formats supports it).
+	tile is a (width, height) tuple, multiples of 16, or None for strips.
+	bigtiff is True, False or "auto" to switch to BigTIFF for files that may not fit in 4 GB.
+	float_policy converts 32-bit results (avg, sum and sd projections) to 16-bit, see to_16bit.
+	Files are written with the .tif extension like ij.io.FileSaver.saveAsTiff does.
+	An instance holds no state while writing, so it can be shared between threads.
+	'''
+	def __init__(self, compression="lzw", tile=None, bigtiff="auto", float_policy="keep"):
+		if compression not in COMPRESSIONS:
+			raise ValueError("Unknown compression {0}. Use one of {1}.".format(compression, sorted(COMPRESSIONS)))
+		if float_policy not in FLOAT_POLICIES:
+			raise ValueError("Unknown float policy {0}. Use one of {1}.".format(float_policy, FLOAT_POLICIES))
+		self.compression = compression
+		self.tile = tile
+		self.bigtiff = bigtiff
+		self.float_policy = float_policy
+
+
+	def settings(self):
+		return {"compression": self.compression, "tile": self.tile, "bigtiff": self.bigtiff,
+			"float_policy": self.float_policy}
+
+
+	def write(self, imp, path):
+		'''
+		Writes imp to path (with the .tif extension) and returns the path written.
+		'''
+		from ij.measure import Calibration
+		from loci.formats import (MetadataTools, FormatTools)
+		from loci.formats.out import OMETiffWriter
+
+		imp = to_16bit(imp, self.float_policy)
+		path = "{0}.tif".format(os.path.splitext(path)[0])
+		if os.path.exists(path):
+			os.remove(path)
+		rgb = imp.getBitDepth() == 24
+		pixel_types = {8: FormatTools.UINT8, 16: FormatTools.UINT16, 24: FormatTools.UINT8, 32: FormatTools.FLOAT}
+		n_channels, n_slices, n_frames = imp.getNChannels(), imp.getNSlices(), imp.getNFrames()
+		samples = 3 if rgb else 1
+		meta = MetadataTools.createOMEXMLMetadata()
+		MetadataTools.populateMetadata(meta, 0, imp.getTitle(), False, "XYCZT",
+			FormatTools.getPixelTypeString(pixel_types[imp.getBitDepth()]), imp.getWidth(), imp.getHeight(),
+			n_slices, n_channels * samples, n_frames, samples)
+		self.set_physical_sizes(meta, imp.getCalibration())
+		cal = imp.getCalibration()
+		if cal.getFunction() == Calibration.STRAIGHT_LINE:
+			offset, slope = cal.getCoefficients()[:2]
+			meta.setImageDescription("IBPlib: value = {0!r} + {1!r} * pixel".format(offset, slope), 0)
+
+		writer = OMETiffWriter()
+		writer.setMetadataRetrieve(meta)
+		writer.setCompression(self.compression_type(writer))
+		writer.setInterleaved(False)
+		writer.setWriteSequentially(True)
+		if self.bigtiff is True or (self.bigtiff == "auto" and self.estimate_size(imp) > BIGTIFF_THRESHOLD):
+			writer.setBigTiff(True)
+		writer.setId(path)
+		try:
+			if self.tile:
+				writer.setTileSizeX(self.tile[0])
+				writer.setTileSizeY(self.tile[1])
+			stack = imp.getStack()
+			for i in range(stack.getSize()):
+				writer.saveBytes(i, plane_bytes(stack.getProcessor(i + 1)))
+		finally:
+			writer.close()
+		return path
+
+
+	def estimate_size(self, imp):
+		return imp.getWidth() * imp.getHeight() * imp.getStackSize() * imp.getBytesPerPixel()
+
+
+	def compression_type(self, writer):
+		'''
+		Returns the Bio-Formats compression type name, raising ValueError if it is not available.
+		'''
+		types = list(writer.getCompressionTypes())
+		for bf_name in types:
+			if bf_name.lower() == COMPRESSIONS[self.compression].lower():
+				return bf_name
+		raise ValueError("{0} compression is not available in this Bio-Formats. Available: {1}"
+			.format(self.compression, types))
+
+
+	def set_physical_sizes(self, meta, cal):
+		'''
+		Stores the pixel size of cal in meta when its unit is microns.
+		'''
+		from ome.units import UNITS
+		from loci.formats import FormatTools
+
+		if cal.getUnit() not in ("micron", "microns", "um", u"\u00b5m"):
+			return
+		for setter, value in ((meta.setPixelsPhysicalSizeX, cal.pixelWidth),
+			(meta.setPixelsPhysicalSizeY, cal.pixelHeight), (meta.setPixelsPhysicalSizeZ, cal.pixelDepth)):
+			length = FormatTools.createLength(value, UNITS.MICROMETER)
+			if length is not None:
+				setter(length, 0)
+
+
+def plane_bytes(ip):
+	'''
+	Returns the pixels of ip as big endian bytes, RGB split in planar R, G and B samples.
+	'''
+	from java.lang import System
+	from loci.common import DataTools
+
+	bitdepth = ip.getBitDepth()
+	if bitdepth == 8:
+		return ip.getPixels()
+	if bitdepth == 16:
+		return DataTools.shortsToBytes(ip.getPixels(), False)
+	if bitdepth == 32:
+		return DataTools.floatsToBytes(ip.getPixels(), False)
+	n = ip.getPixelCount()
+	r, g, b = [jarray.zeros(n, "b") for i in range(3)]
+	ip.getRGB(r, g, b)
+	plane = jarray.zeros(3 * n, "b")
+	for i, samples in enumerate((r, g, b)):
+		System.arraycopy(samples, 0, plane, i * n, n)
+	return plane
+
+
+def save(imp, path, output=None):
+	'''
+	Saves imp to path with output (an OutputWriter), or with ij.io.FileSaver.saveAsTiff if None.
+	Returns True if saved, like ij.io.FileSaver.
+	'''
+	from ij.io import FileSaver
+
+	if output is None:
+		return FileSaver(imp).saveAsTiff(path)
+	output.write(imp, path)
+	return True
+
+
+def benchmark_output(imp, settings=None, folder=None):
+	'''
+	Writes imp with each of settings (a list of OutputWriter keyword dicts) and logs the
+	write throughput and file size of each against uncompressed ij.io.FileSaver.
+	Returns a list of dicts with the settings, seconds, bytes and MB/s.
+	'''
+	if settings is None:
+		settings = [{"compression": c} for c in available_compressions()]
+		settings.append({"compression": "lzw", "tile": (512, 512)})
+		if imp.getBitDepth() == 32:
+			settings.append({"compression": "lzw", "float_policy": "clip"})
+	temporary = folder is None
+	if temporary:
+		folder = tempfile.mkdtemp(prefix="IBPlib_output_")
+	raw = imp.getWidth() * imp.getHeight() * imp.getStackSize() * imp.getBytesPerPixel()
+	results = []
+	for i, kwargs in enumerate([None] + list(settings)):
+		path = os.path.join(folder, "benchmark_{0}.tif".format(i))
+		start = time.time()
+		try:
+			if kwargs is None:
+				save(imp, path)
+			else:
+				path = OutputWriter(**kwargs).write(imp, path)
+		except (Exception, java.lang.Exception) as e:
+			IJ.log("# {0} failed: {1}".format(kwargs, e))
+			continue
+		elapsed = time.time() - start
+		size = os.path.getsize(path)
+		os.remove(path)
+		result = {"settings": kwargs or {"writer": "FileSaver"}, "seconds": elapsed, "bytes": size,
+			"throughput": raw / elapsed / (1 << 20) if elapsed else 0.0}
+		results.append(result)
+		IJ.log("# {0}: {1:.2f}s, {2:.1f} MB/s, {3:.1f} MB ({4:.0%} of raw)".format(result["settings"],
+			elapsed, result["throughput"], size / float(1 << 20), size / float(raw)))
+	if temporary:
+		os.rmdir(folder)
+	return results
+
+
+if __name__ in ("__builtin__", "__main__"):
+	benchmark_output(IJ.getImage())
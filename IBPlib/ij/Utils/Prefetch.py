@@ -0,0 +1,152 @@
+import time
+import traceback
+import java.lang.Exception
+
+from threading import (Thread, Condition)
+
+from ij import IJ
+
+from IBPlib.ij.Utils.Files import (imageloader, imagesize)
+
+__version__ = "1.0"
+__threadname__ = "IBPlib.ij.Prefetcher"
+
+
+class Prefetcher:
+	'''
+	Opens the images of paths ahead of their use on a background thread, in order, so the
+	next image is ready when the current one is done (e.g. while the user traces in batch_run).
+	At most depth images are held ready and no more are opened while the ready images hold
+	budget bytes or more (a quarter of the JVM max heap by default).
+	prepare(path, imp) is run on the background thread after opening each image
+	(e.g. building its mask in a MaskCache).
+	Images requested out of order, or not prefetched yet, are opened by the caller.
+	Errors are raised by get for the image that failed.
+	e.g.
+		prefetcher = Prefetcher(paths, depth=1)
+		try:
+			for path in paths:
+				imp = prefetcher.get(path)
+		finally:
+			prefetcher.close()
+	'''
+	def __init__(self, paths, depth=1, budget=None, heap_fraction=0.25, loader=imageloader, prepare=None):
+		from java.lang import Runtime
+
+		if budget is None:
+			budget = int(Runtime.getRuntime().maxMemory() * heap_fraction)
+		self.paths = list(paths)
+		self.order = {}
+		for i, path in enumerate(self.paths):
+			self.order.setdefault(path, i)
+		self.depth = depth
+		self.budget = budget
+		self.loader = loader
+		self.prepare = prepare
+		self.condition = Condition()
+		self.ready = {} # {path: (imp, error, bytes)}
+		self.held = 0
+		self.position = 0
+		self.loading = None
+		self.closed = False
+		self.hits = 0
+		self.waits = 0
+		self.misses = 0
+		self.waited = 0.0
+		self.thread = None
+		if depth > 0:
+			self.thread = Thread(target=self.work, name=__threadname__)
+			self.thread.setDaemon(True)
+			self.thread.start()
+
+
+	def work(self):
+		while True:
+			with self.condition:
+				while not self.closed and self.position < len(self.paths) and (len(self.ready) >= self.depth
+					or (self.ready and self.held >= self.budget)):
+					self.condition.wait()
+				if self.closed or self.position >= len(self.paths):
+					return
+				path = self.paths[self.position]
+				self.position += 1
+				self.loading = path
+			imp, error = None, None
+			try:
+				imp = self.loader(path)
+				if self.prepare is not None:
+					self.prepare(path, imp)
+			except (Exception, java.lang.Exception) as e:
+				IJ.log("# Prefetching {0} failed.\n{1}".format(path, traceback.format_exc()))
+				error = e
+			with self.condition:
+				self.loading = None
+				if self.closed:
+					if imp is not None:
+						imp.close()
+					self.condition.notifyAll()
+					return
+				nbytes = imagesize(imp) if imp is not None else 0
+				self.ready[path] = (imp, error, nbytes)
+				self.held += nbytes
+				self.condition.notifyAll()
+
+
+	def get(self, path):
+		'''
+		Returns the image of path, waiting for it if it is being prefetched.
+		Images prefetched before path in paths are dropped.
+		'''
+		start = time.time()
+		with self.condition:
+			index = self.order.get(path)
+			if index is not None and self.position <= index:
+				self.position = index + 1 # Opened below by the caller, the background thread skips it.
+			while path not in self.ready and self.loading == path:
+				self.condition.wait()
+			entry = self.ready.pop(path, None)
+			if entry is not None:
+				self.held -= entry[2]
+			if index is not None:
+				for stale in [p for p in self.ready if self.order[p] < index]:
+					stale_entry = self.ready.pop(stale)
+					self.held -= stale_entry[2]
+					if stale_entry[0] is not None:
+						stale_entry[0].close()
+			self.condition.notifyAll()
+		waited = time.time() - start
+		if entry is None:
+			self.misses += 1
+			return self.loader(path)
+		if waited > 0.05:
+			self.waits += 1
+			self.waited += waited
+		else:
+			self.hits += 1
+		if entry[1] is not None:
+			raise entry[1]
+		return entry[0]
+
+
+	def close(self):
+		'''
+		Stops prefetching and closes the images that were not requested.
+		'''
+		with self.condition:
+			self.closed = True
+			for imp, error, nbytes in self.ready.values():
+				if imp is not None:
+					imp.close()
+			self.ready.clear()
+			self.held = 0
+			self.condition.notifyAll()
+
+
+	def stats(self):
+		return {"hits": self.hits, "waits": self.waits, "misses": self.misses, "waited": self.waited}
+
+
+	def log_stats(self):
+		s = self.stats()
+		IJ.log("# Prefetcher: {0} ready, {1} waited ({2:.1f}s), {3} opened on demand.".format(s["hits"],
+			s["waits"], s["waited"], s["misses"]))
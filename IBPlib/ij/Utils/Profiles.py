@@ -0,0 +1,333 @@
+import os
+import sys
+import csv
+import json
+import struct
+import array
+import java.lang.Exception
+import traceback
+
+from threading import (Thread, Lock)
+from Queue import (Queue, Empty)
+
+from ij import (IJ, ImagePlus)
+from ij.gui import ProfilePlot
+
+__version__ = "1.0"
+__threadname__ = "IBPlib.ij.Profiles" # Threads spawned by profiles have this name + index.
+
+PROFILE_COLUMNS = ("image", "roi", "stroke_width", "th_method", "position", "value") # Long format columns.
+BINARY_EXTENSION = ".ibpprof"
+BINARY_MAGIC = "IBPPROF1"
+
+
+def profile(imp, roi):
+	'''
+	Returns the ProfilePlot profile of roi on the current plane of imp, line width included,
+	without going through the RoiManager or changing the roi of imp.
+	roi is set on a bare ImagePlus that shares the processor of imp (no pixels are copied),
+	so the values are exactly the ones ij.gui.ProfilePlot gives and the call is safe from
+	worker threads and headless.
+	'''
+	wrapper = ImagePlus(imp.getTitle(), imp.getProcessor())
+	wrapper.setCalibration(imp.getCalibration())
+	wrapper.setRoi(roi, False)
+	return ProfilePlot(wrapper).getProfile()
+
+
+def profiles(imp, rois, threads=None):
+	'''
+	Returns the profiles of all rois on imp, in the order of rois, computed on threads threads
+	(the core count by default). A roi whose profile fails gets None and the error is logged.
+	'''
+	from java.lang import Runtime
+
+	rois = list(rois)
+	results = [None] * len(rois)
+	if threads is None:
+		threads = Runtime.getRuntime().availableProcessors()
+	threads = max(1, min(threads, len(rois)))
+	if threads == 1:
+		for i, roi in enumerate(rois):
+			results[i] = safe_profile(imp, roi)
+		return results
+
+	tasks_q = Queue()
+	for task in enumerate(rois):
+		tasks_q.put(task)
+
+	def worker():
+		while not tasks_q.empty():
+			try:
+				i, roi = tasks_q.get(block=False)
+			except Empty:
+				break
+			results[i] = safe_profile(imp, roi)
+
+	workers = [Thread(target=worker, name="{0}.{1}".format(__threadname__, i)) for i in range(threads)]
+	[t.start() for t in workers]
+	[t.join() for t in workers]
+	return results
+
+
+def safe_profile(imp, roi):
+	try:
+		return profile(imp, roi)
+	except (Exception, java.lang.Exception):
+		IJ.log("# Profile of {0} failed.\n{1}".format(roi.getName(), traceback.format_exc()))
+		return None
+
+
+class ProfileWriter:
+	'''
+	Writes the profiles of a whole batch to a single file instead of one csv per roi.
+	Files ending with BINARY_EXTENSION are written in the binary columnar format, anything else
+	as a long format csv with the PROFILE_COLUMNS columns (one row per profile point).
+	Rows are buffered and written buffer_rows at a time. add can be called from several threads.
+	With append, an existing file is continued (a binary file is reopened before its footer) and
+	profiles of an (image, roi) already in it are skipped, so resuming a batch does not duplicate them.
+	typecode is the array typecode of binary values, "f" (float32) or "d" (float64).
+	The binary format is the magic, all the values as big endian typecode numbers, a JSON footer
+	with the typecode and a [image, roi, stroke_width, th_method, offset, length] entry per profile
+	and the footer length as an unsigned 64 bit integer. See read_profiles.
+	flush writes the footer too, so a binary file is readable and can be appended to after a crash
+	up to the last flush. The footer is overwritten by the next values written.
+	e.g.
+		with ProfileWriter(os.path.join(csvs_folder, "profiles.csv")) as writer:
+			writer.add(title, roi.getName(), stroke_width, th_method, profile(imp, roi))
+	'''
+	def __init__(self, path, append=False, buffer_rows=65536, typecode="f"):
+		self.path = path
+		self.binary = path.lower().endswith(BINARY_EXTENSION)
+		self.buffer_rows = buffer_rows
+		self.lock = Lock()
+		self.pending = []
+		self.pending_count = 0
+		self.count = 0
+		self.stored = set() # (image, roi) of the profiles already in an appended file.
+		exists = append and os.path.isfile(path) and os.path.getsize(path) > 0
+		if self.binary:
+			self.entries = []
+			self.typecode = typecode
+			self.offset = 0
+			self.footer_written = False
+			if exists and os.path.getsize(path) > len(BINARY_MAGIC):
+				header = read_binary_footer(path)
+				self.entries = header["profiles"]
+				self.typecode = header["typecode"]
+				self.offset = sum([entry[5] for entry in self.entries])
+				self.stored = set([(entry[0], entry[1]) for entry in self.entries])
+				self.values_end = header["values_end"]
+				self.footer_written = True # Kept until new values are written over it.
+				self.file = open(path, "r+b")
+			else:
+				self.file = open(path, "wb")
+				self.file.write(BINARY_MAGIC)
+				self.values_end = len(BINARY_MAGIC)
+		else:
+			if exists:
+				self.stored = read_csv_keys(path)
+			self.file = open(path, "ab" if exists else "wb", 1 << 20)
+			self.writer = csv.writer(self.file)
+			if not exists:
+				self.writer.writerow(PROFILE_COLUMNS)
+			elif not ends_with_newline(path):
+				self.file.write("\r\n") # Closes a row truncated by a crash.
+
+
+	def add(self, image, roi, stroke_width, th_method, values):
+		'''
+		Adds the profile values of roi on image, flushing the buffer when it is full.
+		Profiles already in an appended file are skipped.
+		'''
+		values = list(values)
+		with self.lock:
+			if (image, roi) in self.stored:
+				return
+			self.pending.append((image, roi, stroke_width, th_method, values))
+			self.pending_count += len(values)
+			self.count += 1
+			if self.pending_count >= self.buffer_rows:
+				self.write_pending()
+
+
+	def flush(self):
+		'''
+		Writes the buffered profiles, and the footer of binary files, to disk.
+		'''
+		with self.lock:
+			self.write_pending()
+			if self.binary and not self.footer_written:
+				self.write_footer()
+			self.file.flush()
+			os.fsync(self.file.fileno())
+
+
+	def write_pending(self):
+		if not self.pending:
+			return
+		if self.binary:
+			self.file.seek(self.values_end) # Values go over the footer, if one was written.
+			if self.footer_written:
+				self.file.truncate()
+				self.footer_written = False
+		for image, roi, stroke_width, th_method, values in self.pending:
+			if self.binary:
+				self.entries.append([image, roi, stroke_width, th_method, self.offset, len(values)])
+				self.offset += len(values)
+				self.file.write(big_endian(array.array(self.typecode, values)).tostring())
+			else:
+				self.writer.writerows([(image, roi, stroke_width, th_method, i, value)
+					for i, value in enumerate(values)])
+		if self.binary:
+			self.values_end = self.file.tell()
+		self.pending = []
+		self.pending_count = 0
+
+
+	def write_footer(self):
+		footer = json.dumps({"columns": PROFILE_COLUMNS, "typecode": self.typecode, "profiles": self.entries})
+		self.file.seek(self.values_end)
+		self.file.write(footer)
+		self.file.write(struct.pack(">Q", len(footer)))
+		self.footer_written = True
+
+
+	def close(self):
+		'''
+		Writes the buffered profiles (and the footer of binary files) and closes the file.
+		'''
+		with self.lock:
+			if self.file.closed:
+				return
+			self.write_pending()
+			if self.binary and not self.footer_written:
+				self.write_footer()
+			self.file.close()
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.close()
+
+
+class ProfileBuffer:
+	'''
+	Collects profiles with the ProfileWriter.add signature to add them to a writer later,
+	e.g. to write the profiles of images profiled in parallel in a deterministic order.
+	'''
+	def __init__(self):
+		self.rows = []
+
+
+	def add(self, image, roi, stroke_width, th_method, values):
+		self.rows.append((image, roi, stroke_width, th_method, values))
+
+
+	def add_to(self, writer):
+		for row in self.rows:
+			writer.add(*row)
+
+
+def read_csv_keys(path):
+	'''
+	Returns the set of (image, roi) of the profiles in a long format csv.
+	'''
+	with open(path, "rb") as f:
+		reader = csv.reader(f)
+		next(reader, None)
+		return set([(row[0], row[1]) for row in reader if len(row) >= 2])
+
+
+def ends_with_newline(path):
+	with open(path, "rb") as f:
+		f.seek(-1, os.SEEK_END)
+		return f.read(1) == b"\n"
+
+
+def big_endian(values):
+	if sys.byteorder == "little":
+		values.byteswap()
+	return values
+
+
+def read_binary_footer(path):
+	'''
+	Returns the footer of a binary profiles file with the offset where its values end.
+	Raises ValueError if the file has no valid footer, e.g. when its writer was interrupted
+	before flushing or closing it.
+	'''
+	invalid = ("{0} has no valid footer: its writer was interrupted before flushing or closing it. "
+		"Move it away to start a new file.").format(path)
+	with open(path, "rb") as f:
+		if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+			raise ValueError("{0} is not an IBPlib binary profiles file.".format(path))
+		f.seek(0, os.SEEK_END)
+		if f.tell() < len(BINARY_MAGIC) + 8:
+			raise ValueError(invalid)
+		f.seek(-8, os.SEEK_END)
+		end = f.tell()
+		length = struct.unpack(">Q", f.read(8))[0]
+		if length > end - len(BINARY_MAGIC):
+			raise ValueError(invalid)
+		f.seek(end - length)
+		try:
+			header = json.loads(f.read(length))
+		except ValueError:
+			raise ValueError(invalid)
+	if not isinstance(header, dict) or "profiles" not in header or "typecode" not in header:
+		raise ValueError(invalid)
+	header["values_end"] = end - length
+	return header
+
+
+def read_profiles(path, by_roi=False):
+	'''
+	Loads a file written by ProfileWriter in one call.
+	Returns a dict of PROFILE_COLUMNS lists (long format), or if by_roi a list of dicts with the
+	image, roi, stroke_width, th_method and the values of each profile.
+	'''
+	if path.lower().endswith(BINARY_EXTENSION):
+		header = read_binary_footer(path)
+		values = array.array(header["typecode"])
+		with open(path, "rb") as f:
+			f.seek(len(BINARY_MAGIC))
+			values.fromstring(f.read(header["values_end"] - len(BINARY_MAGIC)))
+		big_endian(values)
+		profiles = [{"image": image, "roi": roi, "stroke_width": stroke_width, "th_method": th_method,
+			"values": values[offset:offset + length].tolist()}
+			for image, roi, stroke_width, th_method, offset, length in header["profiles"]]
+	else:
+		profiles = []
+		with open(path, "rb") as f:
+			reader = csv.reader(f)
+			next(reader)
+			for image, roi, stroke_width, th_method, position, value in reader:
+				if not profiles or (profiles[-1]["image"], profiles[-1]["roi"]) != (image, roi) or position == "0":
+					profiles.append({"image": image, "roi": roi, "stroke_width": float(stroke_width),
+						"th_method": th_method, "values": []})
+				profiles[-1]["values"].append(float(value))
+	if by_roi:
+		return profiles
+	columns = dict([(column, []) for column in PROFILE_COLUMNS])
+	for p in profiles:
+		n = len(p["values"])
+		for column in ("image", "roi", "stroke_width", "th_method"):
+			columns[column].extend([p[column]] * n)
+		columns["position"].extend(range(n))
+		columns["value"].extend(p["values"])
+	return columns
+
+
+if __name__ in ("__builtin__", "__main__"):
+	import time
+	from ij.plugin.frame import RoiManager
+
+	imp = IJ.getImage()
+	rois = RoiManager.getRoiManager().getRoisAsArray()
+	start = time.time()
+	results = profiles(imp, rois)
+	IJ.log("# {0} profiles in {1:.3f}s".format(len(results), time.time() - start))
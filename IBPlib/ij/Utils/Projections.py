@@ -0,0 +1,363 @@
+import os.path
+import time
+import java.lang.Exception
+
+from threading import Thread
+from Queue import (Queue, Empty)
+
+from ij import (ImagePlus, ImageStack, CompositeImage)
+from ij.process import Blitter
+
+from IBPlib.ij.Utils import Readers
+
+__version__ = "1.1"
+__threadname__ = "IBPlib.ij.Projections" # Threads spawned by band_projection have this name + index.
+
+STREAMING_METHODS = ("max", "min", "sum", "avg", "sd") # ij.plugin.ZProjector method names that can be folded plane by plane.
+METHODS = STREAMING_METHODS + ("median",)
+TITLE_PREFIXES = {"max": "MAX", "min": "MIN", "sum": "SUM", "avg": "AVG", "sd": "STD", "median": "MED"} # As used by ij.plugin.ZProjector.
+
+
+def validate_methods(methods, streaming=False):
+	'''
+	Validates projection method names against the ones supported.
+	'''
+	supported = STREAMING_METHODS if streaming else METHODS
+	for method in methods:
+		if method not in supported:
+			raise ValueError("{0} projections are not supported{1}. Use one of {2}."
+				.format(method, " when streaming" if streaming else "", supported))
+
+
+class PlaneAccumulator:
+	'''
+	Folds the planes of one channel and timepoint into one or more projections, one plane at a time.
+	Memory is one output plane per statistic no matter how many planes are added, and all the
+	requested statistics are computed from the same traversal.
+	Results follow ij.plugin.ZProjector: max and min keep the bit depth, sum, avg and sd are 32-bit.
+	The standard deviation (n-1 normalised) uses Welford's running mean and sum of squared
+	differences, applied plane-wise, so it does not lose precision on bright stacks.
+	'''
+	def __init__(self, methods):
+		if isinstance(methods, basestring):
+			methods = [methods]
+		validate_methods(methods, streaming=True)
+		self.methods = list(methods)
+		self.max = None
+		self.min = None
+		self.sum = None
+		self.mean = None
+		self.m2 = None
+		self.count = 0
+
+
+	def add(self, ip):
+		if "max" in self.methods:
+			self.max = fold(self.max, ip, Blitter.MAX)
+		if "min" in self.methods:
+			self.min = fold(self.min, ip, Blitter.MIN)
+		self.count += 1
+		if not [method for method in self.methods if method in ("sum", "avg", "sd")]:
+			return
+		fp = to_float(ip)
+		if "sum" in self.methods or "avg" in self.methods:
+			self.sum = fold(self.sum, fp, Blitter.ADD)
+		if "sd" in self.methods:
+			self.__welford(fp)
+
+
+	def results(self):
+		'''
+		Returns a dict {method: ImageProcessor}.
+		'''
+		results = {}
+		for method in self.methods:
+			if method in ("max", "min"):
+				results[method] = getattr(self, method)
+			elif method == "sum":
+				results[method] = self.sum.duplicate() if "avg" in self.methods else self.sum
+			elif method == "avg":
+				avg = self.sum
+				if "sum" in self.methods:
+					avg = self.sum.duplicate()
+				avg.multiply(1.0 / self.count)
+				results[method] = avg
+			elif method == "sd":
+				sd = self.m2.duplicate()
+				if self.count > 1:
+					sd.multiply(1.0 / (self.count - 1))
+					sd.sqrt()
+				else:
+					sd.set(0)
+				results[method] = sd
+		return results
+
+
+	def result(self):
+		'''
+		Returns the ImageProcessor of the first method.
+		'''
+		return self.results()[self.methods[0]]
+
+
+	def __welford(self, fp):
+		if self.mean is None:
+			self.mean = fp.duplicate()
+			self.m2 = fp.createProcessor(fp.getWidth(), fp.getHeight())
+			return
+		delta = fp.duplicate()
+		delta.copyBits(self.mean, 0, 0, Blitter.SUBTRACT)	# x - mean(n-1)
+		step = delta.duplicate()
+		step.multiply(1.0 / self.count)
+		self.mean.copyBits(step, 0, 0, Blitter.ADD)	# mean(n)
+		fp.copyBits(self.mean, 0, 0, Blitter.SUBTRACT)	# x - mean(n)
+		delta.copyBits(fp, 0, 0, Blitter.MULTIPLY)
+		self.m2.copyBits(delta, 0, 0, Blitter.ADD)
+
+
+def fold(acc, ip, mode):
+	'''
+	Returns acc with ip blitted into it using mode, or a copy of ip if acc is None.
+	'''
+	if acc is None:
+		return ip.duplicate()
+	acc.copyBits(ip, 0, 0, mode)
+	return acc
+
+
+def to_float(ip):
+	'''
+	Returns a 32-bit copy of ip that can be modified without touching ip.
+	'''
+	if ip.getBitDepth() == 32:
+		return ip.duplicate()
+	return ip.convertToFloatProcessor()
+
+
+def open_reader(path, series=0):
+	'''
+	Returns an initialised Bio-Formats ImageProcessorReader for path, splitting RGB planes
+	into channels, and its OME metadata.
+	The reader comes from the pool of IBPlib.ij.Utils.Readers and must be given back with release.
+	'''
+	return Readers.acquire(path, series)
+
+
+def set_calibration(imp, meta, series=0):
+	'''
+	Sets the pixel size of imp from the OME metadata, if present.
+	'''
+	cal = imp.getCalibration()
+	sizex = meta.getPixelsPhysicalSizeX(series)
+	sizey = meta.getPixelsPhysicalSizeY(series)
+	if sizex is not None:
+		cal.pixelWidth = sizex.value()
+		cal.setUnit(sizex.unit().getSymbol())
+	if sizey is not None:
+		cal.pixelHeight = sizey.value()
+
+
+def build_hyperstack(title, planes, n_channels, n_frames):
+	'''
+	Returns an ImagePlus from a {(c, t): ImageProcessor} dict, as a composite if multichannel.
+	'''
+	first = planes[(0, 0)]
+	stack = ImageStack(first.getWidth(), first.getHeight())
+	for t in range(n_frames):
+		for c in range(n_channels):
+			stack.addSlice(planes[(c, t)])
+	imp = ImagePlus(title, stack)
+	imp.setDimensions(n_channels, 1, n_frames)
+	if n_channels > 1:
+		imp = CompositeImage(imp, CompositeImage.COMPOSITE)
+	imp.setOpenAsHyperStack(True)
+	return imp
+
+
+def stream_projections(path, methods, series=0):
+	'''
+	Projects the image in path along Z reading one plane at a time from Bio-Formats.
+	Keeps one accumulator per channel and timepoint, so peak memory is bounded by the
+	size of the projections and not by the size of the stack, and every requested
+	method is computed from a single read of the file.
+	Returns a dict {method: ImagePlus} titled like ij.plugin.ZProjector does.
+	'''
+	validate_methods(methods, streaming=True)
+	reader, meta = open_reader(path, series)
+	try:
+		n_channels = reader.getEffectiveSizeC()
+		n_frames = reader.getSizeT()
+		accumulators = {}
+		for c in range(n_channels):
+			for t in range(n_frames):
+				accumulators[(c, t)] = PlaneAccumulator(methods)
+		for i in range(reader.getImageCount()):
+			z, c, t = reader.getZCTCoords(i)
+			accumulators[(c, t)].add(reader.openProcessors(i)[0])
+	finally:
+		Readers.release(reader)
+
+	results = dict([(key, acc.results()) for key, acc in accumulators.items()])
+	projections = {}
+	for method in methods:
+		planes = dict([(key, result[method]) for key, result in results.items()])
+		title = "{0}_{1}".format(TITLE_PREFIXES[method], os.path.basename(path))
+		projections[method] = build_hyperstack(title, planes, n_channels, n_frames)
+		set_calibration(projections[method], meta, series)
+	return projections
+
+
+def stream_projection(path, method, series=0):
+	'''
+	Streaming projection of the image in path with a single method. See stream_projections.
+	'''
+	return stream_projections(path, [method], series)[method]
+
+
+def project_stack(imp, methods):
+	'''
+	Computes every requested projection of an image already in memory in a single traversal
+	of its planes. The median is not foldable and is computed by ij.plugin.ZProjector.
+	Returns a dict {method: ImagePlus}.
+	'''
+	from ij.plugin import ZProjector
+
+	validate_methods(methods)
+	foldable = [method for method in methods if method != "median"]
+	projections = {}
+	if foldable:
+		n_channels, n_frames = imp.getNChannels(), imp.getNFrames()
+		accumulators = {}
+		for c in range(n_channels):
+			for t in range(n_frames):
+				accumulators[(c, t)] = PlaneAccumulator(foldable)
+		stack = imp.getStack()
+		for n in range(1, stack.getSize() + 1):
+			c, z, t = imp.convertIndexToPosition(n)
+			accumulators[(c - 1, t - 1)].add(stack.getProcessor(n))
+		results = dict([(key, acc.results()) for key, acc in accumulators.items()])
+		for method in foldable:
+			planes = dict([(key, result[method]) for key, result in results.items()])
+			title = "{0}_{1}".format(TITLE_PREFIXES[method], imp.getTitle())
+			projection = build_hyperstack(title, planes, n_channels, n_frames)
+			projection.setCalibration(imp.getCalibration())
+			if n_channels > 1 and imp.isComposite():
+				projection.setMode(imp.getMode())
+				projection.setLuts(imp.getLuts())
+			projections[method] = projection
+	if "median" in methods:
+		projections["median"] = ZProjector.run(imp, "median")
+	return projections
+
+
+def band_projection(imp, method, threads=None, bands=None):
+	'''
+	Projects imp along Z splitting its XY plane into row bands that are projected in parallel
+	by ij.plugin.ZProjector on a pool of threads, then stitched back together.
+	Every pixel is still computed by ZProjector from the same values in the same order, so the
+	result is identical to ZProjector.run(imp, method) for every method.
+	By default uses one thread per core and 4 bands per thread, holding at most threads bands
+	of the stack in memory on top of the stack itself.
+	'''
+	from java.lang import Runtime
+	from ij.plugin import ZProjector
+
+	if threads is None:
+		threads = Runtime.getRuntime().availableProcessors()
+	width, height = imp.getWidth(), imp.getHeight()
+	n_bands = max(1, min(height, bands or threads * 4))
+	edges = [height * i // n_bands for i in range(n_bands + 1)]
+	stack = imp.getStack()
+	results = [None] * n_bands
+	errors = []
+	tasks_q = Queue()
+	for i in range(n_bands):
+		tasks_q.put(i)
+
+	def project_bands():
+		while True:
+			try:
+				i = tasks_q.get(block=False)
+			except Empty:
+				break
+			try:
+				y0, y1 = edges[i], edges[i + 1]
+				band = ImagePlus(imp.getTitle(), stack.crop(0, y0, 0, width, y1 - y0, stack.getSize()))
+				band.setDimensions(imp.getNChannels(), imp.getNSlices(), imp.getNFrames())
+				band.setOpenAsHyperStack(imp.isHyperStack())
+				band.setCalibration(imp.getCalibration().copy())
+				results[i] = ZProjector.run(band, method)
+			except (Exception, java.lang.Exception) as e:
+				errors.append(e)
+
+	workers = [Thread(target=project_bands, name="{0}.{1}".format(__threadname__, i))
+		for i in range(min(threads, n_bands))]
+	[t.start() for t in workers]
+	[t.join() for t in workers]
+	if errors:
+		raise errors[0]
+
+	template = results[0]
+	out = ImageStack(width, height)
+	for s in range(1, template.getStackSize() + 1):
+		ip = template.getStack().getProcessor(s).createProcessor(width, height)
+		for i, band in enumerate(results):
+			ip.insert(band.getStack().getProcessor(s), 0, edges[i])
+		out.addSlice(template.getStack().getSliceLabel(s), ip)
+	projection = ImagePlus(template.getTitle(), out)
+	projection.setDimensions(template.getNChannels(), template.getNSlices(), template.getNFrames())
+	projection.setCalibration(template.getCalibration())
+	if template.getNChannels() > 1:
+		projection = CompositeImage(projection, CompositeImage.COMPOSITE)
+		if imp.isComposite():
+			projection.setMode(imp.getMode())
+			projection.setLuts(imp.getLuts())
+	projection.setOpenAsHyperStack(template.isHyperStack())
+	return projection
+
+
+def same_pixels(imp1, imp2):
+	'''
+	Returns True if both images have the same dimensions and identical pixels on every slice.
+	'''
+	from java.util import Arrays
+
+	if list(imp1.getDimensions()) != list(imp2.getDimensions()):
+		return False
+	stack1, stack2 = imp1.getStack(), imp2.getStack()
+	for s in range(1, stack1.getSize() + 1):
+		if not Arrays.equals(stack1.getPixels(s), stack2.getPixels(s)):
+			return False
+	return True
+
+
+def benchmark_band_projection(imp, method="max", thread_counts=(1, 2, 4, 8), repeats=3):
+	'''
+	Times ZProjector.run against band_projection on imp for each thread count,
+	checking the results are identical. Returns a dict {threads: best time in seconds}
+	with the ZProjector time under the key 0.
+	'''
+	from ij import IJ
+	from ij.plugin import ZProjector
+
+	def best_time(project):
+		times = []
+		for r in range(repeats):
+			start = time.time()
+			result = project()
+			times.append(time.time() - start)
+		return min(times), result
+
+	timings = {}
+	timings[0], reference = best_time(lambda: ZProjector.run(imp, method))
+	IJ.log("# benchmark_band_projection: {0} {1} ZProjector {2:.3f}s".format(imp.getTitle(), method, timings[0]))
+	for threads in thread_counts:
+		timings[threads], result = best_time(lambda: band_projection(imp, method, threads=threads))
+		IJ.log("# {0} threads {1:.3f}s ({2:.2f}x){3}".format(threads, timings[threads], timings[0] / max(timings[threads], 1e-9),
+			"" if same_pixels(reference, result) else " RESULTS DIFFER"))
+	return timings
+
+
+if __name__ in ("__builtin__", "__main__"):
+	from ij import IJ
+	benchmark_band_projection(IJ.getImage())
@@ -0,0 +1,172 @@
+import os.path
+import java.lang.Exception
+
+from threading import (Lock, local)
+
+__version__ = "1.0"
+
+
+class ReaderPool:
+	'''
+	Pool of initialised Bio-Formats readers, kept per thread and per file extension.
+	Building a reader (ImageReader instantiates every format reader) costs more than reading
+	the header of most files, so released readers are closed but kept and reused for the
+	next file of the same format opened by the same thread.
+	Readers split RGB planes into channels (ChannelSeparator) and return ImageProcessors.
+	'''
+	def __init__(self, max_idle=2):
+		self.max_idle = max_idle
+		self.local = local()
+		self.lock = Lock()
+		self.created = 0
+		self.reused = 0
+
+
+	def acquire(self, path, series=0):
+		'''
+		Returns a reader initialised on path and series, and its OME metadata.
+		Every acquire must be paired with a release of the reader.
+		'''
+		from loci.formats import (ChannelSeparator, MetadataTools)
+		from loci.plugins.util import (ImageProcessorReader, LociPrefs)
+
+		idle = self.idle(path)
+		if idle:
+			reader = idle.pop()
+			with self.lock:
+				self.reused += 1
+		else:
+			reader = ImageProcessorReader(ChannelSeparator(LociPrefs.makeImageReader()))
+			with self.lock:
+				self.created += 1
+		meta = MetadataTools.createOMEXMLMetadata()
+		try:
+			reader.setMetadataStore(meta)
+			reader.setId(path)
+			reader.setSeries(series)
+		except (Exception, java.lang.Exception):
+			reader.close()
+			raise
+		return reader, meta
+
+
+	def release(self, reader):
+		'''
+		Closes the file opened by reader and keeps the reader for the next file of the same format.
+		'''
+		path = reader.getCurrentFile()
+		reader.close()
+		if path is None:
+			return
+		idle = self.idle(path)
+		if len(idle) < self.max_idle:
+			idle.append(reader)
+
+
+	def idle(self, path):
+		'''
+		Returns the list of idle readers of the calling thread for the format of path.
+		'''
+		readers = getattr(self.local, "readers", None)
+		if readers is None:
+			readers = self.local.readers = {}
+		return readers.setdefault(os.path.splitext(path)[1].lower(), [])
+
+
+	def stats(self):
+		with self.lock:
+			return {"created": self.created, "reused": self.reused}
+
+
+__POOL__ = ReaderPool() # Process wide pool used by the module functions.
+
+
+def acquire(path, series=0):
+	'''
+	Returns a pooled reader initialised on path and its OME metadata. See ReaderPool.acquire.
+	'''
+	return __POOL__.acquire(path, series)
+
+
+def release(reader):
+	'''
+	Returns reader to the pool. See ReaderPool.release.
+	'''
+	__POOL__.release(reader)
+
+
+def probe(path, series=0):
+	'''
+	Reads the header of path without reading any pixel.
+	Returns a dict with width, height, slices, channels (RGB split), frames, bitdepth,
+	bytes per pixel, series count and the ij.measure.Calibration of series.
+	'''
+	from loci.formats import FormatTools
+
+	reader, meta = acquire(path, series)
+	try:
+		bpp = FormatTools.getBytesPerPixel(reader.getPixelType())
+		return {"width": reader.getSizeX(),
+			"height": reader.getSizeY(),
+			"slices": reader.getSizeZ(),
+			"channels": reader.getSizeC(),
+			"frames": reader.getSizeT(),
+			"bitdepth": bpp * 8,
+			"bytes_per_pixel": bpp,
+			"series": reader.getSeriesCount(),
+			"calibration": calibration(meta, series)}
+	finally:
+		release(reader)
+
+
+def calibration(meta, series=0):
+	'''
+	Returns an ij.measure.Calibration with the physical sizes found in the OME metadata of series.
+	'''
+	from ij.measure import Calibration
+
+	cal = Calibration()
+	sizex = meta.getPixelsPhysicalSizeX(series)
+	sizey = meta.getPixelsPhysicalSizeY(series)
+	sizez = meta.getPixelsPhysicalSizeZ(series)
+	if sizex is not None:
+		cal.pixelWidth = sizex.value()
+		cal.setUnit(sizex.unit().getSymbol())
+	if sizey is not None:
+		cal.pixelHeight = sizey.value()
+	if sizez is not None:
+		cal.pixelDepth = sizez.value()
+	return cal
+
+
+def open_virtual(path, series=0):
+	'''
+	Opens series of path as a Bio-Formats virtual stack: planes are only read when displayed
+	or requested with getProcessor, for callers that need a few planes of a big stack.
+	'''
+	from loci.plugins import BF
+
+	# "in" is a keyword, in Jython too, so loci.plugins.in cannot be named in an import statement.
+	ImporterOptions = __import__("loci.plugins.in", globals(), locals(), ["ImporterOptions"]).ImporterOptions
+	options = ImporterOptions()
+	options.setId(path)
+	options.setVirtual(True)
+	options.setSeriesOn(series, True)
+	return BF.openImagePlus(options)[0]
+
+
+def log_stats():
+	from ij import IJ
+
+	s = __POOL__.stats()
+	IJ.log("# Readers: {0} created, {1} reused.".format(s["created"], s["reused"]))
+
+
+if __name__ in ("__builtin__", "__main__"):
+	from ij import IJ
+	from ij.io import OpenDialog
+
+	path = OpenDialog("Probe image").getPath()
+	if path:
+		IJ.log("{0}".format(probe(path)))
+		open_virtual(path).show()
@@ -0,0 +1,176 @@
+import os
+import re
+import json
+import array
+import zipfile
+
+from threading import Lock
+
+from IBPlib.ij.Utils.Manifest import write_json
+
+__version__ = "1.0"
+__ROIS_INDEX_FILENAME__ = "IBPlib_rois.json"
+BUNDLE_SUFFIX = "_RoiSet.zip"
+
+
+class RoiStore:
+	'''
+	Rois of a folder stored per image in RoiSet style zip bundles (one .roi entry per roi,
+	readable by the RoiManager), with an index json mapping each image title to its bundle.
+	Lookups are exact on the image title and read a single bundle, instead of listing the folder
+	and matching every loose .roi file against every title.
+	Loose .roi files saved by older versions ("<title>_<i>.roi", optionally prefixed by the
+	ChannelSplitter "C<n>-") are still found for images without a bundle. See migrate.
+	e.g.
+		store = RoiStore(rois_folder)
+		store.append(imp.getTitle(), rois)
+		rois = store.get(title)
+	'''
+	def __init__(self, folder, filename=__ROIS_INDEX_FILENAME__):
+		self.folder = folder
+		self.path = os.path.join(folder, filename)
+		self.lock = Lock()
+		self.entries = {}
+		if os.path.exists(self.path):
+			with open(self.path, "r") as index_file:
+				self.entries = json.load(index_file)
+
+
+	def titles(self):
+		with self.lock:
+			return sorted(self.entries.keys())
+
+
+	def get(self, title):
+		'''
+		Returns the rois stored for the image title, named after their entries, in stored order.
+		'''
+		with self.lock:
+			entry = self.entries.get(title)
+			if entry is None:
+				return [open_roi(path) for path in self.loose_files(title)]
+			bundle = os.path.join(self.folder, entry["bundle"])
+			return [roi for name, roi in read_bundle(bundle)]
+
+
+	def append(self, title, rois):
+		'''
+		Adds rois to the bundle of the image title, replacing stored rois with the same name.
+		'''
+		with self.lock:
+			entry = self.entries.get(title)
+			if entry is None:
+				entry = {"bundle": bundle_name(title, self.entries), "rois": []}
+			bundle = os.path.join(self.folder, entry["bundle"])
+			names = [entry_name(roi, i + len(entry["rois"])) for i, roi in enumerate(rois)]
+			if set(names) & set(entry["rois"]):
+				stored = [(name, roi) for name, roi in read_bundle(bundle) if name not in names]
+				write_bundle(bundle, stored + list(zip(names, rois)), "w")
+				entry["rois"] = [name for name, roi in stored] + names
+			else:
+				write_bundle(bundle, zip(names, rois), "a" if entry["rois"] else "w")
+				entry["rois"] = entry["rois"] + names
+			self.entries[title] = entry
+			self.__save()
+
+
+	def put(self, title, rois):
+		'''
+		Replaces the rois of the image title.
+		'''
+		self.remove(title)
+		self.append(title, rois)
+
+
+	def remove(self, title):
+		with self.lock:
+			entry = self.entries.pop(title, None)
+			if entry is None:
+				return
+			bundle = os.path.join(self.folder, entry["bundle"])
+			if os.path.exists(bundle):
+				os.remove(bundle)
+			self.__save()
+
+
+	def loose_files(self, title):
+		'''
+		Returns the loose .roi files of title, sorted by roi index.
+		'''
+		pattern = re.compile(r"^(C\d+-)?{0}_(\d+)\.roi$".format(re.escape(title)))
+		found = []
+		for name in os.listdir(self.folder):
+			match = pattern.match(name)
+			if match:
+				found.append((int(match.group(2)), os.path.join(self.folder, name)))
+		return [path for i, path in sorted(found)]
+
+
+	def migrate(self, titles, remove_loose=False):
+		'''
+		Moves the loose .roi files of titles into bundles. Returns the number of rois migrated.
+		'''
+		migrated = 0
+		for title in titles:
+			if title in self.entries:
+				continue
+			paths = self.loose_files(title)
+			if not paths:
+				continue
+			self.append(title, [open_roi(path) for path in paths])
+			migrated += len(paths)
+			if remove_loose:
+				[os.remove(path) for path in paths]
+		return migrated
+
+
+	def __save(self):
+		write_json(self.entries, self.path, indent=1, sort_keys=True)
+
+
+def bundle_name(title, entries):
+	'''
+	Returns an unused bundle filename for title.
+	'''
+	used = set([entry["bundle"] for entry in entries.values()])
+	root = re.sub(r"[\\/:*?\"<>|]", "_", title)
+	name = "{0}{1}".format(root, BUNDLE_SUFFIX)
+	i = 1
+	while name in used:
+		name = "{0}.{1}{2}".format(root, i, BUNDLE_SUFFIX)
+		i += 1
+	return name
+
+
+def entry_name(roi, index):
+	name = roi.getName() or "roi_{0}".format(index)
+	return "{0}.roi".format(name)
+
+
+def write_bundle(bundle, named_rois, mode):
+	from ij.io import RoiEncoder
+
+	with zipfile.ZipFile(bundle, mode, zipfile.ZIP_DEFLATED) as zf:
+		for name, roi in named_rois:
+			zf.writestr(name, RoiEncoder.saveAsByteArray(roi).tostring())
+
+
+def read_bundle(bundle):
+	'''
+	Returns the (entry name, roi) pairs of a bundle in stored order.
+	'''
+	from ij.io import RoiDecoder
+
+	rois = []
+	with zipfile.ZipFile(bundle, "r") as zf:
+		for name in zf.namelist():
+			roi = RoiDecoder(array.array("b", zf.read(name)), name).getRoi()
+			roi.setName(os.path.splitext(name)[0])
+			rois.append((name, roi))
+	return rois
+
+
+def open_roi(path):
+	from ij.io import Opener
+
+	return Opener().openRoi(path)
@@ -0,0 +1,153 @@
+import os.path
+import time
+
+from threading import Condition
+
+from ij import IJ
+
+from IBPlib.ij.Utils.Readers import probe
+
+__version__ = "1.0"
+
+
+def estimate_footprint(path):
+	'''
+	Estimates the bytes needed to hold the image in path from its header
+	(width x height x slices x channels x frames x bytes per pixel) without reading pixels.
+	Falls back to the file size if the header cannot be read.
+	'''
+	try:
+		p = probe(path)
+		return p["width"] * p["height"] * p["slices"] * p["channels"] * p["frames"] * p["bytes_per_pixel"]
+	except:
+		return os.path.getsize(path)
+
+
+def estimate_projection_footprint(path):
+	'''
+	Estimates the bytes needed to stream a Z-projection of the image in path:
+	one 32-bit accumulator plane per channel and timepoint.
+	Falls back to estimate_footprint if the header cannot be read.
+	'''
+	try:
+		p = probe(path)
+		return p["width"] * p["height"] * p["channels"] * p["frames"] * 4
+	except:
+		return estimate_footprint(path)
+
+
+class AdmissionScheduler:
+	'''
+	Admits tasks only while the estimated memory of all running tasks stays under a budget
+	and while there are fewer running tasks than max_workers.
+	By default the budget is half of the JVM max heap and max_workers is the core count,
+	so many small images run in parallel while huge stacks are processed a few at a time.
+	A task bigger than the whole budget is still admitted, but only when it would run alone.
+	'''
+
+	def __init__(self, budget=None, heap_fraction=0.5, max_workers=None):
+		from java.lang import Runtime
+
+		runtime = Runtime.getRuntime()
+		if budget is None:
+			budget = int(runtime.maxMemory() * heap_fraction)
+		if max_workers is None:
+			max_workers = runtime.availableProcessors()
+		self.budget = budget
+		self.max_workers = max(1, max_workers)
+		self.condition = Condition()
+		self.in_use = 0
+		self.running = 0
+		self.admitted = 0
+		self.peak_running = 0
+		self.peak_in_use = 0
+		self.started = None
+		self.last_change = None
+		self.running_area = 0.0
+
+
+	def footprint(self, paths, overhead=1.0):
+		'''
+		Returns the estimated bytes to process the images in paths.
+		overhead accounts for the working copies a task creates (e.g. the merged composite).
+		'''
+		return int(sum([estimate_footprint(p) for p in paths if p]) * overhead)
+
+
+	def admit(self, cost):
+		'''
+		Blocks until the task of the given cost fits in the budget.
+		Every admit must be paired with a release of the same cost.
+		'''
+		with self.condition:
+			while not self.__fits(cost):
+				self.condition.wait()
+			if cost > self.budget:
+				IJ.log("# Task needs {0} MB, above the {1} MB budget. Running it alone."
+					.format(cost >> 20, self.budget >> 20))
+			self.__update_area()
+			self.in_use += cost
+			self.running += 1
+			self.admitted += 1
+			self.peak_running = max(self.peak_running, self.running)
+			self.peak_in_use = max(self.peak_in_use, self.in_use)
+		return cost
+
+
+	def release(self, cost):
+		'''
+		Frees the budget taken by a finished task and wakes up waiting tasks.
+		'''
+		with self.condition:
+			self.__update_area()
+			self.in_use -= cost
+			self.running -= 1
+			self.condition.notifyAll()
+
+
+	def report(self):
+		'''
+		Returns a dict with the concurrency statistics of the run.
+		'''
+		with self.condition:
+			self.__update_area()
+			elapsed = 0.0
+			if self.started is not None:
+				elapsed = self.last_change - self.started
+			average = 0.0
+			if elapsed > 0:
+				average = self.running_area / elapsed
+			return {"tasks": self.admitted,
+				"peak_concurrency": self.peak_running,
+				"average_concurrency": average,
+				"peak_memory": self.peak_in_use,
+				"budget": self.budget,
+				"max_workers": self.max_workers,
+				"elapsed": elapsed}
+
+
+	def log_report(self):
+		'''
+		Logs the concurrency statistics of the run.
+		'''
+		r = self.report()
+		IJ.log("# Scheduler: {0} tasks in {1:.1f}s. Concurrency peak {2}, average {3:.2f} (max {4}). Peak memory {5} MB of {6} MB."
+			.format(r["tasks"], r["elapsed"], r["peak_concurrency"], r["average_concurrency"],
+				r["max_workers"], r["peak_memory"] >> 20, r["budget"] >> 20))
+
+
+	def __fits(self, cost):
+		if self.running == 0:
+			return True
+		if self.running >= self.max_workers:
+			return False
+		return self.in_use + cost <= self.budget
+
+
+	def __update_area(self):
+		now = time.time()
+		if self.started is None:
+			self.started = now
+			self.last_change = now
+		self.running_area += self.running * (now - self.last_change)
+		self.last_change = now
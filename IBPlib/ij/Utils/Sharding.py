@@ -0,0 +1,136 @@
+import os
+import glob
+import json
+import time
+import zlib
+import socket
+
+from threading import Lock
+
+from ij import IJ
+
+from IBPlib.ij.Utils.Manifest import (__MANIFEST_FILENAME__, shard_filename, write_json)
+
+__version__ = "1.0"
+__RUN_REPORT_FILENAME__ = "IBPlib_run_report.json"
+
+
+def validate_shard(shard):
+	'''
+	Validates a (index, count) shard tuple.
+	'''
+	index, count = shard
+	if count < 1 or not 0 <= index < count:
+		raise ValueError("Invalid shard {0}. Index should be in [0, count).".format(shard))
+
+
+def shard_of(key, count):
+	'''
+	Returns the shard index of key.
+	Uses crc32 so every process, on any node, assigns a key to the same shard.
+	'''
+	if isinstance(key, unicode):
+		key = key.encode("utf-8")
+	return (zlib.crc32(key) & 0xffffffff) % count
+
+
+def shard(items, index, count, key=None):
+	'''
+	Returns the items of shard index out of count.
+	key maps an item to the string used to assign its shard (e.g. the root title of a
+	ColorMerger image, so all its channels land in the same shard). Defaults to the item itself.
+	'''
+	validate_shard((index, count))
+	if count == 1:
+		return list(items)
+	if key is None:
+		key = lambda item: item
+	return [item for item in items if shard_of(key(item), count) == index]
+
+
+class RunReport:
+	'''
+	Thread safe record of what a ColorMerger or Projector run did with each image.
+	Saved next to the outputs, one file per shard, and merged by merge_shards.
+	'''
+	def __init__(self, name, shard=(0, 1)):
+		self.lock = Lock()
+		self.data = {
+			"name": name,
+			"shard": list(shard),
+			"host": socket.gethostname(),
+			"started": time.time(),
+			"elapsed": 0.0,
+			"processed": [],
+			"skipped": [],
+			"failed": {}}
+
+
+	def processed(self, title):
+		with self.lock:
+			self.data["processed"].append(title)
+
+
+	def skipped(self, title):
+		with self.lock:
+			self.data["skipped"].append(title)
+
+
+	def failed(self, title, reason):
+		with self.lock:
+			self.data["failed"][title] = "{0}".format(reason)
+
+
+	def save(self, folder, extra=None):
+		'''
+		Writes the report to folder, with the shard suffix when sharded.
+		extra is a dict of other stats to store (e.g. the scheduler report).
+		'''
+		with self.lock:
+			self.data["elapsed"] = time.time() - self.data["started"]
+			if extra:
+				self.data.update(extra)
+			path = os.path.join(folder, __RUN_REPORT_FILENAME__)
+			if self.data["shard"][1] > 1:
+				path = shard_filename(path, self.data["shard"])
+			write_json(self.data, path, indent=1, sort_keys=True)
+		return path
+
+
+def merge_shards(folder):
+	'''
+	Merges the per shard manifests and run reports found in folder.
+	The manifests are merged into the main manifest and removed.
+	The run reports are combined into the main run report, which is returned as a dict, and removed
+	so a later run with another shard count does not merge them again.
+	'''
+	manifest_path = os.path.join(folder, __MANIFEST_FILENAME__)
+	entries = {}
+	if os.path.exists(manifest_path):
+		with open(manifest_path, "r") as manifest_file:
+			entries = json.load(manifest_file)
+	shard_manifests = sorted(glob.glob(shard_filename(manifest_path, ("*", "*"))))
+	for path in shard_manifests:
+		with open(path, "r") as manifest_file:
+			entries.update(json.load(manifest_file))
+	write_json(entries, manifest_path, indent=1, sort_keys=True)
+	[os.remove(path) for path in shard_manifests]
+
+	report_path = os.path.join(folder, __RUN_REPORT_FILENAME__)
+	report = {"shards": [], "processed": [], "skipped": [], "failed": {}, "elapsed": 0.0}
+	shard_reports = sorted(glob.glob(shard_filename(report_path, ("*", "*"))))
+	for path in shard_reports:
+		with open(path, "r") as report_file:
+			shard_report = json.load(report_file)
+		report["shards"].append(shard_report)
+		report["processed"].extend(shard_report["processed"])
+		report["skipped"].extend(shard_report["skipped"])
+		report["failed"].update(shard_report["failed"])
+		report["elapsed"] = max(report["elapsed"], shard_report["elapsed"])
+	write_json(report, report_path, indent=1, sort_keys=True)
+	[os.remove(path) for path in shard_reports]
+
+	IJ.log("# Merged {0} shards: {1} processed, {2} skipped, {3} failed in {4:.1f}s."
+		.format(len(report["shards"]), len(report["processed"]), len(report["skipped"]),
+			len(report["failed"]), report["elapsed"]))
+	return report
@@ -1,13 +1,16 @@
 import java.lang.Exception
+import time
 import traceback
 
-from threading import Thread
+from threading import (Thread, Condition, Event, Lock)
 from Queue import Queue
 
 import ij.io.FileSaver
 from ij import (ImagePlus, IJ)
 
-__version__ = "1.0"
+from IBPlib.ij.Utils.Files import imagesize
+
+__version__ = "1.1"
 __threadname__ = "IBPlib.ij.ThreadedFileSaver" # Threads spawned by ThreadedFileSaver have this name + name of the saved image.
 
 class ThreadedFileSaver(Thread):
@@ -33,7 +36,193 @@ class ThreadedFileSaver(Thread):
 		command = getattr(fs, self.args[2])
 		if not command(self.args[1]):
 			IJ.log("# '{0}' could not be saved.".format(self.args[1]))
-		IJ.log("# '{0}' was saved successfully.".format(self.args[1]))
+		else:
+			IJ.log("# '{0}' was saved successfully.".format(self.args[1]))
+
+
+class SaveFuture:
+	'''
+	Outcome of a save queued in a WriterPool.
+	ok is True once the file is saved, error holds the reason when it could not be.
+	'''
+	def __init__(self, imp, savepath, command):
+		self.imp = imp
+		self.savepath = savepath
+		self.command = command
+		self.nbytes = imagesize(imp)
+		self.ok = None
+		self.error = None
+		self.event = Event()
+		self.callbacks = []
+		self.lock = Lock()
+
+
+	def done(self):
+		return self.event.isSet()
+
+
+	def result(self, timeout=None):
+		'''
+		Waits for the save and returns True if the file was saved, False otherwise (see error).
+		'''
+		self.event.wait(timeout)
+		return bool(self.ok)
+
+
+	def add_done_callback(self, callback):
+		'''
+		Calls callback(future) once the save is done, straight away if it already is.
+		Callbacks run in the writer thread.
+		'''
+		with self.lock:
+			if not self.event.isSet():
+				self.callbacks.append(callback)
+				return
+		callback(self)
+
+
+	def finish(self, ok, error=None):
+		with self.lock:
+			self.ok = ok
+			self.error = error
+			self.imp = None
+			self.event.set()
+			callbacks, self.callbacks = self.callbacks, []
+		for callback in callbacks:
+			try:
+				callback(self)
+			except (Exception, java.lang.Exception):
+				IJ.log(traceback.format_exc())
+
+
+class WriterPool:
+	'''
+	Fixed pool of writer threads saving images with ij.io.FileSaver.
+	submit blocks while the images waiting to be written would go above the byte budget
+	(a quarter of the JVM max heap by default), so producers cannot pile images up in the heap.
+	An image bigger than the budget is only accepted when nothing else is in flight.
+	Each submit returns a SaveFuture, flush waits for every queued write and stats reports throughput.
+	With output (an IBPlib.ij.Utils.Output.OutputWriter) images are written as compressed OME-TIFF
+	instead of with the FileSaver command.
+	'''
+	def __init__(self, writers=2, budget=None, heap_fraction=0.25, output=None):
+		from java.lang import Runtime
+
+		if budget is None:
+			budget = int(Runtime.getRuntime().maxMemory() * heap_fraction)
+		self.budget = budget
+		self.output = output
+		self.condition = Condition()
+		self.in_flight = 0
+		self.peak_in_flight = 0
+		self.saved = 0
+		self.failed = 0
+		self.bytes_written = 0
+		self.busy = 0.0
+		self.started = time.time()
+		self.queue = Queue()
+		self.workers = []
+		for i in range(max(1, writers)):
+			t = Thread(target=self.writerthread_task, name="{0}.writer.{1}".format(__threadname__, i))
+			t.setDaemon(True)
+			self.workers.append(t)
+			t.start()
+
+
+	def submit(self, imp, savepath, command="saveAsTiff", callback=None):
+		'''
+		Queues imp to be saved in savepath with the ij.io.FileSaver saveAs... command.
+		callback(future) is called once the save is done.
+		Returns a SaveFuture.
+		'''
+		if "saveAs" not in command:
+			raise AttributeError("{0} only exposes the 'saveAs...' methods from ij.io.FileSaver.".format(__threadname__))
+		future = SaveFuture(imp, savepath, command)
+		if callback:
+			future.add_done_callback(callback)
+		with self.condition:
+			while self.in_flight and self.in_flight + future.nbytes > self.budget:
+				self.condition.wait()
+			self.in_flight += future.nbytes
+			self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+		self.queue.put(future)
+		return future
+
+
+	def flush(self):
+		'''
+		Waits until every queued image has been written.
+		'''
+		self.queue.join()
+
+
+	def shutdown(self):
+		'''
+		Flushes the queue and stops the writers.
+		'''
+		self.flush()
+		for t in self.workers:
+			self.queue.put(None)
+		for t in self.workers:
+			t.join()
+		self.workers = []
+
+
+	def writerthread_task(self):
+		while True:
+			future = self.queue.get()
+			if future is None:
+				self.queue.task_done()
+				break
+			start = time.time()
+			ok, error = False, None
+			try:
+				if self.output:
+					self.output.write(future.imp, future.savepath)
+					ok = True
+				else:
+					fs = ij.io.FileSaver(future.imp)
+					ok = getattr(fs, future.command)(future.savepath)
+				if not ok:
+					error = "could not be saved"
+					IJ.log("# '{0}' could not be saved.".format(future.savepath))
+			except (Exception, java.lang.Exception) as e:
+				error = e
+				IJ.log("# '{0}' could not be saved.\n{1}".format(future.savepath, traceback.format_exc()))
+			with self.condition:
+				self.in_flight -= future.nbytes
+				self.busy += time.time() - start
+				if ok:
+					self.saved += 1
+					self.bytes_written += future.nbytes
+				else:
+					self.failed += 1
+				self.condition.notifyAll()
+			try:
+				future.finish(ok, error)
+			finally:
+				self.queue.task_done()
+
+
+	def stats(self):
+		'''
+		Returns a dict with the files saved and failed, the bytes written, the throughput in
+		bytes per second of writer time and of wall time, and the peak bytes in flight.
+		'''
+		with self.condition:
+			elapsed = time.time() - self.started
+			return {"saved": self.saved, "failed": self.failed, "bytes": self.bytes_written,
+				"writer_throughput": self.bytes_written / self.busy if self.busy else 0.0,
+				"throughput": self.bytes_written / elapsed if elapsed else 0.0,
+				"peak_in_flight": self.peak_in_flight, "budget": self.budget,
+				"writers": len(self.workers), "elapsed": elapsed}
+
+
+	def log_stats(self):
+		s = self.stats()
+		IJ.log("# Writers: {0} saved, {1} failed, {2} MB in {3:.1f}s ({4:.1f} MB/s, {5:.1f} MB/s per writer). Peak {6} MB in flight of {7} MB."
+			.format(s["saved"], s["failed"], s["bytes"] >> 20, s["elapsed"], s["throughput"] / (1 << 20),
+				s["writer_throughput"] / (1 << 20), s["peak_in_flight"] >> 20, s["budget"] >> 20))
 
 
 if __name__ in ("__builtin__", "__main__"):
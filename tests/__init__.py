@@ -0,0 +1,19 @@
+'''
+Tests of IBPlib. Run them from the repository root with
+	python -m unittest discover -s tests -t .
+on Jython with ImageJ in the classpath (e.g. the Fiji jython), or on Python 2.7, where the
+minimal ij and java stand-ins of tests/stubs are used and the tests needing ImageJ are skipped.
+'''
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+	sys.path.insert(0, ROOT)
+
+try:
+	import ij
+	IMAGEJ = True
+except ImportError:
+	sys.path.append(os.path.join(ROOT, "tests", "stubs"))
+	IMAGEJ = False
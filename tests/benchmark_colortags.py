@@ -0,0 +1,60 @@
+'''
+Times TagMatcher against the nested loop sorting it replaced. Run from the repository root with
+	python -m tests.benchmark_colortags
+'''
+import time
+
+from IBPlib.ij.Colortags import TagMatcher
+
+
+def legacy_sortbytag(tags, titleslist):
+	'''
+	Nested loop sorting used by ColorMerger.sortbytag before TagMatcher.
+	'''
+	sortedimgs = {}
+	for img in titleslist:
+		for index, tagstuple in tags.items():
+			for colortag in tagstuple:
+				if colortag not in img:
+					continue
+				imgtitleroot = "".join(img.split(colortag))
+				if imgtitleroot not in sortedimgs:
+					impsbucket = [None]*7
+					impsbucket[index] = img
+					sortedimgs.update({imgtitleroot:impsbucket})
+				else:
+					sortedimgs[imgtitleroot][index] = img
+	return sortedimgs
+
+
+def synthetic_titles(tags, n_titles):
+	colortags = [tagstuple[0] for index, tagstuple in sorted(tags.items()) if tagstuple]
+	return ["plate{0}_well{1}_{2}_cmle.ics".format(i // 384, i % 384, colortags[i % len(colortags)])
+		for i in range(n_titles)]
+
+
+def benchmark_matcher(tags, n_titles=100000):
+	'''
+	Times legacy_sortbytag against TagMatcher on n_titles synthetic titles built from tags
+	and checks both give the same buckets.
+	Returns a dict with the timings in seconds.
+	'''
+	titleslist = synthetic_titles(tags, n_titles)
+
+	start = time.time()
+	legacy = legacy_sortbytag(tags, titleslist)
+	legacy_time = time.time() - start
+
+	start = time.time()
+	compiled, ambiguous = TagMatcher(tags).sort(titleslist)
+	compiled_time = time.time() - start
+
+	if legacy != compiled:
+		print("TagMatcher and legacy sorting differ.")
+	print("{0} titles. Legacy {1:.3f}s, TagMatcher {2:.3f}s ({3:.1f}x). {4} ambiguous titles."
+		.format(n_titles, legacy_time, compiled_time, legacy_time / max(compiled_time, 1e-9), len(ambiguous)))
+	return {"titles": n_titles, "legacy": legacy_time, "compiled": compiled_time}
+
+
+if __name__ == "__main__":
+	benchmark_matcher({0: ["_C1", "_red"], 1: ["_C2", "_green"], 2: ["_C3", "_blue"], 3: ["_C4"]})
@@ -0,0 +1,44 @@
+'''
+Minimal stand-ins of the ImageJ classes imported by IBPlib, to run the tests without ImageJ.
+'''
+
+
+class IJ:
+	logged = []
+
+	@staticmethod
+	def log(message):
+		IJ.logged.append(message)
+
+
+	@staticmethod
+	def error(message):
+		IJ.logged.append(message)
+
+
+class Prefs:
+	@staticmethod
+	def get(key, default):
+		return default
+
+
+	@staticmethod
+	def set(key, value):
+		pass
+
+
+	@staticmethod
+	def savePreferences():
+		pass
+
+
+class ImagePlus:
+	pass
+
+
+class CompositeImage:
+	pass
+
+
+class ImageStack:
+	pass
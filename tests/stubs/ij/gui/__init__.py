@@ -0,0 +1,18 @@
+class ProfilePlot:
+	pass
+
+
+class GenericDialog:
+	pass
+
+
+class DialogListener:
+	pass
+
+
+class WaitForUserDialog:
+	pass
+
+
+class Overlay:
+	pass
@@ -0,0 +1,10 @@
+class RGBStackMerge:
+	pass
+
+
+class ZProjector:
+	pass
+
+
+class Duplicator:
+	pass
@@ -0,0 +1,2 @@
+class Blitter:
+	pass
@@ -0,0 +1,6 @@
+def array(sequence, typecode):
+	return list(sequence)
+
+
+def zeros(length, typecode):
+	return [0] * length
@@ -0,0 +1,5 @@
+import os
+
+
+def getProperty(key):
+	return {"user.home": os.path.expanduser("~")}.get(key)
@@ -0,0 +1,26 @@
+import sys
+
+
+class Exception(Exception):
+	pass
+
+
+class Error(Exception):
+	pass
+
+
+class Runtime:
+	@staticmethod
+	def getRuntime():
+		return Runtime()
+
+
+	def maxMemory(self):
+		return 1 << 30
+
+
+	def availableProcessors(self):
+		return 4
+
+
+sys.modules[__name__ + ".Exception"] = Exception # For "import java.lang.Exception".
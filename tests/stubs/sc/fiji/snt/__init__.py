@@ -0,0 +1,6 @@
+class SNTService:
+	pass
+
+
+class Tree:
+	pass
@@ -0,0 +1,97 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import tests
+from IBPlib.ij.Projector import Projector
+from IBPlib.ij.Utils.Backends import (CLIJ2Backend, get_backend, register_backend, unregister_backend,
+	registered_backends, select_backends, project)
+
+CLIJ2_MODULE = "net.haesleinhuepf.clij2"
+
+
+class RecordingBackend:
+	methods = ("max",)
+
+	def __init__(self, name):
+		self.name = name
+		self.projected = []
+
+
+	def available(self):
+		return True
+
+
+	def project(self, imp, method, threads=None):
+		self.projected.append((imp, method))
+		return "{0} projection".format(self.name)
+
+
+class GPUFallbackTest(unittest.TestCase):
+	'''
+	On GPU-less nodes the CLIJ2 import fails and clij2 projections fall back to the CPU.
+	The import is made to fail by a None entry in sys.modules, even where CLIJ2 is installed.
+	'''
+	def setUp(self):
+		self.backends = registered_backends()
+		self.clij2_module = sys.modules.get(CLIJ2_MODULE)
+		sys.modules[CLIJ2_MODULE] = None
+		register_backend(CLIJ2Backend())
+
+
+	def tearDown(self):
+		if self.clij2_module is None:
+			sys.modules.pop(CLIJ2_MODULE, None)
+		else:
+			sys.modules[CLIJ2_MODULE] = self.clij2_module
+		for backend in registered_backends():
+			unregister_backend(backend.name)
+		for backend in self.backends:
+			register_backend(backend)
+
+
+	def test_clij2_unavailable(self):
+		self.assertFalse(get_backend("clij2").available())
+
+
+	def test_select_backends_falls_back(self):
+		self.assertEqual([b.name for b in select_backends("max", backend="clij2")], ["cpu", "zprojector"])
+
+
+	def test_unknown_backend(self):
+		self.assertRaises(ValueError, select_backends, "max", backend="cpuu")
+
+
+	def test_project_falls_back_to_cpu(self):
+		cpu = RecordingBackend("cpu")
+		register_backend(cpu, first=True)
+		self.assertEqual(project("imp", "max", backend="clij2"), "cpu projection")
+		self.assertEqual(cpu.projected, [("imp", "max")])
+
+
+	@unittest.skipUnless(tests.IMAGEJ, "Needs ImageJ.")
+	def test_projector_run_on_gpu(self):
+		from ij import IJ
+		from ij.plugin import ZProjector
+
+		folder = tempfile.mkdtemp(prefix="IBPlib_fallback_")
+		try:
+			imgfolder, savefolder = os.path.join(folder, "in"), os.path.join(folder, "out")
+			os.mkdir(imgfolder)
+			os.mkdir(savefolder)
+			imp = IJ.createImage("fallback", "16-bit ramp", 64, 48, 5)
+			IJ.saveAsTiff(imp, os.path.join(imgfolder, "fallback.tif"))
+			projector = Projector(savefolder, imgfolder, ".tif")
+			projector.run(onGPU=True, exclusionFlag=None, incremental=False)
+			self.assertEqual(projector.report.data["processed"], ["fallback.tif"])
+			result = IJ.openImage(os.path.join(savefolder, "fallback.tif"))
+			expected = ZProjector.run(imp, "max")
+			self.assertEqual(list(result.getProcessor().getPixels()), list(expected.getProcessor().getPixels()))
+		finally:
+			shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+	unittest.main()
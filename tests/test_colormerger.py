@@ -0,0 +1,59 @@
+import shutil
+import tempfile
+import unittest
+
+from IBPlib.ij.ColorMerger import ColorMerger
+from IBPlib.ij.Projector import Projector
+from IBPlib.ij.Utils.Output import OutputWriter
+
+COLORTAGS = {0: ["_C1"], 1: ["_C2"]}
+
+
+class SortByTagTest(unittest.TestCase):
+	def test_sortbytag(self):
+		merger = ColorMerger(None, None, ".tif", colortags=COLORTAGS)
+		sortedimgs = merger.sortbytag(["a_C1.tif", "a_C2.tif", "b_C1.tif"])
+		self.assertEqual(sortedimgs, {"a.tif": ["a_C1.tif", "a_C2.tif", None, None, None, None, None]})
+
+
+
+class Pool:
+	def __init__(self, output=None):
+		self.output = output
+
+
+class ManifestParamsTest(unittest.TestCase):
+	'''
+	The output settings the images are written with are part of the manifest parameters.
+	'''
+	def setUp(self):
+		self.folder = tempfile.mkdtemp(prefix="IBPlib_manifest_")
+		self.output = OutputWriter(compression="zlib", float_policy="clip")
+
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+
+	def test_colormerger_output(self):
+		merger = ColorMerger(self.folder, self.folder, ".tif", colortags=COLORTAGS, output=self.output)
+		merger.setup_manifest(None, [])
+		self.assertEqual(merger.run_params["output"], self.output.settings())
+		self.assertTrue(callable(merger.output))
+
+
+	def test_colormerger_writer_output(self):
+		merger = ColorMerger(self.folder, self.folder, ".tif", colortags=COLORTAGS, writer=Pool(self.output))
+		merger.setup_manifest(None, [])
+		self.assertEqual(merger.run_params["output"], self.output.settings())
+
+
+	def test_projector_writer_output(self):
+		projector = Projector(self.folder, self.folder, ".tif", writer=Pool(self.output))
+		projector.setup_manifest("cpu")
+		self.assertEqual(projector.run_params["output"], self.output.settings())
+
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,25 @@
+import unittest
+
+from IBPlib.ij.Colortags import TagMatcher
+from tests.benchmark_colortags import (legacy_sortbytag, synthetic_titles)
+
+TAGS = {0: ["_C1", "_red"], 1: ["_C2", "_green"], 2: ["_C3"]}
+
+
+class TagMatcherTest(unittest.TestCase):
+	def test_same_buckets_as_legacy(self):
+		titleslist = synthetic_titles(TAGS, 1000) + ["plate_green_cmle.ics", "untagged.ics"]
+		sortedimgs, ambiguous = TagMatcher(TAGS).sort(titleslist)
+		self.assertEqual(sortedimgs, legacy_sortbytag(TAGS, titleslist))
+		self.assertEqual(ambiguous, {})
+
+
+	def test_longest_overlapping_tag_wins(self):
+		tags = {0: ["C1"], 1: ["C10"]}
+		sortedimgs, ambiguous = TagMatcher(tags).sort(["img_C10.tif"])
+		self.assertEqual(sortedimgs, {"img_.tif": [None, "img_C10.tif", None, None, None, None, None]})
+		self.assertEqual(sorted(legacy_sortbytag(tags, ["img_C10.tif"])), ["img_.tif", "img_0.tif"])
+
+
+if __name__ == "__main__":
+	unittest.main()
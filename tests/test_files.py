@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from IBPlib.ij.Utils.Files import scan
+
+
+class ScanTest(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp(prefix="IBPlib_files_")
+		for name in ("a.tif", "a_488.tif", os.path.join("well_488", "b.tif"), os.path.join("skip", "c.tif")):
+			path = os.path.join(self.folder, name)
+			if not os.path.isdir(os.path.dirname(path)):
+				os.mkdir(os.path.dirname(path))
+			open(path, "w").close()
+
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+
+	def scanned(self, **kwargs):
+		return sorted([os.path.relpath(path, self.folder) for path in scan(self.folder, recursive=True, **kwargs)])
+
+
+	def test_exclude_only_filters_files(self):
+		self.assertEqual(self.scanned(exclude="*488*"), ["a.tif", os.path.join("skip", "c.tif"),
+			os.path.join("well_488", "b.tif")])
+
+
+	def test_exclude_dirs(self):
+		self.assertEqual(self.scanned(exclude_dirs="skip"), ["a.tif", "a_488.tif", os.path.join("well_488", "b.tif")])
+
+
+	def test_missing_folder(self):
+		self.assertRaises(IOError, list, scan(os.path.join(self.folder, "missing")))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from IBPlib.ij.Utils.Files import ImageCache
+
+
+class Stack:
+	def __init__(self, virtual):
+		self.virtual = virtual
+
+
+	def isVirtual(self):
+		return self.virtual
+
+
+class Image:
+	'''
+	An ImagePlus of nbytes bytes counting its live copies.
+	'''
+	copies = 0
+
+	def __init__(self, nbytes, virtual=False):
+		self.nbytes = nbytes
+		self.virtual = virtual
+		self.title = None
+		self.calibration = None
+		Image.copies += 1
+
+
+	def duplicate(self):
+		return Image(self.nbytes, self.virtual)
+
+
+	def getStack(self):
+		return Stack(self.virtual)
+
+
+	def getWidth(self):
+		return self.nbytes
+
+
+	def getHeight(self):
+		return 1
+
+
+	def getStackSize(self):
+		return 1
+
+
+	def getBytesPerPixel(self):
+		return 1
+
+
+	def getTitle(self):
+		return self.title
+
+
+	def setTitle(self, title):
+		self.title = title
+
+
+	def getCalibration(self):
+		return self.calibration
+
+
+	def setCalibration(self, calibration):
+		self.calibration = calibration
+
+
+class ImageCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp(prefix="IBPlib_cache_")
+		self.path = os.path.join(self.folder, "img.tif")
+		open(self.path, "w").close()
+		self.loaded = []
+		Image.copies = 0
+
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+
+	def loader(self, nbytes, virtual=False):
+		def load(path):
+			self.loaded.append(Image(nbytes, virtual))
+			return self.loaded[-1]
+		return load
+
+
+	def test_miss_returns_the_loaded_image(self):
+		cache = ImageCache(budget=100)
+		imp = cache.get(self.path, self.loader(10))
+		self.assertTrue(imp is self.loaded[0])
+		self.assertEqual(cache.stats()["images"], 1)
+		self.assertFalse(cache.get(self.path, self.loader(10)) is imp)
+		self.assertEqual(len(self.loaded), 1)
+
+
+	def test_uncacheable_images_are_not_duplicated(self):
+		cache = ImageCache(budget=100)
+		cache.get(self.path, self.loader(1000))
+		cache.get(self.path, self.loader(10, virtual=True))
+		self.assertEqual(Image.copies, 2)
+		self.assertEqual(cache.stats()["images"], 0)
+
+
+if __name__ == "__main__":
+	unittest.main()
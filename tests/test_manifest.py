@@ -0,0 +1,38 @@
+import unittest
+
+from IBPlib.ij.Utils.Manifest import parameter_value
+
+
+class Settings:
+	'''
+	Like most Java objects: the repr holds the identity, the str does not.
+	'''
+	def __init__(self, radius):
+		self.radius = radius
+
+
+	def __str__(self):
+		return "Settings[radius={0}]".format(self.radius)
+
+
+def subtract_background(imp, settings):
+	pass
+
+
+class ParameterValueTest(unittest.TestCase):
+	def test_primitives(self):
+		self.assertEqual([parameter_value(v) for v in (None, True, 2, 0.5, "Li")], ["None", "True", "2", "0.5", "'Li'"])
+
+
+	def test_objects_compare_equal_between_runs(self):
+		first, second = Settings(5), Settings(5)
+		self.assertNotEqual(repr(first), repr(second))
+		self.assertEqual(parameter_value([first, {"settings": first}]), parameter_value([second, {"settings": second}]))
+
+
+	def test_callables(self):
+		self.assertEqual(parameter_value(subtract_background), "tests.test_manifest.subtract_background")
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from IBPlib.ij.Projector import Projector
+from IBPlib.ij.ColorMerger import ColorMerger
+
+
+COLORTAGS = {0: ["_C1"], 1: ["_C2"]}
+
+
+def unreachable(*args):
+	raise OSError("Lost the file server.")
+
+
+def unreachable_scan(*args):
+	unreachable()
+	yield
+
+
+class QueueingFailureTest(unittest.TestCase):
+	'''
+	A failure while queueing images raises in run without leaving the workers waiting for tasks.
+	'''
+	def setUp(self):
+		self.folder = tempfile.mkdtemp(prefix="IBPlib_pipelines_")
+		self.savefolder = os.path.join(self.folder, "out")
+		os.mkdir(self.savefolder)
+		self.threads = threading.active_count()
+
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+
+	def test_projector_missing_folder(self):
+		projector = Projector(self.savefolder, os.path.join(self.folder, "missing"), ".tif")
+		self.assertRaises(IOError, projector.run)
+		self.assertEqual(threading.active_count(), self.threads)
+
+
+	def test_projector_queueing_error(self):
+		open(os.path.join(self.folder, "img.tif"), "w").close()
+		projector = Projector(self.savefolder, self.folder, ".tif")
+		projector.is_up_to_date = unreachable
+		self.assertRaises(OSError, projector.run)
+		self.assertEqual(threading.active_count(), self.threads)
+
+
+	def test_colormerger_missing_folder(self):
+		merger = ColorMerger(self.savefolder, os.path.join(self.folder, "missing"), ".tif", colortags=COLORTAGS)
+		self.assertRaises(IOError, merger.run)
+		self.assertEqual(threading.active_count(), self.threads)
+
+
+	def test_colormerger_queueing_error(self):
+		merger = ColorMerger(self.savefolder, self.folder, ".tif", colortags=COLORTAGS)
+		merger.scanchannels = unreachable_scan
+		self.assertRaises(OSError, merger.run)
+		self.assertEqual(threading.active_count(), self.threads)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from IBPlib.ij.Utils.Profiles import (ProfileWriter, read_profiles, BINARY_EXTENSION)
+
+
+class BinaryProfileWriterTest(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp(prefix="IBPlib_profiles_")
+		self.path = os.path.join(self.folder, "profiles{0}".format(BINARY_EXTENSION))
+
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+
+	def stored(self):
+		return [(p["roi"], p["values"]) for p in read_profiles(self.path, by_roi=True)]
+
+
+	def test_empty_flush_after_flush(self):
+		writer = ProfileWriter(self.path)
+		writer.add("a", "a_0", 3, "Li", [1, 2, 3])
+		writer.flush()
+		writer.flush()
+		writer.add("b", "b_0", 3, "Li", [4, 5])
+		writer.close()
+		self.assertEqual(self.stored(), [("a_0", [1.0, 2.0, 3.0]), ("b_0", [4.0, 5.0])])
+
+
+	def test_empty_flush_after_reopening(self):
+		with ProfileWriter(self.path) as writer:
+			writer.add("a", "a_0", 3, "Li", [1, 2])
+		writer = ProfileWriter(self.path, append=True)
+		writer.flush()
+		writer.add("b", "b_0", 3, "Li", [3])
+		writer.close()
+		self.assertEqual(self.stored(), [("a_0", [1.0, 2.0]), ("b_0", [3.0])])
+
+
+	def test_reopen_after_crash(self):
+		writer = ProfileWriter(self.path)
+		writer.add("a", "a_0", 3, "Li", [1, 2])
+		writer.flush()
+		writer.add("b", "b_0", 3, "Li", [3]) # Never flushed, as if the run crashed here.
+		writer.file.close()
+		writer = ProfileWriter(self.path, append=True)
+		writer.add("c", "c_0", 3, "Li", [4])
+		writer.close()
+		self.assertEqual(self.stored(), [("a_0", [1.0, 2.0]), ("c_0", [4.0])])
+
+
+	def test_missing_footer(self):
+		writer = ProfileWriter(self.path, buffer_rows=1)
+		writer.add("a", "a_0", 3, "Li", [1, 2]) # Written without a footer.
+		writer.file.close()
+		self.assertRaises(ValueError, ProfileWriter, self.path, append=True)
+
+
+
+class CSVProfileWriterTest(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp(prefix="IBPlib_profiles_")
+		self.path = os.path.join(self.folder, "profiles.csv")
+
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+
+	def test_append_skips_stored_profiles(self):
+		with ProfileWriter(self.path) as writer:
+			writer.add("a", "a_0", 3, "Li", [1, 2])
+		with ProfileWriter(self.path, append=True) as writer:
+			writer.add("a", "a_0", 3, "Li", [1, 2])
+			writer.add("b", "b_0", 3, "Li", [3])
+		profiles = read_profiles(self.path, by_roi=True)
+		self.assertEqual([(p["roi"], p["values"]) for p in profiles], [("a_0", [1.0, 2.0]), ("b_0", [3.0])])
+
+
+	def test_append_after_truncated_row(self):
+		with ProfileWriter(self.path) as writer:
+			writer.add("a", "a_0", 3, "Li", [1, 2])
+		with open(self.path, "rb+") as f:
+			f.seek(-2, os.SEEK_END)
+			f.truncate() # A crash in the middle of the last row.
+		with ProfileWriter(self.path, append=True) as writer:
+			writer.add("b", "b_0", 3, "Li", [3])
+		profiles = read_profiles(self.path, by_roi=True)
+		self.assertEqual(profiles[-1]["roi"], "b_0")
+		self.assertEqual(profiles[-1]["values"], [3.0])
+
+
+
+if __name__ == "__main__":
+	unittest.main()
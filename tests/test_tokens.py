@@ -0,0 +1,20 @@
+import unittest
+
+from IBPlib.ij.Utils.Files import TokenIndex
+
+GROUPS = {"marker": ("GFP", "mCherry"), "stage": {"L4": ("L4", "l4"), "adult": ("YA",)}, "flags": (), "empty": ("",)}
+
+
+class TokenIndexTest(unittest.TestCase):
+	def test_classify(self):
+		index = TokenIndex(GROUPS)
+		self.assertEqual(index.classify("GFP_l4_001.ics"), {"marker": "GFP", "stage": "L4"})
+		self.assertEqual(index.classify("mCherry_YA.ics"), {"marker": "mCherry", "stage": "adult"})
+
+
+	def test_empty_categories_are_skipped(self):
+		self.assertEqual(TokenIndex(GROUPS).classify("other.ics"), {})
+
+
+if __name__ == "__main__":
+	unittest.main()
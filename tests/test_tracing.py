@@ -0,0 +1,158 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from IBPlib.ij.Routines import tracing_and_linescanning
+from IBPlib.ij.Routines.batch_parameters import (Batch_Parameters, BatchJournal)
+from IBPlib.ij.Routines.tracing_and_linescanning import (SNTSession, profile_images, get_batch_schema,
+	setup_output_folders)
+from IBPlib.ij.Utils.Profiles import (ProfileWriter, read_profiles)
+
+
+class FakeSNT:
+	'''
+	Records the calls made to an SNT plugin.
+	'''
+	def __init__(self, ui=None):
+		self.ui = ui
+		self.calls = []
+
+
+	def __getattr__(self, name):
+		return lambda *args: self.calls.append((name,) + args)
+
+
+	def getUI(self):
+		return self.ui
+
+
+	def getPathAndFillManager(self):
+		return self
+
+
+class FakeUI:
+	READY = "ready"
+
+	def isReady(self):
+		return True
+
+
+class FakeCosts:
+	def get(self, imp, channel, sigma, path=None):
+		return "tubeness of {0}".format(imp)
+
+
+class SNTSessionTest(unittest.TestCase):
+	def setUp(self):
+		self.prepared = []
+		self.prepare_SNT = tracing_and_linescanning.prepare_SNT
+		tracing_and_linescanning.prepare_SNT = self.prepare
+
+
+	def tearDown(self):
+		tracing_and_linescanning.prepare_SNT = self.prepare_SNT
+
+
+	def prepare(self, context, imp):
+		self.prepared.append(imp)
+		return FakeSNT(FakeUI())
+
+
+	def test_reuses_open_snt(self):
+		session = SNTSession(None)
+		plugin = session.load("img1")
+		self.assertTrue(session.load("img2") is plugin)
+		self.assertEqual(self.prepared, ["img1"])
+		self.assertTrue(("initialize", "img2") in plugin.calls)
+
+
+	def test_prepares_closed_snt_again(self):
+		session = SNTSession(None)
+		session.load("img1").ui = None # The user closed SNT.
+		session.load("img2")
+		self.assertEqual(self.prepared, ["img1", "img2"])
+
+
+	def test_traces_on_cost_image(self):
+		session = SNTSession(None, hessian=True)
+		session.costs = FakeCosts()
+		plugin = session.load("img1")
+		self.assertTrue(("loadSecondaryImage", "tubeness of img1") in plugin.calls)
+		self.assertTrue(("enableSecondaryImgTracing", True) in plugin.calls)
+
+
+
+class FakeImage:
+	def __init__(self, path):
+		self.title = os.path.basename(path)
+
+
+	def getTitle(self):
+		return self.title
+
+
+	def close(self):
+		pass
+
+
+def fake_profile_from_threshold(imp, analysis_ch, rois, stroke_width, th_method, csvs_output, writer=None,
+	masks=None, path=None, threads=None):
+	writer.add(imp.getTitle(), "{0}_0".format(imp.getTitle()), stroke_width, th_method, [1, 2])
+	if imp.getTitle().startswith("broken"):
+		raise ValueError("Profiling failed after the first roi.")
+	writer.add(imp.getTitle(), "{0}_1".format(imp.getTitle()), stroke_width, th_method, [3])
+
+
+class ProfileImagesTest(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp(prefix="IBPlib_tracing_")
+		self.rois_folder, self.csvs_folder = setup_output_folders(self.folder)
+		self.batch_parameters = Batch_Parameters(get_batch_schema(), batch_name="test")
+		self.batch_parameters.set("output_folder", self.folder)
+		self.batch_parameters.set("stroke_width", 3)
+		self.batch_parameters.set("th_method", "Li")
+		self.patched = (tracing_and_linescanning.imageloader, tracing_and_linescanning.profile_from_threshold)
+		tracing_and_linescanning.imageloader = FakeImage
+		tracing_and_linescanning.profile_from_threshold = fake_profile_from_threshold
+
+
+	def tearDown(self):
+		tracing_and_linescanning.imageloader, tracing_and_linescanning.profile_from_threshold = self.patched
+		shutil.rmtree(self.folder)
+
+
+	def profile(self, threads=2):
+		path = os.path.join(self.csvs_folder, "profiles.csv")
+		with ProfileWriter(path) as writer:
+			failed = profile_images(self.batch_parameters, self.rois_folder, self.csvs_folder, writer, threads=threads)
+		return failed, [p["roi"] for p in read_profiles(path, by_roi=True)]
+
+
+	def test_no_analysed_images(self):
+		threads = threading.active_count()
+		self.assertEqual(self.profile(), ([], []))
+		self.assertEqual(threading.active_count(), threads)
+
+
+	def test_failed_image_profiles_are_dropped(self):
+		self.batch_parameters.set("analysed_images", ["a.tif", "broken.tif", "b.tif"])
+		failed, rois = self.profile()
+		self.assertEqual(failed, ["broken.tif"])
+		self.assertEqual(rois, ["a.tif_0", "a.tif_1", "b.tif_0", "b.tif_1"])
+
+
+	def test_journaled_images_are_profiled(self):
+		self.batch_parameters.set("analysed_images", ["a.tif"])
+		self.batch_parameters.set("raw_images", ["b.tif"])
+		journal = BatchJournal(self.batch_parameters, self.folder, compact_every=0)
+		journal.record("b.tif") # Not compacted, as after a crash.
+		journal.close()
+		failed, rois = self.profile()
+		self.assertEqual(rois, ["a.tif_0", "a.tif_1", "b.tif_0", "b.tif_1"])
+
+
+
+if __name__ == "__main__":
+	unittest.main()